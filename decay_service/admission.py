@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+import falcon
+import redis
+from scoring import _parse_host
+import metrics
+from constants import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_SHARD_HOSTS, TRENDING_KEY, ADMISSION_ROUTES, API_KEYS,
+    RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_BACKEND, RATE_LIMIT_MAX_CLIENTS, MAX_IN_FLIGHT, SHED_WAIT_MS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Admission control in front of the write routes. Two checks run before a
+# request reaches its resource, both answering in microseconds so a flood costs
+# the workers as little as possible:
+#   1. a token bucket per client; an empty bucket means 429 with Retry-After,
+#   2. a cap on requests in flight in this process; a request that cannot get a
+#      slot within SHED_WAIT_MS is shed with 503, instead of queueing behind a
+#      backlog that would raise everyone's latency.
+
+# KEYS[1]: the client's bucket hash; ARGV: rate per second, burst, now (seconds)
+# Returns {1 if admitted, tokens left as a string}.
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local admitted = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    admitted = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+-- A bucket left alone this long is full again, which is what a missing key means
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {admitted, tostring(tokens)}
+"""
+
+def client_id(req, api_keys=API_KEYS) -> str:
+    """Bucket name of the client: its X-API-Key if the key is one of `api_keys`, else its address.
+
+    A key anyone can make up would give every request a fresh bucket, so unknown keys are ignored.
+    """
+    api_key = req.get_header("X-API-Key")
+    return f"key:{api_key}" if api_key in api_keys else f"ip:{req.remote_addr}"
+
+class TokenBuckets:
+    """Per-client token buckets in this process, forgetting the least recently seen clients first."""
+
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, burst: float = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client: str, now: float) -> float:
+        """0 if `client` may send a request now, else the seconds until it may."""
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+            admitted = tokens >= 1
+            self._buckets[client] = (tokens - 1 if admitted else tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return 0.0 if admitted else (1 - tokens) / self.rate
+
+class RedisTokenBuckets(TokenBuckets):
+    """Token buckets shared by every worker through "ratelimit:<key>:<client>" hashes on the first Redis host.
+
+    While Redis is unreachable, requests are limited by this process's own buckets.
+    """
+
+    def __init__(self, key: str = TRENDING_KEY, hosts=REDIS_SHARD_HOSTS, **kwargs):
+        super().__init__(**kwargs)
+        self.key = key
+        host, port = _parse_host(hosts[0]) if hosts else (REDIS_HOST, REDIS_PORT)
+        self.client = redis.Redis(host=host, port=port, db=REDIS_DB)
+        self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._failing = False
+
+    def take(self, client: str, now: float) -> float:
+        try:
+            with metrics.REDIS_LATENCY.time(command="evalsha"):
+                admitted, tokens = self._script(keys=[f"ratelimit:{self.key}:{client}"],
+                                                args=[self.rate, self.burst, now])
+        except redis.RedisError as e:
+            if not self._failing:
+                logger.warning("Rate limiting in-process while Redis fails: %s", e)
+                self._failing = True
+            return super().take(client, now)
+        self._failing = False
+        return 0.0 if admitted else (1 - float(tokens)) / self.rate
+
+def make_buckets(backend: str = RATE_LIMIT_BACKEND):
+    if RATE_LIMIT_PER_SECOND <= 0:
+        return None
+    if backend == "redis":
+        return RedisTokenBuckets()
+    if backend == "local":
+        return TokenBuckets()
+    raise ValueError(f"unknown RATE_LIMIT_BACKEND {backend!r}")
+
+def _reject(resp, status, reason: str, error: str, retry_after: float):
+    metrics.ADMISSION_REJECTED.inc(reason=reason)
+    resp.status = status
+    resp.media = {"error": error}
+    resp.set_header("Retry-After", str(max(1, math.ceil(retry_after))))
+    resp.complete = True
+
+class AdmissionMiddleware:
+    """Falcon middleware rate limiting and shedding the routes in ADMISSION_ROUTES;
+    works for both falcon.App and falcon.asgi.App."""
+
+    def __init__(self, buckets=None, max_in_flight: int = MAX_IN_FLIGHT, wait_ms: int = SHED_WAIT_MS,
+                 routes=ADMISSION_ROUTES, api_keys=API_KEYS):
+        self.buckets = make_buckets() if buckets is None else buckets
+        self.api_keys = frozenset(api_keys)
+        self.max_in_flight = max_in_flight
+        self.wait = wait_ms / 1000.0
+        self.routes = frozenset(routes)
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        # asyncio semaphores belong to one event loop, so the ASGI one is made on first use
+        self._async_slots = None
+
+    def _rate_limited(self, req, resp, wait: float) -> bool:
+        if wait > 0:
+            _reject(resp, falcon.HTTP_429, "rate_limited", "rate limit exceeded", wait)
+            return True
+        return False
+
+    def process_request(self, req, resp):
+        if req.path not in self.routes:
+            return
+        if self.buckets is not None:
+            wait = self.buckets.take(client_id(req, self.api_keys), time.time())
+            if self._rate_limited(req, resp, wait):
+                return
+        if self._slots is None:
+            return
+        if not (self._slots.acquire(timeout=self.wait) if self.wait > 0 else self._slots.acquire(blocking=False)):
+            _reject(resp, falcon.HTTP_503, "shed", "server overloaded, retry later", 1)
+            return
+        req.context.admission_slot = True
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if getattr(req.context, "admission_slot", False):
+            self._slots.release()
+
+    async def process_request_async(self, req, resp):
+        if req.path not in self.routes:
+            return
+        if self.buckets is not None:
+            take = self.buckets.take
+            # Redis buckets block on the network, so they run on a worker thread
+            client = client_id(req, self.api_keys)
+            wait = (await asyncio.to_thread(take, client, time.time())
+                    if isinstance(self.buckets, RedisTokenBuckets) else take(client, time.time()))
+            if self._rate_limited(req, resp, wait):
+                return
+        if self.max_in_flight <= 0:
+            return
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_in_flight)
+        slots = self._async_slots
+        if slots.locked():
+            try:
+                if self.wait <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(slots.acquire(), self.wait)
+            except asyncio.TimeoutError:
+                _reject(resp, falcon.HTTP_503, "shed", "server overloaded, retry later", 1)
+                return
+        else:
+            await slots.acquire()
+        req.context.admission_slot = True
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        if getattr(req.context, "admission_slot", False):
+            self._async_slots.release()
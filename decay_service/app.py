@@ -1,23 +1,37 @@
+import logging
+import time
 import falcon
-import json
-from scoring import add_event, get_trending
-from constants import TRENDING_KEY
+from payloads import parse_event, parse_batch, encode_cursor, serialize_trending, json_handler
+from scoring import add_event, add_events, get_trending, get_velocity
+import metrics
+from app_common import parse_trending_query, register_stats
+from admission import AdmissionMiddleware
+from cache import TrendingCache
+from dedup import split_duplicates, remember
+from constants import TRENDING_KEY, MAX_BATCH_EVENTS, IN_PROCESS_STORE, LOG_LEVEL, LOG_FORMAT
+
+# A no-op when the server (gunicorn via serve.py) has configured logging already
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
 class AddEventResource:
     def on_post(self, req, resp):
         try:
-            print("Got a new Add Event Request")
-            body = req.media
-            item_id = body.get("item_id")
-            event_time = body.get("event_time")
-            weight = body.get("weight", 1.0)
-
-            if not item_id or not event_time:
+            try:
+                event = parse_event(req.bounded_stream.read())
+            except ValueError as e:
                 resp.status = falcon.HTTP_400
-                resp.media = {"error": "item_id and event_time are required"}
+                resp.media = {"error": str(e)}
                 return
 
-            add_event(TRENDING_KEY, item_id, int(event_time), float(weight))
+            events, duplicates = split_duplicates([event])
+            if duplicates:
+                resp.status = falcon.HTTP_200
+                resp.media = {"message": "Duplicate event ignored", "duplicate": True}
+                return
+            # A buffered event is only written by a later flush, which may fail, so its ID stays unmarked
+            if add_event(TRENDING_KEY, *event[:4]):
+                remember(events)
             resp.status = falcon.HTTP_200
             resp.media = {"message": "Event added successfully"}
 
@@ -25,26 +39,100 @@ class AddEventResource:
             resp.status = falcon.HTTP_500
             resp.media = {"error": str(e)}
 
+class AddEventsResource:
+    def on_post(self, req, resp):
+        try:
+            try:
+                bodies = parse_batch(req.bounded_stream.read(), req.content_type)
+            except ValueError as e:
+                resp.status = falcon.HTTP_400
+                resp.media = {"error": f"invalid batch body: {e}"}
+                return
+            if len(bodies) > MAX_BATCH_EVENTS:
+                resp.status = falcon.HTTP_413
+                resp.media = {"error": f"batch exceeds {MAX_BATCH_EVENTS} events"}
+                return
+            metrics.BATCH_SIZE.observe(len(bodies))
+
+            events, errors = [], []
+            for index, body in enumerate(bodies):
+                try:
+                    events.append(parse_event(body))
+                except ValueError as e:
+                    errors.append({"index": index, "error": str(e)})
+
+            events, duplicates = split_duplicates(events)
+            add_events(TRENDING_KEY, events)
+            remember(events)
+            resp.status = falcon.HTTP_200 if events or duplicates or not errors else falcon.HTTP_400
+            resp.media = {"added": len(events), "duplicates": duplicates, "errors": errors}
+
+        except Exception as e:
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": str(e)}
+
+# Cached per (window, categories); every entry is a top-TRENDING_CACHE_MAX_K read of one set or category union
+trending_cache = TrendingCache(lambda key, count: get_trending(TRENDING_KEY, count, *key), serialize_trending)
+
 class TrendingResource:
     def on_get(self, req, resp):
         try:
-            count = int(req.get_param("count") or 10)
-            items = get_trending(TRENDING_KEY, count)
-            result = [{"item_id": item.decode(), "score": round(score, 6)} for item, score in items]
+            now = int(time.time())
+            try:
+                query = parse_trending_query(req, now)
+            except ValueError as e:
+                resp.status = falcon.HTTP_400
+                resp.media = {"error": str(e)}
+                return
             resp.status = falcon.HTTP_200
-            resp.media = result
+            resp.content_type = falcon.MEDIA_JSON
+            if query.mode == "velocity":
+                rows = get_velocity(TRENDING_KEY, query.count, query.categories, query.offset, now)
+                resp.data = serialize_trending(rows)
+                return
+            if query.uncached:
+                # Pages and reads at another time bypass the cache; pages link to the next one
+                try:
+                    rows = get_trending(TRENDING_KEY, query.count, query.window, query.categories, query.offset,
+                                     query.cursor, now, query.at)
+                except ValueError as e:
+                    # A past `at` that no history copy covers
+                    resp.status = falcon.HTTP_400
+                    resp.media = {"error": str(e)}
+                    return
+                if len(rows) == query.count:
+                    resp.set_header("X-Next-Cursor", encode_cursor(rows[-1], now if query.at is None else query.at))
+                resp.data = serialize_trending(rows)
+                return
+            resp.data = trending_cache.get((query.window, query.categories), query.count)
         except Exception as e:
             resp.status = falcon.HTTP_500
             resp.media = {"error": str(e)}
 
+class MetricsResource:
+    def on_get(self, req, resp):
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.text = metrics.render(metrics.aggregate())
+
+collect_stats = register_stats(trending_cache)
+
+# In-process stores only exist in this process, so their maintenance jobs run here too
+if IN_PROCESS_STORE:
+    import jobs
+    jobs.start_in_background()
+
 # Falcon app setup
-app = falcon.App()
+app = falcon.App(middleware=[metrics.MetricsMiddleware(), AdmissionMiddleware()])
+app.req_options.media_handlers[falcon.MEDIA_JSON] = json_handler
+app.resp_options.media_handlers[falcon.MEDIA_JSON] = json_handler
 app.add_route('/add_event', AddEventResource())
+app.add_route('/add_events', AddEventsResource())
 app.add_route('/trending', TrendingResource())
+app.add_route('/metrics', MetricsResource())
 
-# For dev testing only
+# For dev testing only; production runs `python serve.py`
 if __name__ == "__main__":
     from wsgiref import simple_server
     httpd = simple_server.make_server('127.0.0.1', 8000, app)
-    print("Serving on http://127.0.0.1:8000")
+    logger.info("Serving on http://127.0.0.1:8000")
     httpd.serve_forever()
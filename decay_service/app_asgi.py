@@ -0,0 +1,160 @@
+import logging
+import time
+import falcon
+import falcon.asgi
+from payloads import parse_event, parse_batch, encode_cursor, serialize_trending, json_handler
+from scoring_async import add_event, add_events, get_trending, get_velocity, pools
+import metrics
+from app_common import parse_trending_query, register_stats
+from admission import AdmissionMiddleware
+from cache import AsyncTrendingCache
+from dedup import split_duplicates_async, remember_async
+from constants import (
+    TRENDING_KEY, MAX_BATCH_EVENTS, IN_PROCESS_STORE, STORE_BACKEND, REDIS_MAX_CONNECTIONS, SERVER_WARM_CONNECTIONS,
+    LOG_LEVEL, LOG_FORMAT,
+)
+
+# A no-op when the server (gunicorn via serve.py) has configured logging already
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+# ASGI variant of app.py: same routes and payloads, served by e.g.
+#   python serve.py --worker-class asgi
+#   uvicorn app_asgi:app --workers 4
+
+class AddEventResource:
+    async def on_post(self, req, resp):
+        try:
+            try:
+                event = parse_event(await req.stream.read())
+            except ValueError as e:
+                resp.status = falcon.HTTP_400
+                resp.media = {"error": str(e)}
+                return
+
+            events, duplicates = await split_duplicates_async([event])
+            if duplicates:
+                resp.status = falcon.HTTP_200
+                resp.media = {"message": "Duplicate event ignored", "duplicate": True}
+                return
+            # A buffered event is only written by a later flush, which may fail, so its ID stays unmarked
+            if await add_event(TRENDING_KEY, *event[:4]):
+                await remember_async(events)
+            resp.status = falcon.HTTP_200
+            resp.media = {"message": "Event added successfully"}
+
+        except Exception as e:
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": str(e)}
+
+class AddEventsResource:
+    async def on_post(self, req, resp):
+        try:
+            try:
+                bodies = parse_batch(await req.stream.read(), req.content_type)
+            except ValueError as e:
+                resp.status = falcon.HTTP_400
+                resp.media = {"error": f"invalid batch body: {e}"}
+                return
+            if len(bodies) > MAX_BATCH_EVENTS:
+                resp.status = falcon.HTTP_413
+                resp.media = {"error": f"batch exceeds {MAX_BATCH_EVENTS} events"}
+                return
+            metrics.BATCH_SIZE.observe(len(bodies))
+
+            events, errors = [], []
+            for index, body in enumerate(bodies):
+                try:
+                    events.append(parse_event(body))
+                except ValueError as e:
+                    errors.append({"index": index, "error": str(e)})
+
+            events, duplicates = await split_duplicates_async(events)
+            await add_events(TRENDING_KEY, events)
+            await remember_async(events)
+            resp.status = falcon.HTTP_200 if events or duplicates or not errors else falcon.HTTP_400
+            resp.media = {"added": len(events), "duplicates": duplicates, "errors": errors}
+
+        except Exception as e:
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": str(e)}
+
+trending_cache = AsyncTrendingCache(lambda key, count: get_trending(TRENDING_KEY, count, *key),
+                                    serialize_trending)
+
+class TrendingResource:
+    async def on_get(self, req, resp):
+        try:
+            now = int(time.time())
+            try:
+                query = parse_trending_query(req, now)
+            except ValueError as e:
+                resp.status = falcon.HTTP_400
+                resp.media = {"error": str(e)}
+                return
+            resp.status = falcon.HTTP_200
+            resp.content_type = falcon.MEDIA_JSON
+            if query.mode == "velocity":
+                rows = await get_velocity(TRENDING_KEY, query.count, query.categories, query.offset, now)
+                resp.data = serialize_trending(rows)
+                return
+            if query.uncached:
+                # Pages and reads at another time bypass the cache; pages link to the next one
+                try:
+                    rows = await get_trending(TRENDING_KEY, query.count, query.window, query.categories, query.offset,
+                                           query.cursor, now, query.at)
+                except ValueError as e:
+                    # A past `at` that no history copy covers
+                    resp.status = falcon.HTTP_400
+                    resp.media = {"error": str(e)}
+                    return
+                if len(rows) == query.count:
+                    resp.set_header("X-Next-Cursor", encode_cursor(rows[-1], now if query.at is None else query.at))
+                resp.data = serialize_trending(rows)
+                return
+            resp.data = await trending_cache.get((query.window, query.categories), query.count)
+        except Exception as e:
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": str(e)}
+
+class RedisPoolLifecycle:
+    async def process_startup(self, scope, event):
+        # Connect before the server accepts traffic, so the first requests skip the handshakes
+        if STORE_BACKEND != "redis":
+            return
+        start = time.monotonic()
+        try:
+            for pool in pools:
+                connections = [await pool.get_connection()
+                               for _ in range(min(SERVER_WARM_CONNECTIONS, REDIS_MAX_CONNECTIONS))]
+                for connection in connections:
+                    await pool.release(connection)
+        except Exception as e:
+            logger.warning("Could not warm the Redis connection pools: %s", e)
+            return
+        logger.info("Warmed %d Redis connection pools in %.1fms", len(pools), (time.monotonic() - start) * 1000)
+
+    async def process_shutdown(self, scope, event):
+        for pool in pools:
+            await pool.disconnect()
+
+class MetricsResource:
+    async def on_get(self, req, resp):
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.text = metrics.render(metrics.aggregate())
+
+collect_stats = register_stats(trending_cache)
+
+# In-process stores only exist in this process, so their maintenance jobs run here too
+if IN_PROCESS_STORE:
+    import jobs
+    jobs.start_in_background()
+
+# Falcon app setup
+app = falcon.asgi.App(middleware=[RedisPoolLifecycle(), metrics.MetricsMiddleware(), AdmissionMiddleware()])
+app.req_options.media_handlers[falcon.MEDIA_JSON] = json_handler
+app.resp_options.media_handlers[falcon.MEDIA_JSON] = json_handler
+app.add_route('/add_event', AddEventResource())
+app.add_route('/add_events', AddEventsResource())
+app.add_route('/trending', TrendingResource())
+app.add_route('/metrics', MetricsResource())
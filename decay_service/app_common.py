@@ -0,0 +1,70 @@
+import logging
+import msgspec
+import metrics
+from payloads import parse_categories, parse_cursor, parse_at, parse_mode
+from scoring import profile_target, coalesce_stats, client_cache_stats, store_memory
+from constants import TRENDING_KEY
+
+logger = logging.getLogger(__name__)
+
+# Request handling shared by app.py (WSGI) and app_asgi.py (ASGI), which only
+# differ in how they await the store.
+
+class TrendingQuery(msgspec.Struct, gc=False):
+    """/trending query parameters, as in swagger.yml."""
+    count: int
+    window: str = None
+    categories: tuple = ()
+    offset: int = 0
+    cursor: tuple = None
+    at: int = None
+    mode: str = "decay"
+    # Pages and reads at another time bypass the response cache
+    uncached: bool = False
+
+def parse_trending_query(req, now: int) -> TrendingQuery:
+    """TrendingQuery of a /trending request; raises ValueError with the message for a 400."""
+    try:
+        count = int(req.get_param("count") or 10)
+        offset = int(req.get_param("offset") or 0)
+    except ValueError:
+        raise ValueError("count and offset must be integers")
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    window = req.get_param("window")
+    profile_target(TRENDING_KEY, window)
+    categories = parse_categories(req.get_param("category"))
+    cursor = req.get_param("cursor")
+    cursor = parse_cursor(cursor) if cursor else None
+    at = req.get_param("at")
+    at = parse_at(at, now) if at else None
+    mode = parse_mode(req.get_param("mode"))
+    if mode == "velocity" and (window or len(categories) > 1 or cursor or at is not None):
+        raise ValueError("mode=velocity takes only count, offset and a single category")
+    return TrendingQuery(count, window, categories, offset, cursor, at, mode,
+                         req.has_param("offset") or cursor is not None or at is not None)
+
+def register_stats(trending_cache):
+    """Copy the coalescing, cache and store memory stats of this process into /metrics on every scrape."""
+
+    @metrics.on_collect
+    def collect_stats():
+        stats = coalesce_stats()
+        if stats:
+            metrics.COALESCED_EVENTS.set(stats["events"])
+            metrics.COALESCED_WRITES.set(stats["writes"])
+        metrics.CACHE_LOOKUPS.set(trending_cache.hits, result="hit")
+        metrics.CACHE_LOOKUPS.set(trending_cache.misses, result="miss")
+        tracked = client_cache_stats()
+        if tracked:
+            metrics.CLIENT_CACHE_LOOKUPS.set(tracked["hits"], result="hit")
+            metrics.CLIENT_CACHE_LOOKUPS.set(tracked["misses"], result="miss")
+        try:
+            for profile_key, size in store_memory(TRENDING_KEY).items():
+                metrics.STORE_MEMORY.set(size, key=profile_key)
+        except Exception as e:
+            logger.warning("store memory stats failed: %s", e)
+
+    return collect_stats
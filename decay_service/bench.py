@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+
+# Load harness for the decay service. Every mode replays the same workload: events
+# streamed from an NDJSON file shaped like /add_event bodies (--events), or drawn
+# from a Zipf distribution over --items item_ids, mixed with GET /trending.
+#
+#   python bench.py inprocess --store local --requests 50000
+#   python bench.py socket --host 127.0.0.1 --port 8000 --duration 20 --concurrency 100
+#   python bench.py compare --workers 4 --concurrency 200 --duration 20
+#
+# inprocess drives app.app through falcon.testing, socket drives a running server,
+# compare starts the WSGI app under gunicorn and the ASGI app under uvicorn and runs
+# the socket load against each. --store local swaps Redis for the in-process store.
+
+SERVERS = {
+    "wsgi": lambda port, workers: ["gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}", "app:app"],
+    "asgi": lambda port, workers: ["uvicorn", "app_asgi:app", "--workers", str(workers),
+                                   "--port", str(port), "--log-level", "warning"],
+}
+
+def read_events(path: str):
+    """Stream event dicts from an NDJSON file, looping over it forever."""
+    while True:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def zipf_events(items: int, exponent: float, seed: int = None, chunk: int = 4096):
+    """Endless events whose item_id popularity follows a Zipf law over `items` ids."""
+    rng = np.random.default_rng(seed)
+    p = 1.0 / np.arange(1, items + 1) ** exponent
+    p /= p.sum()
+    while True:
+        now = int(time.time())
+        for rank in rng.choice(items, size=chunk, p=p).tolist():
+            yield {"item_id": f"item_{rank}", "event_time": now, "weight": 1.0}
+
+def content_type(path: str) -> str:
+    return "application/x-ndjson" if path == "/add_events" else "application/json"
+
+def workload(events, trending_ratio: float, batch: int, count: int, seed: int = None):
+    """Endless (kind, path, body, events_in_request) tuples."""
+    rng = random.Random(seed)
+    while True:
+        if rng.random() < trending_ratio:
+            yield "trending", f"/trending?count={count}", None, 0
+        elif batch > 1:
+            body = "\n".join(json.dumps(event) for event in itertools.islice(events, batch)).encode()
+            yield "add_events", "/add_events", body, batch
+        else:
+            yield "add_event", "/add_event", json.dumps(next(events)).encode(), 1
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def redis_commands():
+    """Commands processed by every Redis the store talks to, or None for in-process stores."""
+    from scoring import store, RedisTrendingStore
+    if not isinstance(store, RedisTrendingStore):
+        return None
+    try:
+        return sum(client.info("stats")["total_commands_processed"] for client in store.clients)
+    except Exception:
+        return None
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = 0
+        self.events = 0
+
+    def record(self, kind: str, seconds: float, status: int, events: int):
+        self.latencies.setdefault(kind, []).append(seconds)
+        if status >= 400:
+            self.errors += 1
+        else:
+            self.events += events
+
+    def report(self, elapsed: float, commands_before, commands_after) -> dict:
+        requests = sum(len(samples) for samples in self.latencies.values())
+        result = {
+            "requests": requests,
+            "requests_per_sec": round(requests / elapsed, 1),
+            "events_per_sec": round(self.events / elapsed, 1),
+            "errors": self.errors,
+        }
+        if commands_before is not None and commands_after is not None and requests:
+            # The INFO calls themselves add a couple of commands
+            result["redis_ops_per_request"] = round((commands_after - commands_before) / requests, 3)
+        for kind, samples in sorted(self.latencies.items()):
+            result[kind] = {f"p{pct}_ms": round(percentile(samples, pct) * 1000, 3) for pct in (50, 95, 99)}
+        return result
+
+def run_inprocess(requests, total: int) -> dict:
+    from falcon import testing
+    import app
+    client = testing.TestClient(app.app)
+    recorder = Recorder()
+    before = redis_commands()
+    start = time.perf_counter()
+    for kind, path, body, events in itertools.islice(requests, total):
+        path, _, query = path.partition("?")
+        t0 = time.perf_counter()
+        if body is None:
+            result = client.simulate_get(path, query_string=query)
+        else:
+            result = client.simulate_post(path, body=body, headers={"Content-Type": content_type(path)})
+        recorder.record(kind, time.perf_counter() - t0, result.status_code, events)
+    elapsed = time.perf_counter() - start
+    return recorder.report(elapsed, before, redis_commands())
+
+def build_request(host: str, port: int, path: str, body: bytes = None) -> bytes:
+    method = "POST" if body is not None else "GET"
+    head = f"{method} {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+    if body is not None:
+        head += f"Content-Type: {content_type(path)}\r\nContent-Length: {len(body)}\r\n"
+    return (head + "\r\n").encode() + (body or b"")
+
+async def read_response(reader) -> tuple:
+    status = int((await reader.readline()).split()[1])
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection" and value.strip().lower() == "close":
+            keep_alive = False
+    await reader.readexactly(length)
+    return status, keep_alive
+
+async def socket_client(host: str, port: int, requests, deadline: float, recorder: Recorder):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        kind, path, body, events = next(requests)
+        request = build_request(host, port, path, body)
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            status, keep_alive = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            recorder.errors += 1
+            writer = None
+            continue
+        recorder.record(kind, time.perf_counter() - start, status, events)
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+def run_socket(requests, host: str, port: int, concurrency: int, duration: float) -> dict:
+    recorder = Recorder()
+    before = redis_commands()
+
+    async def drive():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(socket_client(host, port, requests, deadline, recorder) for _ in range(concurrency)))
+
+    start = time.perf_counter()
+    asyncio.run(drive())
+    return recorder.report(time.perf_counter() - start, before, redis_commands())
+
+def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            asyncio.run(asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 1))
+            return
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+def run_server(kind: str, requests, args) -> dict:
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(SERVERS[kind](args.port, args.workers), cwd=cwd)
+    try:
+        wait_for_port(args.port)
+        return run_socket(requests, "127.0.0.1", args.port, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay an event workload against the decay service")
+    parser.add_argument("mode", choices=["inprocess", "socket", "compare"])
+    parser.add_argument("--events", help="NDJSON file of /add_event bodies to replay (default: synthetic Zipf)")
+    parser.add_argument("--items", type=int, default=100000, help="distinct item_ids in the synthetic workload")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of item popularity")
+    parser.add_argument("--trending-ratio", type=float, default=0.2, help="share of requests that are GET /trending")
+    parser.add_argument("--batch", type=int, default=1, help="events per request; >1 posts NDJSON to /add_events")
+    parser.add_argument("--count", type=int, default=10, help="count parameter of /trending")
+    parser.add_argument("--store", choices=["redis", "local", "sketch", "redis_sketch"],
+                        help="override STORE_BACKEND")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--requests", type=int, default=20000, help="requests to send in inprocess mode")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load in socket/compare mode")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--servers", default="wsgi,asgi", help="servers to start in compare mode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    if args.store:
+        # Read by constants.py, and inherited by servers started in compare mode
+        os.environ["STORE_BACKEND"] = args.store
+    events = read_events(args.events) if args.events else zipf_events(args.items, args.zipf, args.seed)
+    requests = workload(events, args.trending_ratio, args.batch, args.count, args.seed)
+
+    if args.mode == "inprocess":
+        print(json.dumps(run_inprocess(requests, args.requests)))
+    elif args.mode == "socket":
+        print(json.dumps(run_socket(requests, args.host, args.port, args.concurrency, args.duration)))
+    else:
+        for kind in args.servers.split(","):
+            print(kind, json.dumps(run_server(kind, requests, args)))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from constants import TRENDING_CACHE_TTL_MS, TRENDING_CACHE_MAX_K, TRENDING_CACHE_MAX_KEYS
+
+class _Entry:
+    __slots__ = ("rows", "expires", "rendered")
+
+    def __init__(self, rows, expires: float):
+        self.rows = rows
+        self.expires = expires
+        self.rendered = {}
+
+class TrendingCache:
+    """TTL cache of serialized top-K responses.
+
+    Each key is filled by one loader(key, max_k) call; every count up to max_k is
+    answered by slicing those rows, and its serialized bytes are kept until the
+    entry expires. Only one thread per key reloads an expired entry while the
+    others keep serving the stale one, so expiry never stampedes the backend.
+    Keys come from the request, so beyond max_keys the least recently refreshed
+    entry and its lock are dropped.
+    """
+
+    def __init__(self, loader, serialize, ttl_ms: int = TRENDING_CACHE_TTL_MS, max_k: int = TRENDING_CACHE_MAX_K,
+                 max_keys: int = TRENDING_CACHE_MAX_KEYS):
+        self.loader = loader
+        self.serialize = serialize
+        self.ttl = ttl_ms / 1000.0
+        self.max_k = max_k
+        self.max_keys = max_keys
+        # Ordered by last refresh, oldest first
+        self._entries = OrderedDict()
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, count: int) -> bytes:
+        if self.ttl <= 0 or count > self.max_k:
+            return self.serialize(self.loader(key, count))
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            entry = self._refresh(key, entry)
+        else:
+            self.hits += 1
+        rendered = entry.rendered.get(count)
+        if rendered is None:
+            rendered = entry.rendered[count] = self.serialize(entry.rows[:count])
+        return rendered
+
+    def invalidate(self, key: str = None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._locks_guard:
+                lock = self._locks.setdefault(key, threading.Lock())
+        return lock
+
+    def _put(self, key: str, entry: _Entry):
+        with self._locks_guard:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_keys:
+                evicted, _ = self._entries.popitem(last=False)
+                self._locks.pop(evicted, None)
+            # Loads that failed leave a lock but no entry
+            while len(self._locks) > self.max_keys:
+                self._locks.pop(next(iter(self._locks)))
+
+    def _refresh(self, key: str, stale: _Entry) -> _Entry:
+        lock = self._lock_for(key)
+        if not lock.acquire(blocking=stale is None):
+            self.hits += 1
+            return stale
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = _Entry(self.loader(key, self.max_k), time.monotonic() + self.ttl)
+            self._put(key, entry)
+            return entry
+        finally:
+            lock.release()
+
+class AsyncTrendingCache(TrendingCache):
+    """TrendingCache for coroutine loaders, guarded by asyncio locks."""
+
+    async def get(self, key: str, count: int) -> bytes:
+        if self.ttl <= 0 or count > self.max_k:
+            return self.serialize(await self.loader(key, count))
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            entry = await self._refresh(key, entry)
+        else:
+            self.hits += 1
+        rendered = entry.rendered.get(count)
+        if rendered is None:
+            rendered = entry.rendered[count] = self.serialize(entry.rows[:count])
+        return rendered
+
+    def _lock_for(self, key: str) -> asyncio.Lock:
+        # Single event loop thread: no guard needed around the dict.
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    async def _refresh(self, key: str, stale: _Entry) -> _Entry:
+        lock = self._lock_for(key)
+        if stale is not None and lock.locked():
+            self.hits += 1
+            return stale
+        async with lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = _Entry(await self.loader(key, self.max_k), time.monotonic() + self.ttl)
+            self._put(key, entry)
+            return entry
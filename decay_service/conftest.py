@@ -0,0 +1,38 @@
+import os
+
+# Read once by constants.py, so they must be set before any service module is imported.
+# Tests build their own stores; the module-level one is in-process so importing opens no sockets.
+os.environ["SCORING_MODE"] = "forward"
+os.environ["STORE_BACKEND"] = "local"
+os.environ.pop("SNAPSHOT_DIR", None)
+os.environ.pop("METRICS_DIR", None)
+os.environ.pop("COALESCE_WINDOW_MS", None)
+
+import pytest
+import redis
+import scoring
+from local_store import LocalTrendingStore
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Make every redis.Redis(host=..., port=...) a fakeredis client, one server per address."""
+    fakeredis = pytest.importorskip("fakeredis")
+    servers = {}
+
+    def client(host="localhost", port=6379, **kwargs):
+        server = servers.setdefault((host, port), fakeredis.FakeServer())
+        return fakeredis.FakeRedis(server=server, **kwargs)
+
+    monkeypatch.setattr(redis, "Redis", client)
+    return servers
+
+@pytest.fixture(params=["local", "redis"])
+def store(request, monkeypatch):
+    """The module-level store replaced by an empty local store, or a Redis store of 3 shards on 2 hosts."""
+    if request.param == "local":
+        trending = LocalTrendingStore()
+    else:
+        request.getfixturevalue("fake_redis")
+        trending = scoring.RedisTrendingStore(hosts=["redis-a:6379", "redis-b:6379"], shard_count=3)
+    monkeypatch.setattr(scoring, "store", trending)
+    return trending
@@ -1,7 +1,179 @@
+import math
 import os
 
 DECAY_RATE = 0.001
+
+def _parse_profiles(spec: str) -> dict:
+    profiles = {}
+    for entry in filter(None, spec.split(',')):
+        name, _, half_life = entry.partition('=')
+        profiles[name.strip()] = math.log(2) / float(half_life)
+    return profiles
+
+# Named decay profiles fed by the same event stream, as "name=half_life_seconds,...",
+# e.g. "1h=3600,24h=86400,7d=604800". Each profile gets its own "<key>:<name>" set;
+# when unset there is a single set at TRENDING_KEY decaying at DECAY_RATE.
+DECAY_PROFILES = _parse_profiles(os.getenv('DECAY_PROFILES', ''))
+DEFAULT_WINDOW = os.getenv('DEFAULT_WINDOW') or next(iter(DECAY_PROFILES), None)
+# "redis", "local" for an in-process store (single worker, no network hop), or the
+# approximate heavy-hitter stores "sketch" (in-process) and "redis_sketch"
+STORE_BACKEND = os.getenv('STORE_BACKEND', 'redis')
+IN_PROCESS_STORE = STORE_BACKEND in ("local", "sketch")
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = 6379
 REDIS_DB = 0
 TRENDING_KEY = "articles:trending"
+# Events may carry up to MAX_CATEGORIES categories, each also fed into its own
+# "<TRENDING_KEY>:category:<name>" sets; /trending?category=a,b reads a ZUNIONSTORE
+# of those sets that is rebuilt at most once per CATEGORY_UNION_TTL_MS.
+MAX_CATEGORIES = int(os.getenv('MAX_CATEGORIES', '8'))
+CATEGORY_UNION_TTL_MS = int(os.getenv('CATEGORY_UNION_TTL_MS', '2000'))
+# Split each trending set into TRENDING_SHARDS sorted sets by crc32(item_id), placed
+# round-robin over REDIS_SHARD_HOSTS ("host[:port],..."; default: REDIS_HOST only)
+TRENDING_SHARDS = int(os.getenv('TRENDING_SHARDS', '1'))
+REDIS_SHARD_HOSTS = [host for host in os.getenv('REDIS_SHARD_HOSTS', '').split(',') if host]
+
+# Sketch stores keep a Count-Min Sketch of decayed counts, overestimating an item
+# by at most SKETCH_EPSILON * (total decayed weight) with probability 1 - SKETCH_DELTA,
+# and only the SKETCH_TOP_K heaviest items as sorted-set members.
+SKETCH_EPSILON = float(os.getenv('SKETCH_EPSILON', '0.001'))
+SKETCH_DELTA = float(os.getenv('SKETCH_DELTA', '0.01'))
+SKETCH_TOP_K = int(os.getenv('SKETCH_TOP_K', '1000'))
+
+# In-process stores (local, sketch): with SNAPSHOT_DIR set, the store is restored
+# from the snapshot and delta log there on startup, journals every write, and is
+# snapshotted again every SNAPSHOT_INTERVAL seconds.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '60'))
+
+# Forward mode: every HISTORY_INTERVAL seconds the jobs copy the top HISTORY_TOP_K
+# of each set to "<set>:history:<time>", keeping HISTORY_BUCKETS copies' worth of
+# time, so /trending?at= can answer for past times (0 buckets = no history).
+HISTORY_INTERVAL = int(os.getenv('HISTORY_INTERVAL', '300'))
+HISTORY_BUCKETS = int(os.getenv('HISTORY_BUCKETS', '288'))
+HISTORY_TOP_K = int(os.getenv('HISTORY_TOP_K', '100'))
+
+# /trending?mode=velocity: with VELOCITY_WINDOW minutes > 0, every event is also
+# counted in its item's ring of 2 * VELOCITY_WINDOW minute buckets, and items are
+# ranked by the change in events per minute between the last VELOCITY_WINDOW
+# minutes and the VELOCITY_WINDOW before. Reads re-score VELOCITY_CANDIDATES
+# times as many items as they return; the jobs re-score and expire the rest
+# every VELOCITY_REFRESH_INTERVAL seconds.
+VELOCITY_WINDOW = int(os.getenv('VELOCITY_WINDOW', '0'))
+VELOCITY_CANDIDATES = int(os.getenv('VELOCITY_CANDIDATES', '4'))
+VELOCITY_REFRESH_INTERVAL = int(os.getenv('VELOCITY_REFRESH_INTERVAL', '60'))
+
+# "snapshot" freezes each item's score at insertion time (ZADD), "forward"
+# accumulates landmark-relative scores (ZINCRBY) and decays them on read.
+SCORING_MODE = os.getenv('SCORING_MODE', 'snapshot')
+# Rebase the forward-decay landmark once DECAY_RATE * age reaches this exponent,
+# well before exp() leaves the float64 range (~709).
+LANDMARK_REBASE_EXPONENT = float(os.getenv('LANDMARK_REBASE_EXPONENT', '300'))
+REBASE_CHECK_INTERVAL = int(os.getenv('REBASE_CHECK_INTERVAL', '60'))
+# Events stamped more than MAX_EVENT_SKEW seconds ahead of the server clock are
+# rejected: a future event_time is boosted by exp(rate * skew) and would rank for good.
+MAX_EVENT_SKEW = int(os.getenv('MAX_EVENT_SKEW', '300'))
+# Events whose |weight| exceeds MAX_EVENT_WEIGHT are rejected; repeated huge weights
+# would otherwise add up to inf in a forward set.
+MAX_EVENT_WEIGHT = float(os.getenv('MAX_EVENT_WEIGHT', '1000000'))
+# Trim the sorted set to its top MAX_TRENDING_SIZE members on every write (0 = never)
+MAX_TRENDING_SIZE = int(os.getenv('MAX_TRENDING_SIZE', '0'))
+# Background compaction (jobs.py): keep the top COMPACT_MAX_SIZE members per shard
+# and drop members whose present score is below COMPACT_SCORE_FLOOR (0 = skip
+# either), removing at most COMPACT_CHUNK_SIZE members per Redis call.
+COMPACT_MAX_SIZE = int(os.getenv('COMPACT_MAX_SIZE', '0'))
+COMPACT_SCORE_FLOOR = float(os.getenv('COMPACT_SCORE_FLOOR', '0'))
+COMPACT_CHUNK_SIZE = int(os.getenv('COMPACT_CHUNK_SIZE', '1000'))
+COMPACT_INTERVAL = int(os.getenv('COMPACT_INTERVAL', '300'))
+
+# Events per Redis pipeline in batch ingest, and the most a single /add_events call may carry
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '500'))
+MAX_BATCH_EVENTS = int(os.getenv('MAX_BATCH_EVENTS', '10000'))
+
+# Streaming ingest (ingest.py): write a batch once it holds INGEST_BATCH_SIZE events
+# or its first event has waited INGEST_BATCH_WAIT_MS; at most INGEST_QUEUE_SIZE
+# socket lines are buffered before producers block.
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '1000'))
+INGEST_BATCH_WAIT_MS = int(os.getenv('INGEST_BATCH_WAIT_MS', '200'))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+INGEST_POLL_INTERVAL = float(os.getenv('INGEST_POLL_INTERVAL', '0.2'))
+
+# Retry deduplication: with DEDUP_WINDOW seconds > 0, events carrying an event_id
+# are checked against Bloom filters of the IDs accepted in the current and the
+# previous window (one per wall-clock window, local bits for in-process stores,
+# Redis bitmaps otherwise). Each is sized for DEDUP_CAPACITY IDs per window at an
+# overall false-positive rate of DEDUP_ERROR_RATE; a false positive drops a new event.
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', '0'))
+DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', '1000000'))
+DEDUP_ERROR_RATE = float(os.getenv('DEDUP_ERROR_RATE', '0.001'))
+
+# Admission control (admission.py) for the routes in ADMISSION_ROUTES. Each client
+# (its X-API-Key header if it is one of API_KEYS, else its address; any other
+# header value could be made up per request) gets a token bucket refilled at
+# RATE_LIMIT_PER_SECOND requests per second and holding up to RATE_LIMIT_BURST
+# (0 per second = no limit); requests finding it empty get a 429. Buckets are
+# per process, for the RATE_LIMIT_MAX_CLIENTS most recent clients, unless
+# RATE_LIMIT_BACKEND is "redis", which shares them across workers and hosts.
+# MAX_IN_FLIGHT caps the admitted requests a process serves at once (0 = no cap);
+# the rest wait up to SHED_WAIT_MS for a slot and are then shed with a 503.
+ADMISSION_ROUTES = [route for route in os.getenv('ADMISSION_ROUTES', '/add_event,/add_events').split(',') if route]
+API_KEYS = frozenset(key.strip() for key in os.getenv('API_KEYS', '').split(',') if key.strip())
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', '0'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '100'))
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'local')
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv('RATE_LIMIT_MAX_CLIENTS', '100000'))
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '0'))
+SHED_WAIT_MS = int(os.getenv('SHED_WAIT_MS', '0'))
+
+# Write-behind coalescing for add_event: 0 disables it, otherwise pending weights
+# are summed per item for up to COALESCE_WINDOW_MS or COALESCE_MAX_ITEMS items.
+COALESCE_WINDOW_MS = int(os.getenv('COALESCE_WINDOW_MS', '0'))
+COALESCE_MAX_ITEMS = int(os.getenv('COALESCE_MAX_ITEMS', '10000'))
+COALESCE_QUEUE_SIZE = int(os.getenv('COALESCE_QUEUE_SIZE', '8'))
+
+# /trending result cache: 0 disables it. One top-TRENDING_CACHE_MAX_K fetch per
+# key serves every smaller count until it is TRENDING_CACHE_TTL_MS old. Keys
+# (window and category combination) beyond TRENDING_CACHE_MAX_KEYS are evicted,
+# least recently refreshed first.
+TRENDING_CACHE_TTL_MS = int(os.getenv('TRENDING_CACHE_TTL_MS', '0'))
+TRENDING_CACHE_MAX_K = int(os.getenv('TRENDING_CACHE_MAX_K', '100'))
+TRENDING_CACHE_MAX_KEYS = int(os.getenv('TRENDING_CACHE_MAX_KEYS', '1000'))
+
+# Production server (serve.py): gunicorn with SERVER_WORKER_CLASS "sync",
+# "gthread" (SERVER_THREADS per worker), "gevent" or "asgi" (app_asgi.py on
+# uvicorn workers). SERVER_WORKERS 0 picks a count from the CPUs; in-process
+# stores always run one worker. Every worker opens SERVER_WARM_CONNECTIONS Redis
+# connections per host before it takes traffic.
+SERVER_BIND = os.getenv('SERVER_BIND', '0.0.0.0:8000')
+SERVER_WORKER_CLASS = os.getenv('SERVER_WORKER_CLASS', 'gthread')
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '0'))
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '8'))
+SERVER_TIMEOUT = int(os.getenv('SERVER_TIMEOUT', '30'))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', '30'))
+SERVER_KEEPALIVE = int(os.getenv('SERVER_KEEPALIVE', '5'))
+# Recycle a worker after about this many requests (0 = never), bounding slow leaks
+SERVER_MAX_REQUESTS = int(os.getenv('SERVER_MAX_REQUESTS', '0'))
+SERVER_WARM_CONNECTIONS = int(os.getenv('SERVER_WARM_CONNECTIONS', '4'))
+SERVER_PIDFILE = os.getenv('SERVER_PIDFILE', '/tmp/decay_service.pid')
+
+# Client-side caching of /trending reads (Redis 6+): with CLIENT_CACHE_ROWS > 0,
+# each process keeps the top CLIENT_CACHE_ROWS rows of up to CLIENT_CACHE_MAX_KEYS
+# shards it reads. A RESP3 connection per host tracks every key under TRENDING_KEY
+# (CLIENT TRACKING BCAST) and drops a shard's rows as soon as Redis reports a
+# write to it or to its landmark; rows never outlive CLIENT_CACHE_MAX_AGE_MS.
+CLIENT_CACHE_ROWS = int(os.getenv('CLIENT_CACHE_ROWS', '0'))
+CLIENT_CACHE_MAX_KEYS = int(os.getenv('CLIENT_CACHE_MAX_KEYS', '10000'))
+CLIENT_CACHE_MAX_AGE_MS = int(os.getenv('CLIENT_CACHE_MAX_AGE_MS', '60000'))
+
+# Connection pool size for the asyncio Redis client used by app_asgi.py
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '100'))
+
+# /metrics: with METRICS_DIR set, each worker writes a snapshot there every
+# METRICS_FLUSH_INTERVAL seconds and any worker can serve the sum of all of them.
+# Unset, /metrics only reports the worker that answers the scrape.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Log records of every module go to stderr at LOG_LEVEL and above
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import logging
+import math
+import threading
+import time
+import redis
+from scoring import _parse_host
+import metrics
+from constants import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_SHARD_HOSTS, IN_PROCESS_STORE, TRENDING_KEY,
+    DEDUP_WINDOW, DEDUP_CAPACITY, DEDUP_ERROR_RATE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Idempotent retries for events that carry an event_id. IDs are kept in Bloom
+# filters, one per DEDUP_WINDOW of arrival time: an ID is a duplicate if all its
+# bits are set in the current or the previous window's filter, so every ID is
+# remembered for between one and two windows. That costs ~1.44 * log2(1 / p)
+# bits per ID whatever its length, instead of storing the IDs themselves.
+#
+# Checking and remembering are separate steps around the store write, so a
+# write that fails leaves its IDs unmarked and the client's retry is accepted.
+# With COALESCE_WINDOW_MS, /add_event only buffers the event and the flush that
+# writes it may fail after the response, so buffered IDs are never marked and
+# their retries are counted again. Two copies of one event in flight at the
+# same moment can both get through.
+
+# KEYS: the live window filters; ARGV: hashes per ID, then every ID's bit offsets.
+# Returns 1 per ID whose bits are all set in one of the filters.
+DEDUP_CHECK_SCRIPT = """
+local k = tonumber(ARGV[1])
+local seen = {}
+for base = 2, #ARGV, k do
+    local found = 0
+    for _, key in ipairs(KEYS) do
+        found = 1
+        for i = base, base + k - 1 do
+            if redis.call('GETBIT', key, ARGV[i]) == 0 then
+                found = 0
+                break
+            end
+        end
+        if found == 1 then break end
+    end
+    seen[#seen + 1] = found
+end
+return seen
+"""
+
+# KEYS[1]: the current window's filter; ARGV: its TTL in seconds, then bit offsets to set
+DEDUP_MARK_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+"""
+
+def bloom_size(capacity: int, error_rate: float) -> tuple:
+    """(bits, hashes) of each window's filter for an overall `error_rate` over the two live windows."""
+    per_filter = 1.0 - math.sqrt(1.0 - error_rate)
+    bits = max(8, math.ceil(-capacity * math.log(per_filter) / math.log(2) ** 2))
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+def bloom_offsets(event_id: str, bits: int, hashes: int) -> list:
+    """Bit offsets of `event_id`, by double hashing two 64-bit halves of a blake2b digest."""
+    digest = hashlib.blake2b(event_id.encode(), digest_size=16).digest()
+    h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+class BloomFilter:
+    """Rotating window filters as in-process bytearrays, for the local and sketch stores."""
+
+    def __init__(self, window: int = DEDUP_WINDOW, capacity: int = DEDUP_CAPACITY,
+                 error_rate: float = DEDUP_ERROR_RATE):
+        self.window = window
+        self.bits, self.hashes = bloom_size(capacity, error_rate)
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def _live(self, now: int) -> list:
+        current = now // self.window
+        for old in [w for w in self._filters if w < current - 1]:
+            del self._filters[old]
+        return [self._filters[w] for w in (current, current - 1) if w in self._filters]
+
+    def contains(self, offsets: list, now: int) -> list:
+        with self._lock:
+            filters = self._live(now)
+            return [any(all(f[o >> 3] >> (o & 7) & 1 for o in item) for f in filters) for item in offsets]
+
+    def add(self, offsets: list, now: int):
+        with self._lock:
+            self._live(now)
+            current = self._filters.setdefault(now // self.window, bytearray((self.bits + 7) // 8))
+            for item in offsets:
+                for o in item:
+                    current[o >> 3] |= 1 << (o & 7)
+
+class RedisBloomFilter(BloomFilter):
+    """Rotating window filters as Redis bitmaps, shared by every worker and ingest.py.
+
+    They live on the first Redis host under "dedup:<key>:<window>" and expire
+    once they leave the two live windows.
+    """
+
+    def __init__(self, key: str = TRENDING_KEY, hosts=REDIS_SHARD_HOSTS, **kwargs):
+        super().__init__(**kwargs)
+        self.key = key
+        host, port = _parse_host(hosts[0]) if hosts else (REDIS_HOST, REDIS_PORT)
+        self.client = redis.Redis(host=host, port=port, db=REDIS_DB)
+        self._check_script = self.client.register_script(DEDUP_CHECK_SCRIPT)
+        self._mark_script = self.client.register_script(DEDUP_MARK_SCRIPT)
+
+    def _key(self, window: int) -> str:
+        return f"dedup:{self.key}:{window}"
+
+    def contains(self, offsets: list, now: int) -> list:
+        current = now // self.window
+        with metrics.REDIS_LATENCY.time(command="evalsha"):
+            seen = self._check_script(keys=[self._key(current), self._key(current - 1)],
+                                      args=[self.hashes, *(o for item in offsets for o in item)])
+        return [bool(flag) for flag in seen]
+
+    def add(self, offsets: list, now: int):
+        with metrics.REDIS_LATENCY.time(command="evalsha"):
+            self._mark_script(keys=[self._key(now // self.window)],
+                              args=[2 * self.window, *(o for item in offsets for o in item)])
+
+def make_filter():
+    if DEDUP_WINDOW <= 0:
+        return None
+    return BloomFilter() if IN_PROCESS_STORE else RedisBloomFilter()
+
+bloom = make_filter()
+
+def split_duplicates(events):
+    """(events not seen before, number dropped) from parsed events whose fifth field is the event_id.
+
+    Events without an event_id always pass, as does everything when dedup is off.
+    """
+    if bloom is None:
+        return events, 0
+    ids = {}
+    for index, event in enumerate(events):
+        if event[4] is not None:
+            ids.setdefault(event[4], []).append(index)
+    if not ids:
+        return events, 0
+    seen = bloom.contains([bloom_offsets(event_id, bloom.bits, bloom.hashes) for event_id in ids],
+                          int(time.time()))
+    # Only the first copy of an unseen ID within the batch is kept
+    dropped = {i for indexes, found in zip(ids.values(), seen) for i in (indexes if found else indexes[1:])}
+    if dropped:
+        metrics.DUPLICATE_EVENTS.inc(len(dropped))
+    return [event for index, event in enumerate(events) if index not in dropped], len(dropped)
+
+def remember(events):
+    """Mark the event_ids of written events as seen.
+
+    Errors are only logged: the events are already written, and failing the
+    request here would make the client retry them.
+    """
+    if bloom is None:
+        return
+    ids = {event[4] for event in events if event[4] is not None}
+    if not ids:
+        return
+    try:
+        bloom.add([bloom_offsets(event_id, bloom.bits, bloom.hashes) for event_id in ids], int(time.time()))
+    except Exception as e:
+        logger.warning("Remembering %d event ids failed: %s", len(ids), e)
+
+# Redis filters block on the network, so the ASGI app runs them on a worker thread
+async def split_duplicates_async(events):
+    if isinstance(bloom, RedisBloomFilter):
+        return await asyncio.to_thread(split_duplicates, events)
+    return split_duplicates(events)
+
+async def remember_async(events):
+    if isinstance(bloom, RedisBloomFilter):
+        return await asyncio.to_thread(remember, events)
+    return remember(events)
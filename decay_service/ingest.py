@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import metrics
+from payloads import parse_event
+from scoring import add_events
+from dedup import split_duplicates, remember
+from constants import (
+    TRENDING_KEY, IN_PROCESS_STORE, INGEST_BATCH_SIZE, INGEST_BATCH_WAIT_MS, INGEST_QUEUE_SIZE, INGEST_POLL_INTERVAL,
+    LOG_LEVEL, LOG_FORMAT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bulk ingest without the HTTP layer: tails an append-only NDJSON file of
+# /add_event bodies, or accepts NDJSON over a Unix domain socket, and writes the
+# events through pipelined add_events calls.
+#
+#   python ingest.py file /var/log/events.ndjson
+#   python ingest.py socket /run/decay/ingest.sock
+#
+# Each stage is a generator pulled by the next one, so a slow or failing store
+# stops the reads upstream: a tailed file simply waits, and socket producers
+# block once INGEST_QUEUE_SIZE lines are buffered. Sources yield None when idle
+# so partial batches are still written after INGEST_BATCH_WAIT_MS.
+
+def load_checkpoint(path: str):
+    """(inode, byte offset) saved by save_checkpoint, or (None, 0)."""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint["inode"], checkpoint["offset"]
+    except (OSError, ValueError, KeyError):
+        return None, 0
+
+def save_checkpoint(path: str, inode: int, offset: int):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"inode": inode, "offset": offset}, f)
+    os.replace(tmp, path)
+
+def tail_file(path: str, inode: int = None, offset: int = 0, follow: bool = True,
+              poll_interval: float = INGEST_POLL_INTERVAL):
+    """Yield (line, (inode, end offset)) for every complete line from `offset` on.
+
+    At the end of the file yields None and polls for more. A file that was
+    truncated or replaced (rotated) is read again from the start.
+    """
+    f = None
+    while True:
+        if f is None:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                if not follow:
+                    return
+                yield None
+                time.sleep(poll_interval)
+                continue
+            stat = os.fstat(f.fileno())
+            if inode is not None and (stat.st_ino != inode or stat.st_size < offset):
+                offset = 0
+            inode = stat.st_ino
+            f.seek(offset)
+        line = f.readline()
+        if line.endswith(b"\n"):
+            offset += len(line)
+            yield line, (inode, offset)
+            continue
+        # End of file, possibly mid-line: the partial line is read again once complete
+        f.seek(offset)
+        if not follow:
+            f.close()
+            return
+        yield None
+        time.sleep(poll_interval)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.st_ino != inode or stat.st_size < offset:
+            f.close()
+            f, offset = None, 0
+
+def read_socket(path: str, queue_size: int = INGEST_QUEUE_SIZE, poll_interval: float = INGEST_POLL_INTERVAL):
+    """Yield (line, None) for every line sent by any producer connected to a Unix socket at `path`."""
+    lines = queue.Queue(maxsize=queue_size)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def serve(conn):
+        with conn, conn.makefile("rb") as f:
+            for line in f:
+                # Blocks while the queue is full, so the producer blocks in send()
+                lines.put(line)
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, name="ingest-accept", daemon=True).start()
+    while True:
+        try:
+            yield lines.get(timeout=poll_interval), None
+        except queue.Empty:
+            yield None
+
+def parse_lines(items):
+    """(event or None, position) per line; invalid lines are counted and become None."""
+    for item in items:
+        if item is None:
+            yield None
+            continue
+        line, position = item
+        if not line.strip():
+            yield None, position
+            continue
+        try:
+            yield parse_event(line), position
+        except ValueError as e:
+            metrics.INGESTED_EVENTS.inc(result="rejected")
+            logger.warning("Skipping invalid event %r: %s", line[:200], e)
+            yield None, position
+
+def batch_events(items, max_size: int = INGEST_BATCH_SIZE, max_wait_ms: int = INGEST_BATCH_WAIT_MS):
+    """(events, position after the last line) once max_size events are collected or the first waited max_wait_ms."""
+    events, position, deadline, flushed = [], None, None, None
+    for item in items:
+        if item is not None:
+            event, position = item
+            if event is not None:
+                events.append(event)
+                if deadline is None:
+                    deadline = time.monotonic() + max_wait_ms / 1000.0
+        if events and (len(events) >= max_size or time.monotonic() >= deadline):
+            yield events, position
+            events, deadline, flushed = [], None, position
+        elif item is None and not events and position != flushed:
+            # Only invalid lines since the last batch: still move the checkpoint past them
+            yield [], position
+            flushed = position
+    if events or position != flushed:
+        yield events, position
+
+def write_batches(batches, key: str = TRENDING_KEY, checkpoint: str = None, max_backoff: float = 30.0):
+    """Write every batch, retrying until the store accepts it, then checkpoint its position.
+
+    A crash between a write and its checkpoint replays that batch on restart
+    (at-least-once delivery); with DEDUP_WINDOW set, replayed events that
+    carry an event_id are dropped as duplicates.
+    """
+    for events, position in batches:
+        backoff = 0.5
+        duplicates = 0
+        while events:
+            try:
+                fresh, duplicates = split_duplicates(events)
+                add_events(key, fresh)
+                events = fresh
+                break
+            except Exception as e:
+                logger.warning("Writing %d events failed, retrying in %.1fs: %s", len(events), backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+        remember(events)
+        metrics.INGESTED_EVENTS.inc(len(events), result="added")
+        if duplicates:
+            metrics.INGESTED_EVENTS.inc(duplicates, result="duplicate")
+        if checkpoint and position is not None:
+            save_checkpoint(checkpoint, *position)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream NDJSON events into the decay service's store")
+    parser.add_argument("source", choices=["file", "socket"])
+    parser.add_argument("path", help="NDJSON file to tail, or Unix socket path to listen on")
+    parser.add_argument("--checkpoint", help="offset file for the tailed file (default: <path>.offset)")
+    parser.add_argument("--no-follow", action="store_true", help="exit at the end of the file instead of tailing it")
+    parser.add_argument("--key", default=TRENDING_KEY)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--batch-wait-ms", type=int, default=INGEST_BATCH_WAIT_MS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    if IN_PROCESS_STORE:
+        parser.error("in-process stores keep their data inside the API process; ingest.py needs a shared store")
+    metrics.ensure_flusher()
+    checkpoint = None
+    if args.source == "file":
+        checkpoint = args.checkpoint or f"{args.path}.offset"
+        lines = tail_file(args.path, *load_checkpoint(checkpoint), follow=not args.no_follow)
+    else:
+        lines = read_socket(args.path)
+    batches = batch_events(parse_lines(lines), args.batch_size, args.batch_wait_ms)
+    try:
+        write_batches(batches, args.key, checkpoint)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+import metrics
+from scoring import store, maybe_rebase_landmark, compact, trending_keys, record_history, velocity_key
+from constants import (
+    TRENDING_KEY, REBASE_CHECK_INTERVAL, SCORING_MODE, COMPACT_INTERVAL, COMPACT_MAX_SIZE, COMPACT_SCORE_FLOOR,
+    IN_PROCESS_STORE, SNAPSHOT_DIR, SNAPSHOT_INTERVAL, HISTORY_INTERVAL, HISTORY_BUCKETS, VELOCITY_WINDOW,
+    VELOCITY_REFRESH_INTERVAL, LOG_LEVEL, LOG_FORMAT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Both jobs cover the category sets under the key as well
+def run_rebase(key: str = TRENDING_KEY):
+    for target_key in trending_keys(key):
+        landmark = maybe_rebase_landmark(target_key)
+        if landmark is not None:
+            logger.info("Rebased %s to landmark %s", target_key, landmark)
+
+def run_compaction(key: str = TRENDING_KEY):
+    # Redis also keeps evicted_by_score/evicted_by_rank in each <key>:meta hash
+    with metrics.COMPACTION_DURATION.time():
+        for target_key in trending_keys(key):
+            by_score, by_rank = compact(target_key)
+            metrics.COMPACTION_EVICTED.inc(by_score, reason="score")
+            metrics.COMPACTION_EVICTED.inc(by_rank, reason="rank")
+            if by_score or by_rank:
+                logger.info("Compacted %s: %d below floor, %d beyond top %d", target_key, by_score, by_rank,
+                            COMPACT_MAX_SIZE)
+    metrics.COMPACTION_RUNS.inc()
+
+def run_history(key: str = TRENDING_KEY):
+    written = record_history(key)
+    logger.info("Recorded history of %d sets", written)
+
+def run_velocity_refresh(key: str = TRENDING_KEY):
+    now = int(time.time())
+    for target_key in trending_keys(key):
+        dropped = store.refresh_velocity(velocity_key(target_key), now)
+        if dropped:
+            logger.info("Dropped %d idle items from %s", dropped, velocity_key(target_key))
+
+def run_snapshot(directory: str = SNAPSHOT_DIR):
+    import snapshot
+    stats = snapshot.write_snapshot(store, directory)
+    logger.info("Snapshot of %d sets, %d members: %d bytes in %.3fs", stats["sets"], stats["members"],
+                stats["bytes"], stats["seconds"])
+
+def scheduled_jobs() -> list:
+    jobs = []
+    if SCORING_MODE == "forward":
+        jobs.append((run_rebase, REBASE_CHECK_INTERVAL))
+    if SCORING_MODE == "forward" and HISTORY_BUCKETS > 0:
+        jobs.append((run_history, HISTORY_INTERVAL))
+    if COMPACT_MAX_SIZE > 0 or COMPACT_SCORE_FLOOR > 0:
+        jobs.append((run_compaction, COMPACT_INTERVAL))
+    if VELOCITY_WINDOW > 0:
+        jobs.append((run_velocity_refresh, VELOCITY_REFRESH_INTERVAL))
+    if IN_PROCESS_STORE and SNAPSHOT_DIR:
+        jobs.append((run_snapshot, SNAPSHOT_INTERVAL))
+    return jobs
+
+def run_jobs(jobs=None):
+    jobs = scheduled_jobs() if jobs is None else jobs
+    # A separate job process shows up in the /metrics totals through its own snapshot
+    metrics.ensure_flusher()
+    due = [0.0] * len(jobs)
+    while jobs:
+        for i, (job, interval) in enumerate(jobs):
+            if time.monotonic() >= due[i]:
+                try:
+                    job()
+                except Exception:
+                    logger.exception("%s failed", job.__name__)
+                due[i] = time.monotonic() + interval
+        time.sleep(max(0.0, min(due) - time.monotonic()))
+
+def start_in_background():
+    """Run the jobs inside this process, for in-process stores that a separate job process cannot reach."""
+    thread = threading.Thread(target=run_jobs, name="decay-jobs", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    run_jobs()
@@ -0,0 +1,429 @@
+import math
+import sys
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from sortedcontainers import SortedList
+from scoring import (
+    TrendingStore, decayed_score, decayed_scores, category_key, history_key, ring_velocity, rank_velocity, _to_present,
+)
+from constants import (
+    DECAY_RATE, SCORING_MODE, MAX_TRENDING_SIZE, LANDMARK_REBASE_EXPONENT, COMPACT_CHUNK_SIZE, CATEGORY_UNION_TTL_MS,
+    VELOCITY_WINDOW, VELOCITY_CANDIDATES,
+)
+
+class _LocalSet:
+    """One trending set: member -> stored score, plus a rank index of (-score, member)."""
+
+    __slots__ = ("scores", "index", "landmark", "last_updated")
+
+    def __init__(self):
+        self.scores = {}
+        self.index = SortedList()
+        self.landmark = None
+        self.last_updated = None
+
+    def set(self, member: bytes, score: float):
+        old = self.scores.get(member)
+        if old is not None:
+            self.index.remove((-old, member))
+        self.scores[member] = score
+        self.index.add((-score, member))
+
+    def incr(self, member: bytes, amount: float):
+        self.set(member, self.scores.get(member, 0.0) + amount)
+
+    def discard(self, member: bytes):
+        score = self.scores.pop(member, None)
+        if score is not None:
+            self.index.remove((-score, member))
+
+    def trim(self, max_size: int, limit: int = None) -> int:
+        removed = 0
+        while len(self.index) > max_size and (limit is None or removed < limit):
+            _, member = self.index.pop()
+            del self.scores[member]
+            removed += 1
+        return removed
+
+    def evict_below(self, threshold: float, limit: int) -> int:
+        removed = 0
+        while self.index and -self.index[-1][0] < threshold and removed < limit:
+            _, member = self.index.pop()
+            del self.scores[member]
+            removed += 1
+        return removed
+
+    def rescale(self, factor: float):
+        # A positive factor keeps the order, so the index is rebuilt in one pass
+        members = list(self.scores)
+        scaled = (np.fromiter(self.scores.values(), dtype=np.float64, count=len(members)) * factor).tolist()
+        self.scores = dict(zip(members, scaled))
+        self.index = SortedList(zip((-score for score in scaled), members))
+
+class _VelocitySet(_LocalSet):
+    """Items ranked by ring_velocity(), with each item's ring of minute buckets in `rings`."""
+
+    __slots__ = ("rings",)
+
+    def __init__(self):
+        super().__init__()
+        self.rings = {}
+
+    def count(self, member: bytes, minute: int, weight: float, slots: int):
+        ring = self.rings.get(member)
+        if ring is None:
+            ring = self.rings[member] = ([None] * slots, [0.0] * slots)
+        slot = minute % slots
+        if ring[0][slot] != minute:
+            ring[0][slot], ring[1][slot] = minute, 0.0
+        ring[1][slot] += weight
+
+    def rescore(self, member: bytes, now_minute: int):
+        """Current velocity of `member`, or None after dropping it because its buckets are all stale."""
+        velocity, live = ring_velocity(self.rings[member], now_minute, VELOCITY_WINDOW)
+        if not live:
+            self.discard(member)
+            del self.rings[member]
+            return None
+        self.set(member, velocity)
+        return velocity
+
+class LocalTrendingStore(TrendingStore):
+    """In-process trending store: O(log n) updates and O(log n + k) top-k.
+
+    State is per process, so run a single worker. In forward mode the landmark
+    is rebased inline on the write that crosses LANDMARK_REBASE_EXPONENT, so no
+    separate rebase job is needed.
+    """
+
+    def __init__(self, max_size: int = MAX_TRENDING_SIZE):
+        self.max_size = max_size
+        self._sets = {}
+        self._velocity = {}
+        self._union_expires = {}
+        # Reentrant so a warm start can replay journal records while holding it
+        self._lock = threading.RLock()
+        # snapshot.DeltaLog receiving every mutation once restore() has attached it
+        self.journal = None
+        # (snapshot.SnapshotView, keys changed since it) answering plain reads during a warm start
+        self._frozen = None
+
+    def warm_start(self, view, changed, rebuild):
+        """Answer top() from `view` without the lock while rebuild() runs under it on a background thread.
+
+        Sets in `changed` are read under the lock, i.e. once the rebuild is done.
+        """
+        locked = threading.Event()
+
+        def run():
+            with self._lock:
+                locked.set()
+                try:
+                    rebuild()
+                finally:
+                    self._frozen = None
+
+        self._frozen = (view, frozenset(changed))
+        threading.Thread(target=run, name="store-warm-start", daemon=True).start()
+        # Writers must not get the lock before the rebuild does
+        locked.wait()
+
+    def _new_set(self) -> _LocalSet:
+        return _LocalSet()
+
+    def _log(self, *record):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    @staticmethod
+    def record_keys(record) -> list:
+        """Trending sets changed by one journal record."""
+        op, *args = record
+        if op == "add":
+            return [key for key, _ in args[0]]
+        if op == "history":
+            return [history_key(args[0], args[1])]
+        if op == "velocity":
+            # Velocity sets are not in a snapshot's rank arrays
+            return []
+        return [args[0]]
+
+    def replay(self, record):
+        """Re-apply one journal record, e.g. ("add", targets, events, now), when restoring."""
+        op, *args = record
+        if op == "add":
+            self.add_events(*args)
+        elif op == "rebase":
+            key, now, decay_rate = args
+            self.rebase(key, now, 0.0, decay_rate)
+        elif op == "compact":
+            self._compact_chunk(*args)
+        elif op == "delete":
+            self.delete(*args)
+        elif op == "velocity":
+            self.add_velocity(*args)
+        elif op == "history":
+            self.save_history(*args)
+        else:
+            raise ValueError(f"unknown journal record {op!r}")
+
+    def capture(self) -> tuple:
+        """Start a new journal and copy the stored (non-union) sets, atomically with respect to writers.
+
+        Returns the first journal sequence the copy does not include,
+        (key, landmark, last_updated, index rows, sketch or None) per set, and
+        the minute-bucket rings of every velocity set.
+        """
+        with self._lock:
+            seq = self.journal.rotate() if self.journal is not None else 0
+            sets = [(key, zset.landmark, zset.last_updated, list(zset.index),
+                     None if getattr(zset, "sketch", None) is None else zset.sketch.copy())
+                    for key, zset in self._sets.items() if key not in self._union_expires]
+            rings = {key: [(member, list(minutes), list(counts)) for member, (minutes, counts) in vset.rings.items()]
+                     for key, vset in self._velocity.items()}
+            return seq, sets, rings
+
+    def load_velocity(self, key: str, rings, now: int):
+        """Install the (member, minutes, counts) rings of a velocity set read from a snapshot."""
+        vset = _VelocitySet()
+        for member, minutes, counts in rings:
+            vset.rings[member] = (minutes, counts)
+            vset.rescore(member, now // 60)
+        with self._lock:
+            self._velocity[key] = vset
+
+    def load_set(self, key: str, landmark, last_updated, members: list, scores: list, sketch=None):
+        """Install a set read from a snapshot; `members` and `scores` are in rank order."""
+        # Sets saved without a sketch (history copies) stay plain sets in the sketch store too
+        zset = _LocalSet() if sketch is None else self._new_set()
+        zset.scores = dict(zip(members, scores))
+        # Already sorted, so building the index is a single linear pass
+        zset.index = SortedList(zip((-score for score in scores), members))
+        zset.landmark = landmark
+        zset.last_updated = last_updated
+        if sketch is not None:
+            zset.sketch = sketch
+        with self._lock:
+            self._sets[key] = zset
+
+    def add_events(self, targets, events, now: int, velocity=()):
+        forward = SCORING_MODE == "forward"
+        members = [item_id.encode() for item_id, _, _ in events]
+        # Building arrays costs far more than one exp(), so a single event is scored without NumPy
+        single = len(events) == 1
+        if not single:
+            times = np.fromiter((event_time for _, event_time, _ in events), dtype=np.int64, count=len(events))
+            weights = np.fromiter((weight for _, _, weight in events), dtype=np.float64, count=len(events))
+        with self._lock:
+            # Every score is computed before anything is written, so a refused batch changes nothing
+            writes = []
+            for key, decay_rate in targets:
+                zset = self._sets.get(key)
+                if zset is None:
+                    zset = self._new_set()
+                if forward and zset.landmark is not None and decay_rate * (now - zset.landmark) >= LANDMARK_REBASE_EXPONENT:
+                    self._rebase(zset, now, decay_rate)
+                # Forward scores are decayed scores against the landmark
+                reference = now if not forward or zset.landmark is None else zset.landmark
+                if single:
+                    scores = [decayed_score(events[0][2], events[0][1], reference, decay_rate)]
+                else:
+                    scores = decayed_scores(weights, times, reference, decay_rate).tolist()
+                if not self._finite_totals(zset, members, scores, forward):
+                    raise ValueError("event score is not finite")
+                writes.append((key, zset, scores))
+            for key, zset, scores in writes:
+                self._sets.setdefault(key, zset)
+                if forward and zset.landmark is None:
+                    zset.landmark = now
+                update = zset.incr if forward else zset.set
+                for member, score in zip(members, scores):
+                    update(member, score)
+                if self.max_size > 0:
+                    zset.trim(self.max_size)
+                zset.last_updated = now
+            self._log("add", targets, events, now)
+            if velocity:
+                self.add_velocity(velocity, events, now)
+
+    @staticmethod
+    def _finite_totals(zset: _LocalSet, members: list, scores: list, forward: bool) -> bool:
+        """False if writing `scores` would leave any member at inf or nan, which would stay in the set for good."""
+        if not forward:
+            return all(math.isfinite(score) for score in scores)
+        totals = {}
+        for member, score in zip(members, scores):
+            totals[member] = totals.get(member, zset.scores.get(member, 0.0)) + score
+        return all(math.isfinite(total) for total in totals.values())
+
+    def top(self, key: str, count: int, now: int, decay_rate: float = DECAY_RATE, offset: int = 0,
+            cursor=None) -> list:
+        frozen = self._frozen
+        if frozen is not None and cursor is None and key not in frozen[1]:
+            found = frozen[0].top(key, offset, count)
+            if found is not None:
+                return _to_present(*found, now, decay_rate)
+        with self._lock:
+            zset = self._sets.get(key)
+            if zset is None:
+                return []
+            start = offset if cursor is None else offset + self._after(zset, cursor, decay_rate)
+            rows = [(member, -score) for score, member in zset.index.islice(start, start + count)]
+            landmark = zset.landmark
+        return _to_present(rows, landmark, now, decay_rate)
+
+    @staticmethod
+    def _after(zset: _LocalSet, cursor, decay_rate: float) -> int:
+        """Index of the first row after a (present score, time, member) cursor."""
+        score, at, member = cursor
+        stored = score if zset.landmark is None else score / decayed_score(1.0, zset.landmark, at, decay_rate)
+        member = member.encode()
+        current = zset.scores.get(member)
+        tolerance = 1e-9 * abs(stored)
+        if current is not None and abs(current - stored) <= tolerance:
+            return zset.index.index((-current, member)) + 1
+        # Tied members share one stored score, which the converted cursor score only approximates
+        first = zset.index.bisect_left((-(stored + tolerance),))
+        if first < len(zset.index) and abs(-zset.index[first][0] - stored) <= tolerance:
+            stored = -zset.index[first][0]
+        return zset.index.bisect_right((-stored, member))
+
+    def top_union(self, key: str, sources, count: int, now: int, decay_rate: float = DECAY_RATE,
+                  ttl_ms: int = CATEGORY_UNION_TTL_MS, offset: int = 0, cursor=None) -> list:
+        with self._lock:
+            clock = time.monotonic()
+            if self._union_expires.get(key, 0.0) <= clock:
+                # Category combinations come from the request, so expired unions are dropped rather than kept for good
+                for expired in [union_key for union_key, expires in self._union_expires.items() if expires <= clock]:
+                    del self._sets[expired]
+                    del self._union_expires[expired]
+                totals = defaultdict(float)
+                for source in sources:
+                    zset = self._sets.get(source)
+                    if zset is None:
+                        continue
+                    scale = 1.0 if zset.landmark is None else decayed_score(1.0, zset.landmark, now, decay_rate)
+                    for member, score in zset.scores.items():
+                        totals[member] += score * scale
+                union = _LocalSet()
+                union.scores = dict(totals)
+                union.index = SortedList((-score, member) for member, score in totals.items())
+                union.landmark = now if SCORING_MODE == "forward" else None
+                self._sets[key] = union
+                self._union_expires[key] = clock + ttl_ms / 1000.0
+            # Read under the lock too, so another request's sweep cannot drop the union first
+            return self.top(key, count, now, decay_rate, offset, cursor)
+
+    def categories(self, key: str) -> set:
+        prefix = category_key(key, "")
+        with self._lock:
+            return {name[len(prefix):].split(":")[0] for name in self._sets if name.startswith(prefix)}
+
+    def memory(self, key: str):
+        # ~64 bytes of dict and SortedList overhead per member on top of the member itself
+        with self._lock:
+            zset = self._sets.get(key)
+            return 0 if zset is None else sum(sys.getsizeof(member) + 64 for member in zset.scores)
+
+    def history(self, key: str) -> list:
+        prefix = history_key(key, "")
+        with self._lock:
+            return sorted(int(name[len(prefix):]) for name in self._sets if name.startswith(prefix))
+
+    def save_history(self, key: str, taken: int, rows, decay_rate: float = DECAY_RATE):
+        # A plain set in every store: copies are only read, so the sketch store keeps no sketch for them
+        copy = _LocalSet()
+        for member, score in rows:
+            copy.set(member, score)
+        # Scores are as of `taken`, so that is the copy's landmark and reads rescale from there
+        copy.landmark = taken if SCORING_MODE == "forward" else None
+        copy.last_updated = taken
+        with self._lock:
+            self._sets[history_key(key, taken)] = copy
+            self._log("history", key, taken, rows, decay_rate)
+
+    def drop_history(self, key: str, taken: int):
+        self.delete(history_key(key, taken))
+
+    def delete(self, key: str):
+        with self._lock:
+            if self._sets.pop(key, None) is not None:
+                self._union_expires.pop(key, None)
+                self._log("delete", key)
+
+    def add_velocity(self, keys, events, now: int):
+        now_minute, slots = now // 60, 2 * VELOCITY_WINDOW
+        with self._lock:
+            for key in keys:
+                vset = self._velocity.get(key)
+                if vset is None:
+                    vset = self._velocity[key] = _VelocitySet()
+                for item_id, event_time, weight in events:
+                    minute = event_time // 60
+                    if minute > now_minute - slots:
+                        member = item_id.encode()
+                        vset.count(member, minute, weight, slots)
+                        vset.rescore(member, now_minute)
+            self._log("velocity", keys, events, now)
+
+    def top_velocity(self, key: str, count: int, now: int, offset: int = 0) -> list:
+        with self._lock:
+            vset = self._velocity.get(key)
+            if vset is None:
+                return []
+            candidates = [member for _, member in vset.index.islice(0, (offset + count) * VELOCITY_CANDIDATES)]
+            rows = [(member, vset.rescore(member, now // 60)) for member in candidates]
+        return rank_velocity([row for row in rows if row[1] is not None], offset, count)
+
+    def refresh_velocity(self, key: str, now: int) -> int:
+        with self._lock:
+            vset = self._velocity.get(key)
+            if vset is None:
+                return 0
+            return sum(vset.rescore(member, now // 60) is None for member in list(vset.rings))
+
+    def rebase(self, key: str, now: int, min_exponent: float = 0.0, decay_rate: float = DECAY_RATE):
+        with self._lock:
+            zset = self._sets.get(key)
+            if zset is None or zset.landmark is None or decay_rate * (now - zset.landmark) < min_exponent:
+                return None
+            self._log("rebase", key, now, decay_rate)
+            return self._rebase(zset, now, decay_rate)
+
+    def compact(self, key: str, now: int, max_size: int, floor: float, decay_rate: float = DECAY_RATE,
+                chunk_size: int = COMPACT_CHUNK_SIZE):
+        by_score = by_rank = 0
+        while True:
+            # Release the lock between chunks so writers are not starved
+            removed_score, removed_rank = self._compact_chunk(key, now, max_size, floor, decay_rate, chunk_size)
+            by_score += removed_score
+            by_rank += removed_rank
+            if removed_score < chunk_size and removed_rank < chunk_size:
+                break
+        return by_score, by_rank
+
+    def _compact_chunk(self, key: str, now: int, max_size: int, floor: float, decay_rate: float,
+                       chunk_size: int) -> tuple:
+        with self._lock:
+            zset = self._sets.get(key)
+            if zset is None:
+                return 0, 0
+            removed_score = zset.evict_below(self._stored_floor(zset, floor, now, decay_rate), chunk_size) \
+                if floor > 0 else 0
+            removed_rank = zset.trim(max_size, chunk_size) if max_size > 0 else 0
+            if removed_score or removed_rank:
+                self._log("compact", key, now, max_size, floor, decay_rate, chunk_size)
+            return removed_score, removed_rank
+
+    @staticmethod
+    def _stored_floor(zset: _LocalSet, floor: float, now: int, decay_rate: float) -> float:
+        if zset.landmark is None:
+            return floor
+        return floor / decayed_score(1.0, zset.landmark, now, decay_rate)
+
+    def _rebase(self, zset: _LocalSet, now: int, decay_rate: float) -> int:
+        zset.rescale(decayed_score(1.0, zset.landmark, now, decay_rate))
+        zset.landmark = now
+        return now
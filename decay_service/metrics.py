@@ -0,0 +1,294 @@
+import bisect
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from constants import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Per-process metrics rendered in the Prometheus text format.
+#
+# Updates are plain dict/list increments with no locking: under the GIL a
+# concurrent update can very rarely be lost, which is an acceptable trade for
+# keeping the hot path to a few hundred nanoseconds. When METRICS_DIR is set,
+# every worker snapshots its values to METRICS_DIR/metrics-<pid>-<start>.json
+# every METRICS_FLUSH_INTERVAL seconds and /metrics sums all snapshots, so any
+# worker can answer for the whole server. A snapshot that has not been rewritten
+# for STALE_SECONDS belongs to an exited worker: its counters and histograms are
+# folded into one archive file, so totals never go backwards and the directory
+# stays bounded, and its gauges are dropped.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+BATCH_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# A live worker rewrites its snapshot every METRICS_FLUSH_INTERVAL seconds
+STALE_SECONDS = max(60, 10 * METRICS_FLUSH_INTERVAL)
+ARCHIVE_FILE = "archive.json"
+
+_registry = []
+_hooks = []
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels):
+        """Mirror a total that is maintained elsewhere (e.g. in a collect hook)."""
+        self._values[tuple(labels[name] for name in self.labelnames)] = float(value)
+
+    def snapshot(self) -> dict:
+        return {"type": self.kind, "help": self.help, "labelnames": self.labelnames,
+                "samples": [[list(key), value] for key, value in self._values.items()]}
+
+class Gauge(Counter):
+    """A current value; across workers the largest one is reported."""
+
+    kind = "gauge"
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        return {"type": self.kind, "help": self.help, "labelnames": self.labelnames, "buckets": self.buckets,
+                "samples": [[list(key), list(series)] for key, series in self._values.items()]}
+
+def on_collect(hook):
+    """Run hook() before every snapshot, e.g. to copy stats kept by other modules into counters."""
+    _hooks.append(hook)
+    return hook
+
+def collect() -> dict:
+    for hook in _hooks:
+        hook()
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+# Named by pid and start time, so a worker that reuses a dead worker's pid never overwrites its totals
+_snapshot_file = None
+
+def _snapshot_path() -> str:
+    global _snapshot_file
+    if _snapshot_file is None or _snapshot_file[0] != os.getpid():
+        _snapshot_file = (os.getpid(), os.path.join(METRICS_DIR, f"metrics-{os.getpid()}-{time.time_ns()}.json"))
+    return _snapshot_file[1]
+
+def _write_json(path: str, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _read_json(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot():
+    _write_json(_snapshot_path(), collect())
+
+def _merge(total: dict, snapshot: dict, gauges: bool = True):
+    for name, metric in snapshot.items():
+        if metric["type"] == "gauge" and not gauges:
+            continue
+        merged = total.setdefault(name, dict(metric, samples={}))
+        for labels, value in metric["samples"]:
+            key = tuple(labels)
+            if key not in merged["samples"]:
+                merged["samples"][key] = value
+            elif metric["type"] == "gauge":
+                merged["samples"][key] = max(merged["samples"][key], value)
+            elif isinstance(value, list):
+                merged["samples"][key] = [a + b for a, b in zip(merged["samples"][key], value)]
+            else:
+                merged["samples"][key] += value
+
+def _fold_exited():
+    """Fold the snapshots of exited workers into the archive and delete them."""
+    cutoff = time.time() - STALE_SECONDS
+    stale = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                stale.append(path)
+        except OSError:
+            continue
+    if not stale:
+        return
+    # Workers scrape concurrently; the lock keeps a snapshot from being folded twice
+    with open(os.path.join(METRICS_DIR, "archive.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(METRICS_DIR, ARCHIVE_FILE)
+        archive = _read_json(archive_path) or {"metrics": {}, "folded": []}
+        # Names folded by a scrape that died before deleting them; names of deleted files are forgotten
+        folded = {name for name in archive["folded"] if os.path.exists(os.path.join(METRICS_DIR, name))}
+        total = {}
+        _merge(total, archive["metrics"])
+        for path in stale:
+            name = os.path.basename(path)
+            snapshot = None if name in folded else _read_json(path)
+            if snapshot is not None:
+                _merge(total, snapshot, gauges=False)
+                folded.add(name)
+        metrics = {name: dict(metric, samples=[[list(key), value] for key, value in metric["samples"].items()])
+                   for name, metric in total.items()}
+        _write_json(archive_path, {"metrics": metrics, "folded": sorted(folded)})
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def aggregate() -> dict:
+    """This process's live metrics plus, with METRICS_DIR, every other worker's latest snapshot and the archive."""
+    total = {}
+    _merge(total, collect())
+    if METRICS_DIR:
+        _fold_exited()
+        own = _snapshot_path()
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+            if path != own:
+                snapshot = _read_json(path)
+                if snapshot is not None:
+                    _merge(total, snapshot)
+        archive = _read_json(os.path.join(METRICS_DIR, ARCHIVE_FILE))
+        if archive is not None:
+            _merge(total, archive["metrics"])
+    return total
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def render(metrics: dict) -> str:
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labelnames"]
+        for labels, value in sorted(metric["samples"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(names, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{_format_labels(names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(names, labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+_flusher_pid = None
+
+def ensure_flusher():
+    """Start this worker's snapshot thread (once per pid, so it survives a preforking server)."""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    def flush_forever():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                write_snapshot()
+            except OSError:
+                pass
+
+    threading.Thread(target=flush_forever, name="metrics-flusher", daemon=True).start()
+
+REQUEST_LATENCY = Histogram("decay_http_request_duration_seconds", "HTTP request latency by route",
+                            LATENCY_BUCKETS, ("route", "method"))
+REQUEST_ERRORS = Counter("decay_http_request_errors_total", "HTTP responses with a 4xx/5xx status",
+                         ("route", "status"))
+PAYLOAD_BYTES = Histogram("decay_http_request_payload_bytes", "Request body size by route",
+                          SIZE_BUCKETS, ("route",))
+BATCH_SIZE = Histogram("decay_batch_events", "Events per /add_events request", BATCH_BUCKETS)
+REDIS_LATENCY = Histogram("decay_redis_command_duration_seconds",
+                          "Redis round-trip latency by command or pipeline", LATENCY_BUCKETS, ("command",))
+COALESCED_EVENTS = Counter("decay_coalesce_events_total", "Events accepted by the write-behind buffer")
+COALESCED_WRITES = Counter("decay_coalesce_writes_total", "Item writes flushed by the write-behind buffer")
+CLIENT_CACHE_LOOKUPS = Counter("decay_client_cache_lookups_total",
+                               "Shard reads answered by the Redis-tracked client-side cache", ("result",))
+CACHE_LOOKUPS = Counter("decay_trending_cache_lookups_total", "/trending cache lookups", ("result",))
+STORE_MEMORY = Gauge("decay_store_memory_bytes", "Memory held by each trending set, where the store reports it",
+                     ("key",))
+DUPLICATE_EVENTS = Counter("decay_duplicate_events_total", "Events dropped as retries of an event_id already seen")
+ADMISSION_REJECTED = Counter("decay_admission_rejected_total", "Requests refused by admission control",
+                            ("reason",))
+INGESTED_EVENTS = Counter("decay_ingest_events_total", "Events read by ingest.py", ("result",))
+COMPACTION_EVICTED = Counter("decay_compaction_evicted_total",
+                             "Members evicted by compaction, below the score floor or beyond the size cap",
+                             ("reason",))
+COMPACTION_RUNS = Counter("decay_compaction_runs_total", "Compaction job runs")
+COMPACTION_DURATION = Histogram("decay_compaction_duration_seconds", "Compaction job run time", JOB_BUCKETS)
+
+class MetricsMiddleware:
+    """Falcon middleware timing every request; works for both falcon.App and falcon.asgi.App."""
+
+    def process_request(self, req, resp):
+        ensure_flusher()
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, "metrics_start", None)
+        if start is None:
+            return
+        route = req.uri_template or "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - start, route=route, method=req.method)
+        if req.content_length:
+            PAYLOAD_BYTES.observe(req.content_length, route=route)
+        status = resp.status_code if hasattr(resp, "status_code") else int(str(resp.status).split()[0])
+        if status >= 400:
+            REQUEST_ERRORS.inc(route=route, status=str(status))
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
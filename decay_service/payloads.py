@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+import math
+import re
+import time
+from typing import List, Union
+import falcon
+import msgspec
+from constants import (
+    MAX_CATEGORIES, SCORING_MODE, HISTORY_INTERVAL, HISTORY_BUCKETS, VELOCITY_WINDOW, MAX_EVENT_SKEW,
+    MAX_EVENT_WEIGHT,
+)
+
+_CATEGORY = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+def parse_categories(value) -> tuple:
+    """Category names from a string, a comma-separated string or a list, deduplicated in order."""
+    if value is None:
+        return ()
+    names = value.split(",") if isinstance(value, str) else value
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError("category must be a string or a list of strings")
+    categories = tuple(dict.fromkeys(name.strip() for name in names if name.strip()))
+    if len(categories) > MAX_CATEGORIES:
+        raise ValueError(f"at most {MAX_CATEGORIES} categories are allowed")
+    for name in categories:
+        if not _CATEGORY.fullmatch(name):
+            raise ValueError(f"invalid category {name!r}: use up to 64 letters, digits, '_', '.' or '-'")
+    return categories
+
+def parse_at(value: str, now: int) -> int:
+    """/trending?at= as a unix time; past times must fall within the history kept."""
+    if SCORING_MODE != "forward":
+        raise ValueError("at needs SCORING_MODE=forward")
+    try:
+        at = int(value)
+    except ValueError:
+        raise ValueError("at must be a unix timestamp in seconds")
+    retention = HISTORY_INTERVAL * HISTORY_BUCKETS
+    if at < now - retention:
+        raise ValueError(f"at is more than the {retention} seconds of kept history in the past")
+    return at
+
+def parse_mode(value) -> str:
+    """/trending?mode=: "decay" (default) ranks by decayed score, "velocity" by rising event rate."""
+    mode = value or "decay"
+    if mode not in ("decay", "velocity"):
+        raise ValueError("mode must be 'decay' or 'velocity'")
+    if mode == "velocity" and VELOCITY_WINDOW <= 0:
+        raise ValueError("mode=velocity needs VELOCITY_WINDOW")
+    return mode
+
+class AddEventRequest(msgspec.Struct, gc=False):
+    """/add_event body, as in swagger.yml."""
+    item_id: Union[str, int]
+    event_time: int
+    weight: float = 1.0
+    category: Union[str, List[str], None] = None
+    event_id: Union[str, int, None] = None
+
+class TrendingItem(msgspec.Struct, gc=False):
+    """/trending row, as in swagger.yml."""
+    item_id: str
+    score: float
+
+# Compiled once; strict=False keeps accepting numeric strings such as "event_time": "1647123456"
+_event_decoder = msgspec.json.Decoder(AddEventRequest, strict=False)
+_batch_decoder = msgspec.json.Decoder(List[msgspec.Raw])
+_encoder = msgspec.json.Encoder()
+
+def parse_event(body, now: int = None):
+    """(item_id, event_time, weight, categories, event_id or None) from raw JSON bytes or an already decoded object."""
+    try:
+        if isinstance(body, (bytes, msgspec.Raw)):
+            event = _event_decoder.decode(body)
+        else:
+            event = msgspec.convert(body, AddEventRequest, strict=False)
+    except msgspec.ValidationError as e:
+        if "missing required field" in str(e):
+            raise ValueError("item_id and event_time are required")
+        if "$." not in str(e):
+            raise ValueError("event must be a JSON object")
+        raise ValueError(str(e))
+    except msgspec.DecodeError:
+        raise ValueError("event must be a JSON object")
+    if not event.item_id or not event.event_time:
+        raise ValueError("item_id and event_time are required")
+    # strict=False also accepts "inf" and "nan", which would be stored as scores for good
+    if not math.isfinite(event.weight):
+        raise ValueError("weight must be a finite number")
+    if abs(event.weight) > MAX_EVENT_WEIGHT:
+        raise ValueError(f"weight must be between -{MAX_EVENT_WEIGHT:g} and {MAX_EVENT_WEIGHT:g}")
+    if event.event_time > (int(time.time()) if now is None else now) + MAX_EVENT_SKEW:
+        raise ValueError(f"event_time is more than {MAX_EVENT_SKEW} seconds in the future")
+    event_id = None if event.event_id in (None, "") else str(event.event_id)
+    return str(event.item_id), event.event_time, event.weight, parse_categories(event.category), event_id
+
+def parse_batch(raw: bytes, content_type: str = None) -> list:
+    """Return the undecoded JSON of each event in a JSON array or an NDJSON payload.
+
+    Every NDJSON line is returned, valid or not, so each keeps its index.
+    """
+    if "ndjson" not in (content_type or "") and raw.lstrip().startswith(b"["):
+        try:
+            return _batch_decoder.decode(raw)
+        except msgspec.DecodeError:
+            raise ValueError("body must be a JSON array or NDJSON")
+    return [line for line in raw.splitlines() if line.strip()]
+
+def serialize_trending(items) -> bytes:
+    return _encoder.encode([TrendingItem(item.decode(), round(score, 6)) for item, score in items])
+
+# Falcon media handler for req.media/resp.media
+json_handler = falcon.media.JSONHandler(dumps=msgspec.json.encode, loads=msgspec.json.decode)
+
+def encode_cursor(row, now: int) -> str:
+    """Opaque /trending cursor for the page after `row`, a (member bytes, score) read at `now`."""
+    member, score = row
+    return base64.urlsafe_b64encode(json.dumps([score, now, member.decode()]).encode()).decode()
+
+def parse_cursor(token: str):
+    """(score, time, member) from an encode_cursor token; raises ValueError if it is malformed."""
+    try:
+        score, at, member = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return float(score), int(at), str(member)
+    except (binascii.Error, TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
@@ -1,19 +1,1192 @@
+import atexit
+import heapq
+import itertools
+import logging
 import math
+import os
+import queue
+import threading
 import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import redis
-from constants import DECAY_RATE, REDIS_HOST, REDIS_PORT, REDIS_DB
+from constants import (
+    DECAY_RATE, REDIS_HOST, REDIS_PORT, REDIS_DB, SCORING_MODE, LANDMARK_REBASE_EXPONENT, BATCH_CHUNK_SIZE,
+    MAX_TRENDING_SIZE, COALESCE_WINDOW_MS, COALESCE_MAX_ITEMS, COALESCE_QUEUE_SIZE,
+    TRENDING_SHARDS, REDIS_SHARD_HOSTS, STORE_BACKEND, DECAY_PROFILES, DEFAULT_WINDOW,
+    COMPACT_MAX_SIZE, COMPACT_SCORE_FLOOR, COMPACT_CHUNK_SIZE, CATEGORY_UNION_TTL_MS, SNAPSHOT_DIR, HISTORY_TOP_K,
+    HISTORY_INTERVAL, HISTORY_BUCKETS, VELOCITY_WINDOW, VELOCITY_CANDIDATES, TRENDING_KEY,
+    CLIENT_CACHE_ROWS, CLIENT_CACHE_MAX_KEYS, CLIENT_CACHE_MAX_AGE_MS,
+)
 
-# Redis connection
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+from metrics import REDIS_LATENCY
+
+logger = logging.getLogger(__name__)
+
+def _parse_host(host: str):
+    name, _, port = host.partition(":")
+    return name, int(port or REDIS_PORT)
 
 def decayed_score(weight: float, timestamp: int, now: int, decay_rate: float = DECAY_RATE) -> float:
     elapsed = now - timestamp
     return weight * math.exp(-decay_rate * elapsed)
 
-def add_event(key: str, item_id: str, event_time: int, weight: float = 1.0):
+def forward_score(weight: float, timestamp: int, landmark: int, decay_rate: float = DECAY_RATE) -> float:
+    # Forward decay: weight the event by its age *after* the landmark so that
+    # scores can simply be summed; dividing by exp(decay_rate * (now - landmark))
+    # on read gives back sum(weight * exp(-decay_rate * (now - timestamp))).
+    return weight * math.exp(decay_rate * (timestamp - landmark))
+
+def decayed_scores(weights, timestamps, now: int, decay_rate: float = DECAY_RATE) -> np.ndarray:
+    """Vectorized decayed_score. With `now` set to a landmark this is also the
+    vectorized forward_score, since both are weight * exp(-decay_rate * (now - timestamp))."""
+    elapsed = now - np.asarray(timestamps, dtype=np.int64)
+    return np.asarray(weights, dtype=np.float64) * np.exp(-decay_rate * elapsed)
+
+def _meta_key(key: str) -> str:
+    return f"{key}:meta"
+
+def shard_index(item_id: str, shard_count: int = TRENDING_SHARDS) -> int:
+    # crc32 rather than hash(): it has to agree across processes and restarts
+    return zlib.crc32(item_id.encode()) % shard_count if shard_count > 1 else 0
+
+def shard_key(key: str, index: int, shard_count: int = TRENDING_SHARDS) -> str:
+    return f"{key}:shard:{index}" if shard_count > 1 else key
+
+def _by_client(shard_list) -> list:
+    grouped = defaultdict(list)
+    for client, skey in shard_list:
+        grouped[client].append(skey)
+    return list(grouped.items())
+
+def merge_top(shard_items, count: int) -> list:
+    """Merge per-shard (member, score) lists, each in ZREVRANGE order: descending score, then member."""
+    return list(itertools.islice(heapq.merge(*shard_items, key=lambda item: (item[1], item[0]), reverse=True), count))
+
+# Applies one event atomically in a single round trip to every decay profile:
+# decayed_score (snapshot) or forward_score against the stored landmark (forward),
+# an optional trim to the top max_size members and a last_updated stamp.
+# KEYS: sorted set and meta hash of each profile, in pairs
+# ARGV: item_id, weight, event_time, mode, max_size, now, then one decay rate per profile
+ADD_EVENT_SCRIPT = """
+local weight = tonumber(ARGV[2])
+local event_time = tonumber(ARGV[3])
+local max_size = tonumber(ARGV[5])
+local now = tonumber(ARGV[6])
+local forward = ARGV[4] == 'forward'
+-- Every score is computed before anything is written, so a refused event changes nothing
+local scores, landmarks = {}, {}
+for i = 1, #KEYS / 2 do
+    local decay_rate = tonumber(ARGV[6 + i])
+    local score, total
+    if forward then
+        landmarks[i] = tonumber(redis.call('HGET', KEYS[2 * i], 'landmark'))
+        score = weight * math.exp(decay_rate * (event_time - (landmarks[i] or now)))
+        total = score + (tonumber(redis.call('ZSCORE', KEYS[2 * i - 1], ARGV[1])) or 0)
+    else
+        score = weight * math.exp(-decay_rate * (now - event_time))
+        total = score
+    end
+    -- math.exp and ZINCRBY overflow to inf rather than failing, and inf or nan would stay in the set for good
+    if total ~= total or total == math.huge or total == -math.huge then
+        return redis.error_reply('event score is not finite')
+    end
+    scores[i] = string.format('%.17g', score)
+end
+for i = 1, #KEYS / 2 do
+    local zset, meta = KEYS[2 * i - 1], KEYS[2 * i]
+    if forward then
+        if not landmarks[i] then
+            redis.call('HSET', meta, 'landmark', now)
+        end
+        redis.call('ZINCRBY', zset, scores[i], ARGV[1])
+    else
+        redis.call('ZADD', zset, scores[i], ARGV[1])
+    end
+    if max_size > 0 then
+        redis.call('ZREMRANGEBYRANK', zset, 0, -max_size - 1)
+    end
+    redis.call('HSET', meta, 'last_updated', now)
+end
+return 1
+"""
+
+# Removes at most `chunk` members below the score floor and at most `chunk`
+# members beyond the top max_size, so a single call never blocks Redis for long.
+# The floor is given in present-time terms and converted with the stored
+# landmark in forward mode. Evictions are counted in the meta hash.
+# KEYS: sorted set, meta hash
+# ARGV: floor (<= 0 to skip), max_size (<= 0 to skip), chunk, mode, decay_rate, now
+COMPACT_SCRIPT = """
+local floor = tonumber(ARGV[1])
+local max_size = tonumber(ARGV[2])
+local chunk = tonumber(ARGV[3])
+local by_score, by_rank = 0, 0
+if floor > 0 then
+    if ARGV[4] == 'forward' then
+        local landmark = tonumber(redis.call('HGET', KEYS[2], 'landmark'))
+        if landmark then
+            floor = floor * math.exp(tonumber(ARGV[5]) * (tonumber(ARGV[6]) - landmark))
+        end
+    end
+    local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. string.format('%.17g', floor),
+                               'LIMIT', 0, chunk)
+    if #members > 0 then
+        by_score = redis.call('ZREM', KEYS[1], unpack(members))
+        redis.call('HINCRBY', KEYS[2], 'evicted_by_score', by_score)
+    end
+end
+if max_size > 0 then
+    local excess = redis.call('ZCARD', KEYS[1]) - max_size
+    if excess > 0 then
+        by_rank = redis.call('ZREMRANGEBYRANK', KEYS[1], 0, math.min(excess, chunk) - 1)
+        redis.call('HINCRBY', KEYS[2], 'evicted_by_rank', by_rank)
+    end
+end
+return {by_score, by_rank}
+"""
+
+# Materializes the union of several sets at KEYS[1] unless a copy is still live,
+# expiring it after ttl_ms. In forward mode every source is weighted by
+# exp(-rate * (now - its landmark)), so the union holds present-time scores and
+# gets `now` as its own landmark.
+# KEYS: union set and meta hash, then each source set and meta hash in pairs
+# ARGV: ttl_ms, mode, decay_rate, now
+UNION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local sources, weights = {}, {}
+for i = 2, #KEYS / 2 do
+    local weight = 1
+    if ARGV[2] == 'forward' then
+        local landmark = tonumber(redis.call('HGET', KEYS[2 * i], 'landmark'))
+        if landmark then
+            weight = math.exp(-tonumber(ARGV[3]) * (tonumber(ARGV[4]) - landmark))
+        end
+    end
+    table.insert(sources, KEYS[2 * i - 1])
+    table.insert(weights, string.format('%.17g', weight))
+end
+local args = {KEYS[1], #sources}
+for _, source in ipairs(sources) do table.insert(args, source) end
+table.insert(args, 'WEIGHTS')
+for _, weight in ipairs(weights) do table.insert(args, weight) end
+local size = redis.call('ZUNIONSTORE', unpack(args))
+if size > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+    if ARGV[2] == 'forward' then
+        redis.call('HSET', KEYS[2], 'landmark', ARGV[4])
+        redis.call('PEXPIRE', KEYS[2], ARGV[1])
+    end
+end
+return size
+"""
+
+# Reads up to `limit` members after a cursor, the last row of the previous page:
+# from the cursor member's rank when it still holds the cursor score, otherwise
+# from the cursor score, skipping members tied with it that sort before the
+# cursor member. Both matches allow for the float error of converting the score
+# through the landmark. The cursor score is in present-time terms at the cursor
+# time, so it survives rebases and applies to every shard.
+# KEYS: sorted set, meta hash
+# ARGV: cursor score, cursor time, cursor member, limit, mode, decay_rate
+PAGE_SCRIPT = """
+local bound = tonumber(ARGV[1])
+local limit = tonumber(ARGV[4])
+local landmark = false
+if ARGV[5] == 'forward' then
+    landmark = redis.call('HGET', KEYS[2], 'landmark')
+    if landmark then
+        bound = bound * math.exp(tonumber(ARGV[6]) * (tonumber(ARGV[2]) - tonumber(landmark)))
+    end
+end
+local score = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[3]))
+local tolerance = 1e-9 * math.abs(bound)
+local rows
+if score and math.abs(score - bound) <= tolerance then
+    local rank = redis.call('ZREVRANK', KEYS[1], ARGV[3])
+    rows = redis.call('ZREVRANGE', KEYS[1], rank + 1, rank + limit, 'WITHSCORES')
+else
+    local max = string.format('%.17g', bound)
+    -- Tied members share one stored score, which the converted bound only approximates
+    local band = redis.call('ZREVRANGEBYSCORE', KEYS[1], string.format('%.17g', bound + tolerance),
+                            string.format('%.17g', bound - tolerance), 'WITHSCORES', 'LIMIT', 0, 1)
+    if #band > 0 then
+        max = band[2]
+    end
+    local skip = 0
+    while true do
+        local tied = redis.call('ZREVRANGEBYSCORE', KEYS[1], max, max, 'LIMIT', skip, 100)
+        local before = 0
+        for _, member in ipairs(tied) do
+            if member < ARGV[3] then
+                break
+            end
+            before = before + 1
+        end
+        skip = skip + before
+        if before < 100 then
+            break
+        end
+    end
+    rows = redis.call('ZREVRANGEBYSCORE', KEYS[1], max, '-inf', 'WITHSCORES', 'LIMIT', skip, limit)
+end
+return {rows, landmark}
+"""
+
+# Velocity sets rank items by the change in events per minute between the last
+# `window` minutes and the `window` before. Each item keeps a ring of 2 * window
+# minute buckets in "<velocity set>:item:<item_id>", a hash of slot (minute %
+# slots) -> "minute:count" that expires once every bucket is stale. Bucket keys
+# are derived from the member inside the read and refresh scripts, which suits
+# the client-side sharding here but not Redis Cluster.
+_VELOCITY_LUA = """
+local function rescore(zset, member, now_minute, window)
+    local fields = redis.call('HGETALL', zset .. ':item:' .. member)
+    local recent, previous, live = 0, 0, false
+    for j = 2, #fields, 2 do
+        local at, count = string.match(fields[j], '^(-?%d+):(.+)$')
+        local age = now_minute - tonumber(at)
+        if age < window then
+            recent = recent + tonumber(count)
+            live = true
+        elseif age < 2 * window then
+            previous = previous + tonumber(count)
+            live = true
+        end
+    end
+    if not live then
+        redis.call('ZREM', zset, member)
+        return nil
+    end
+    local velocity = string.format('%.17g', (recent - previous) / window)
+    redis.call('ZADD', zset, velocity, member)
+    return velocity
+end
+"""
+
+# Counts one event in its minute bucket and re-scores the item in every velocity set.
+# KEYS: velocity set and the item's bucket hash, per set
+# ARGV: item_id, weight, minute, now_minute, window
+VELOCITY_ADD_SCRIPT = _VELOCITY_LUA + """
+local minute, now_minute, window = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local slot = minute % (2 * window)
+for i = 1, #KEYS / 2 do
+    local count = tonumber(ARGV[2])
+    local current = redis.call('HGET', KEYS[2 * i], slot)
+    if current then
+        local at, value = string.match(current, '^(-?%d+):(.+)$')
+        if tonumber(at) == minute then
+            count = count + tonumber(value)
+        end
+    end
+    redis.call('HSET', KEYS[2 * i], slot, string.format('%d:%.17g', minute, count))
+    redis.call('PEXPIRE', KEYS[2 * i], 2 * window * 60000)
+    rescore(KEYS[2 * i - 1], ARGV[1], now_minute, window)
+end
+return 1
+"""
+
+# Re-scores the n highest stored velocities at now_minute and returns them as
+# member, velocity pairs; items whose buckets have all gone stale are dropped.
+# KEYS: velocity set
+# ARGV: n, now_minute, window
+VELOCITY_TOP_SCRIPT = _VELOCITY_LUA + """
+local rows = {}
+for _, member in ipairs(redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)) do
+    local velocity = rescore(KEYS[1], member, tonumber(ARGV[2]), tonumber(ARGV[3]))
+    if velocity then
+        table.insert(rows, member)
+        table.insert(rows, velocity)
+    end
+end
+return rows
+"""
+
+# Re-scores one ZSCAN page of a velocity set, dropping stale items.
+# KEYS: velocity set
+# ARGV: cursor, count, now_minute, window
+# Returns {next cursor, dropped}
+VELOCITY_REFRESH_SCRIPT = _VELOCITY_LUA + """
+local page = redis.call('ZSCAN', KEYS[1], ARGV[1], 'COUNT', ARGV[2])
+local dropped = 0
+for j = 1, #page[2], 2 do
+    if not rescore(KEYS[1], page[2][j], tonumber(ARGV[3]), tonumber(ARGV[4])) then
+        dropped = dropped + 1
+    end
+end
+return {page[1], dropped}
+"""
+
+def ring_velocity(ring, now_minute: int, window: int = VELOCITY_WINDOW) -> tuple:
+    """(velocity, live) of a ring of ([minute per slot], [count per slot]), as in _VELOCITY_LUA."""
+    recent = previous = 0.0
+    live = False
+    for minute, count in zip(*ring):
+        if minute is None:
+            continue
+        age = now_minute - minute
+        if age < window:
+            recent += count
+            live = True
+        elif age < 2 * window:
+            previous += count
+            live = True
+    return (recent - previous) / window, live
+
+def _velocity_calls(keys, events, now: int, shard_count: int):
+    """(shard index, VELOCITY_ADD_SCRIPT keys, args) for every event recent enough to land in the ring."""
+    now_minute = now // 60
+    for item_id, event_time, weight in events:
+        minute = event_time // 60
+        if minute <= now_minute - 2 * VELOCITY_WINDOW:
+            continue
+        index = shard_index(item_id, shard_count)
+        skeys = [shard_key(key, index, shard_count) for key in keys]
+        yield (index, [k for skey in skeys for k in (skey, f"{skey}:item:{item_id}")],
+               [item_id, weight, minute, now_minute, VELOCITY_WINDOW])
+
+def rank_velocity(rows, offset: int, count: int) -> list:
+    """Rising (member, velocity) rows in ZREVRANGE order, then the requested page."""
+    rising = sorted((row for row in rows if row[1] > 0), key=lambda row: (row[1], row[0]), reverse=True)
+    return rising[offset:offset + count]
+
+def _velocity_pairs(replies) -> list:
+    return [(member, float(velocity)) for reply in replies for member, velocity in zip(reply[::2], reply[1::2])]
+
+def _script_keys(skeys) -> list:
+    return [key for skey in skeys for key in (skey, _meta_key(skey))]
+
+def _event_args(item_id: str, event_time: int, weight: float, now: int, rates) -> list:
+    return [item_id, weight, event_time, SCORING_MODE, MAX_TRENDING_SIZE, now, *rates]
+
+def profile_targets(key: str) -> list:
+    """(sorted set key, decay rate) for every decay profile fed by events on `key`."""
+    if not DECAY_PROFILES:
+        return [(key, DECAY_RATE)]
+    return [(f"{key}:{name}", rate) for name, rate in DECAY_PROFILES.items()]
+
+def profile_target(key: str, window: str = None):
+    """(sorted set key, decay rate) answering /trending?window=; raises ValueError for unknown windows."""
+    if not DECAY_PROFILES and window is None:
+        return key, DECAY_RATE
+    window = window or DEFAULT_WINDOW
+    if window not in DECAY_PROFILES:
+        raise ValueError(f"unknown window {window!r}")
+    return f"{key}:{window}", DECAY_PROFILES[window]
+
+def category_key(key: str, category: str) -> str:
+    return f"{key}:category:{category}"
+
+def velocity_key(key: str) -> str:
+    # Outside `key`'s namespace, so the per-item bucket writes stay out of the tracking cache's prefix
+    return f"velocity:{key}"
+
+def velocity_targets(key: str, categories=()) -> list:
+    """Velocity sets fed by an event on `key`: its own and one per category."""
+    return [velocity_key(key)] + [velocity_key(category_key(key, category)) for category in categories]
+
+def history_key(key: str, taken: int) -> str:
+    """Copy of the top of `key` as it was at time `taken`."""
+    return f"{key}:history:{taken}"
+
+def history_index_key(key: str) -> str:
+    """Sorted set of the times the history copies of `key` were taken, scored by that time."""
+    return f"{key}:history"
+
+def event_targets(key: str, categories=()) -> list:
+    """profile_targets of `key` and of every category set the event also feeds."""
+    targets = profile_targets(key)
+    for category in categories:
+        targets += profile_targets(category_key(key, category))
+    return targets
+
+def union_target(key: str, categories, window: str = None):
+    """(union key, source keys, decay rate) answering /trending?category=a,b&window=."""
+    categories = sorted(set(categories))
+    union_key, decay_rate = profile_target(f"{key}:union:{'+'.join(categories)}", window)
+    return union_key, [profile_target(category_key(key, category), window)[0] for category in categories], decay_rate
+
+def _union_keys(union_key: str, sources, index: int, shard_count: int) -> list:
+    """UNION_SCRIPT keys for one shard; a shard's members live at the same index in every set."""
+    return _script_keys([shard_key(k, index, shard_count) for k in (union_key, *sources)])
+
+def _queue_top(pipe, skeys: list, count: int, start: int = 0):
+    for skey in skeys:
+        pipe.zrevrange(skey, start, start + count - 1, withscores=True)
+        if SCORING_MODE == "forward":
+            pipe.hget(_meta_key(skey), "landmark")
+
+def _split_top(replies: list) -> list:
+    """Pair each shard's rows with its landmark (None outside forward mode)."""
+    if SCORING_MODE != "forward":
+        return [(items, None) for items in replies]
+    return list(zip(replies[::2], replies[1::2]))
+
+def _page_bounds(shard_count: int, count: int, offset: int, cursor) -> tuple:
+    """(first rank, rows) each shard reads; a lone shard read from rank 0 applies the offset itself."""
+    if shard_count == 1 and cursor is None:
+        return offset, count
+    return 0, offset + count
+
+def _queue_page(pipe, page_script, skeys: list, start: int, limit: int, cursor, decay_rate: float):
+    if cursor is None:
+        _queue_top(pipe, skeys, limit, start)
+        return
+    for skey in skeys:
+        page_script(keys=[skey, _meta_key(skey)], args=[*cursor, limit, SCORING_MODE, decay_rate], client=pipe)
+
+def _split_page(replies: list, cursor) -> list:
+    if cursor is None:
+        return _split_top(replies)
+    return [(list(zip(rows[::2], map(float, rows[1::2]))), landmark) for rows, landmark in replies]
+
+def _to_present(items, landmark, now: int, decay_rate: float = DECAY_RATE) -> list:
+    if landmark is None:
+        return items
+    scale = decayed_score(1.0, int(landmark), now, decay_rate)
+    return [(item, score * scale) for item, score in items]
+
+def _merge_replies(replies: list, count: int, now: int, decay_rate: float = DECAY_RATE) -> list:
+    shard_items = [_to_present(items, landmark, now, decay_rate) for reply in replies for items, landmark in reply]
+    if len(shard_items) == 1:
+        return shard_items[0]
+    return merge_top(shard_items, count)
+
+class TrendingStore:
+    """Storage backend behind add_event/get_trending.
+
+    Stored scores follow SCORING_MODE: decayed at write time in snapshot mode,
+    landmark-relative in forward mode. Events are (item_id, event_time, weight)
+    tuples written to every (key, decay_rate) target, and top() returns
+    present-time (member bytes, score) pairs, highest first, starting `offset`
+    rows after the `cursor` (score, time, member) of a previous page, if any.
+    """
+
+    def add_events(self, targets, events, now: int, velocity=()):
+        """Write events to every target and count them in the velocity sets in `velocity`."""
+        raise NotImplementedError
+
+    def top(self, key: str, count: int, now: int, decay_rate: float = DECAY_RATE, offset: int = 0,
+            cursor=None) -> list:
+        raise NotImplementedError
+
+    def top_union(self, key: str, sources, count: int, now: int, decay_rate: float = DECAY_RATE,
+                  ttl_ms: int = CATEGORY_UNION_TTL_MS, offset: int = 0, cursor=None) -> list:
+        """top() of the sum of the `sources` sets, kept at `key` and rebuilt at most every ttl_ms."""
+        raise NotImplementedError
+
+    def categories(self, key: str) -> set:
+        """Names of the category sets stored under `key`."""
+        raise NotImplementedError
+
+    def memory(self, key: str):
+        """Approximate bytes used by the trending set `key`, or None if the backend cannot tell."""
+        return None
+
+    def history(self, key: str) -> list:
+        """Times of the history copies of `key`, oldest first."""
+        raise NotImplementedError
+
+    def save_history(self, key: str, taken: int, rows, decay_rate: float = DECAY_RATE):
+        """Keep present-time (member bytes, score) rows as the copy history_key(key, taken)."""
+        raise NotImplementedError
+
+    def drop_history(self, key: str, taken: int):
+        """Remove the history copy of `key` taken at `taken`."""
+        raise NotImplementedError
+
+    def add_velocity(self, keys, events, now: int):
+        """Count (item_id, event_time, weight) events in the minute buckets of every velocity set in `keys`."""
+        raise NotImplementedError
+
+    def top_velocity(self, key: str, count: int, now: int, offset: int = 0) -> list:
+        """Fastest-rising items of velocity set `key` as (member, change in events per minute)."""
+        raise NotImplementedError
+
+    def refresh_velocity(self, key: str, now: int) -> int:
+        """Re-score every item of velocity set `key`, dropping items with no recent buckets; returns the drops."""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        """Remove the trending set `key` entirely."""
+        raise NotImplementedError
+
+    def rebase(self, key: str, now: int, min_exponent: float = 0.0, decay_rate: float = DECAY_RATE):
+        """Move landmarks with decay_rate * age >= min_exponent to now; returns now if any moved."""
+        raise NotImplementedError
+
+    def compact(self, key: str, now: int, max_size: int, floor: float, decay_rate: float = DECAY_RATE,
+                chunk_size: int = COMPACT_CHUNK_SIZE):
+        """Evict members scoring below `floor` now and members beyond the top `max_size`
+        (per shard), chunk_size at a time; returns (evicted_by_score, evicted_by_rank)."""
+        raise NotImplementedError
+
+class TrackingCache:
+    """Top rows of Redis shards kept in process memory, valid until Redis reports a write.
+
+    One RESP3 connection per host runs CLIENT TRACKING in broadcast mode for
+    every key under `prefix`, so Redis pushes an invalidation for each key
+    written, whoever wrote it. Keys written on every request that are never
+    cached (velocity buckets, rate limits, dedup filters) are kept outside
+    that prefix, so they cost no pushes. A shard's rows are dropped when the shard or its
+    meta hash is invalidated. Rows are only kept while their host's listener is
+    connected (a reconnect empties the cache, since pushes may have been
+    missed) and never for longer than max_age_ms. A connection whose parser
+    cannot hand over pushes (redis-py before 5.1, or the hiredis parser) never
+    connects, so nothing is cached.
+    """
+
+    def __init__(self, clients, prefix: str = TRENDING_KEY, rows: int = CLIENT_CACHE_ROWS,
+                 max_keys: int = CLIENT_CACHE_MAX_KEYS, max_age_ms: int = CLIENT_CACHE_MAX_AGE_MS):
+        self.clients = clients
+        self.prefix = prefix
+        self.rows = rows
+        self.max_keys = max_keys
+        self.max_age = max_age_ms / 1000.0
+        self.hits = 0
+        self.misses = 0
+        # shard key -> (rows read from rank 0, items, landmark, monotonic time read)
+        self._entries = OrderedDict()
+        # Bumped per shard key on invalidation, and for every key by a flush (epoch), so a
+        # read that raced a write is not cached
+        self._versions = defaultdict(int)
+        self._epoch = 0
+        self._live = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def lookup(self, shards, start: int, limit: int):
+        """(cached {shard key: (rows start..start+limit, landmark)}, (client, shard key) pairs to read,
+        token for store())."""
+        self._ensure_started()
+        hits, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for client, skey in shards:
+                entry = self._entries.get(skey)
+                if entry is not None and start + limit <= entry[0] and now - entry[3] < self.max_age:
+                    self._entries.move_to_end(skey)
+                    hits[skey] = (entry[1][start:start + limit], entry[2])
+                else:
+                    missing.append((client, skey))
+            token = (self._epoch, [self._versions[skey] for _, skey in missing])
+        self.hits += len(hits)
+        self.misses += len(missing)
+        return hits, missing, token
+
+    def read_size(self, start: int, limit: int) -> int:
+        """Rows to read from rank 0 on a miss, so smaller pages are served from the entry too."""
+        return max(start + limit, self.rows)
+
+    def store(self, missing, token, replies, rows: int):
+        """Keep the top `rows` rows just read for `missing`, unless one of their keys was invalidated meanwhile."""
+        epoch, versions = token
+        now = time.monotonic()
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            for (client, skey), version, (items, landmark) in zip(missing, versions, replies):
+                if client in self._live and self._versions[skey] == version:
+                    self._entries[skey] = (rows, items, landmark, now)
+                    self._entries.move_to_end(skey)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def _flush_locked(self):
+        self._entries.clear()
+        self._versions.clear()
+        self._epoch += 1
+
+    def _invalidate(self, push):
+        # ["invalidate", [key, ...]], or a null key list after FLUSHDB/FLUSHALL
+        keys = push[1]
+        with self._lock:
+            if keys is None:
+                self._flush_locked()
+                return
+            for key in keys:
+                key = key.decode() if isinstance(key, bytes) else key
+                if key.endswith(":meta"):
+                    key = key[:-len(":meta")]
+                if key in self._versions:
+                    self._versions[key] += 1
+                    self._entries.pop(key, None)
+
+    def _listen(self, client):
+        kwargs = {**client.connection_pool.connection_kwargs, "protocol": 3, "socket_timeout": None}
+        backoff = 0.5
+        while True:
+            connection = redis.Connection(**kwargs)
+            # redis-py has no public hook for pushes on a plain connection, only its parser's
+            set_handler = getattr(connection._parser, "set_invalidation_push_handler", None)
+            if set_handler is None:
+                logger.warning("Client-side caching disabled: the %s of redis %s does not deliver "
+                               "invalidation pushes", type(connection._parser).__name__, redis.__version__)
+                return
+            try:
+                connection.connect()
+                set_handler(self._invalidate)
+                connection.send_command("CLIENT", "TRACKING", "ON", "BCAST", "PREFIX", self.prefix)
+                reply = connection.read_response()
+                if isinstance(reply, Exception):
+                    raise reply
+                with self._lock:
+                    self._live.add(client)
+                backoff = 0.5
+                while True:
+                    connection.read_response(push_request=True)
+            except Exception as e:
+                with self._lock:
+                    self._live.discard(client)
+                    self._flush_locked()
+                logger.warning("Client-side cache listener lost (%s); reconnecting in %.1fs", e, backoff)
+                connection.disconnect()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _ensure_started(self):
+        # Started lazily and per pid, like the coalescing flusher, so each preforked worker listens
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._live = set()
+            self._flush_locked()
+            for client in self.clients:
+                threading.Thread(target=self._listen, args=(client,), name="client-cache-listener",
+                                 daemon=True).start()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "keys": len(self._entries)}
+
+class RedisTrendingStore(TrendingStore):
+    def __init__(self, hosts=REDIS_SHARD_HOSTS, shard_count: int = TRENDING_SHARDS,
+                 chunk_size: int = BATCH_CHUNK_SIZE):
+        # Shard i lives on clients[i % len(clients)]
+        self.clients = [redis.Redis(host=h, port=p, db=REDIS_DB) for h, p in map(_parse_host, hosts)] \
+            or [redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)]
+        self.shard_count = shard_count
+        self.chunk_size = chunk_size
+        self._scatter = ThreadPoolExecutor(max_workers=len(self.clients)) if len(self.clients) > 1 else None
+        # EVALSHA, reloading the script on NOSCRIPT (pipelines load it before executing)
+        self._add_event_script = self.clients[0].register_script(ADD_EVENT_SCRIPT)
+        self._compact_script = self.clients[0].register_script(COMPACT_SCRIPT)
+        self._union_script = self.clients[0].register_script(UNION_SCRIPT)
+        self._page_script = self.clients[0].register_script(PAGE_SCRIPT)
+        self._velocity_add_script = self.clients[0].register_script(VELOCITY_ADD_SCRIPT)
+        self._velocity_top_script = self.clients[0].register_script(VELOCITY_TOP_SCRIPT)
+        self._velocity_refresh_script = self.clients[0].register_script(VELOCITY_REFRESH_SCRIPT)
+        self.tracking = TrackingCache(self.clients) if CLIENT_CACHE_ROWS > 0 else None
+
+    def shards(self, key: str):
+        """Every (client, shard key) pair that makes up the trending set `key`."""
+        return [(self.clients[i % len(self.clients)], shard_key(key, i, self.shard_count))
+                for i in range(self.shard_count)]
+
+    def _scatter_gather(self, fn, jobs: list) -> list:
+        """Run fn(client, payload) once per client, in parallel when there are several."""
+        if self._scatter is None or len(jobs) == 1:
+            return [fn(*job) for job in jobs]
+        return list(self._scatter.map(lambda job: fn(*job), jobs))
+
+    def _locate(self, targets, item_id: str):
+        """Client and script keys for item_id; its shard index is the same in every target."""
+        index = shard_index(item_id, self.shard_count)
+        skeys = [shard_key(key, index, self.shard_count) for key, _ in targets]
+        return self.clients[index % len(self.clients)], _script_keys(skeys)
+
+    def add_events(self, targets, events, now: int, velocity=()):
+        rates = [rate for _, rate in targets]
+        if len(events) == 1 and not velocity:
+            item_id, event_time, weight = events[0]
+            client, keys = self._locate(targets, item_id)
+            with REDIS_LATENCY.time(command="evalsha"):
+                self._add_event_script(keys=keys, args=_event_args(item_id, event_time, weight, now, rates),
+                                       client=client)
+            return
+        by_client = defaultdict(list)
+        for item_id, event_time, weight in events:
+            client, keys = self._locate(targets, item_id)
+            by_client[client].append((self._add_event_script, keys,
+                                      _event_args(item_id, event_time, weight, now, rates)))
+        # An item's velocity buckets share its shard index, so they ride in the same pipeline
+        for index, keys, args in _velocity_calls(velocity, events, now, self.shard_count):
+            by_client[self.clients[index % len(self.clients)]].append((self._velocity_add_script, keys, args))
+
+        def write(client, calls):
+            for start in range(0, len(calls), self.chunk_size):
+                pipe = client.pipeline(transaction=False)
+                for script, keys, args in calls[start:start + self.chunk_size]:
+                    script(keys=keys, args=args, client=pipe)
+                with REDIS_LATENCY.time(command="pipeline_add"):
+                    pipe.execute()
+
+        self._scatter_gather(write, list(by_client.items()))
+
+    def top(self, key: str, count: int, now: int, decay_rate: float = DECAY_RATE, offset: int = 0,
+            cursor=None) -> list:
+        start, limit = _page_bounds(self.shard_count, count, offset, cursor)
+        if cursor is None and self.tracking is not None:
+            replies = [self._tracked_top(self.shards(key), start, limit)]
+            return _merge_replies(replies, offset - start + count, now, decay_rate)[offset - start:]
+
+        def read(client, skeys):
+            pipe = client.pipeline(transaction=False)
+            _queue_page(pipe, self._page_script, skeys, start, limit, cursor, decay_rate)
+            with REDIS_LATENCY.time(command="pipeline_top"):
+                return _split_page(pipe.execute(), cursor)
+
+        replies = self._scatter_gather(read, _by_client(self.shards(key)))
+        return _merge_replies(replies, offset - start + count, now, decay_rate)[offset - start:]
+
+    def _tracked_top(self, shards, start: int, limit: int) -> list:
+        """(items, landmark) of rows start..start+limit of each shard, from the tracking cache where it can."""
+        hits, missing, token = self.tracking.lookup(shards, start, limit)
+        if missing:
+            rows = self.tracking.read_size(start, limit)
+
+            def read(client, skeys):
+                pipe = client.pipeline(transaction=False)
+                _queue_top(pipe, skeys, rows)
+                with REDIS_LATENCY.time(command="pipeline_top"):
+                    return list(zip(skeys, _split_top(pipe.execute())))
+
+            fetched = dict(pair for reply in self._scatter_gather(read, _by_client(missing)) for pair in reply)
+            self.tracking.store(missing, token, [fetched[skey] for _, skey in missing], rows)
+            hits.update((skey, (items[start:start + limit], landmark)) for skey, (items, landmark) in fetched.items())
+        return [hits[skey] for _, skey in shards]
+
+    def top_union(self, key: str, sources, count: int, now: int, decay_rate: float = DECAY_RATE,
+                  ttl_ms: int = CATEGORY_UNION_TTL_MS, offset: int = 0, cursor=None) -> list:
+        args = [ttl_ms, SCORING_MODE, decay_rate, now]
+        start, limit = _page_bounds(self.shard_count, count, offset, cursor)
+
+        def read(client, indexes):
+            pipe = client.pipeline(transaction=False)
+            for index in indexes:
+                self._union_script(keys=_union_keys(key, sources, index, self.shard_count), args=args, client=pipe)
+            _queue_page(pipe, self._page_script, [shard_key(key, index, self.shard_count) for index in indexes],
+                        start, limit, cursor, decay_rate)
+            with REDIS_LATENCY.time(command="pipeline_union"):
+                return _split_page(pipe.execute()[len(indexes):], cursor)
+
+        by_client = defaultdict(list)
+        for index in range(self.shard_count):
+            by_client[self.clients[index % len(self.clients)]].append(index)
+        replies = self._scatter_gather(read, list(by_client.items()))
+        return _merge_replies(replies, offset - start + count, now, decay_rate)[offset - start:]
+
+    def categories(self, key: str) -> set:
+        prefix = category_key(key, "")
+        return {name.decode()[len(prefix):].split(":")[0]
+                for client in self.clients for name in client.scan_iter(match=f"{prefix}*", count=1000)}
+
+    def memory(self, key: str):
+        return sum(client.memory_usage(k) or 0 for client, skey in self.shards(key) for k in (skey, _meta_key(skey)))
+
+    def history(self, key: str) -> list:
+        # The index lives on the first host, next to nothing else that grows with the item count
+        return [int(taken) for taken in self.clients[0].zrange(history_index_key(key), 0, -1)]
+
+    def save_history(self, key: str, taken: int, rows, decay_rate: float = DECAY_RATE):
+        # Plain sorted sets, also under redis_sketch: copies are only read, so they need no sketch
+        copy = history_key(key, taken)
+        by_shard = defaultdict(dict)
+        for member, score in rows:
+            by_shard[shard_index(member.decode(), self.shard_count)][member] = score
+        pipes = {}
+        for index, scores in by_shard.items():
+            client = self.clients[index % len(self.clients)]
+            pipe = pipes.setdefault(client, client.pipeline(transaction=False))
+            skey = shard_key(copy, index, self.shard_count)
+            pipe.zadd(skey, scores)
+            if SCORING_MODE == "forward":
+                # Scores are as of `taken`, so that is the copy's landmark and reads rescale from there
+                pipe.hset(_meta_key(skey), "landmark", taken)
+        for pipe in pipes.values():
+            pipe.execute()
+        self.clients[0].zadd(history_index_key(key), {taken: taken})
+
+    def drop_history(self, key: str, taken: int):
+        self.delete(history_key(key, taken))
+        self.clients[0].zrem(history_index_key(key), taken)
+
+    def delete(self, key: str):
+        for client, skey in self.shards(key):
+            client.delete(skey, _meta_key(skey))
+
+    def add_velocity(self, keys, events, now: int):
+        by_client = defaultdict(list)
+        for index, script_keys, args in _velocity_calls(keys, events, now, self.shard_count):
+            by_client[self.clients[index % len(self.clients)]].append((script_keys, args))
+
+        def write(client, calls):
+            for start in range(0, len(calls), self.chunk_size):
+                pipe = client.pipeline(transaction=False)
+                for script_keys, args in calls[start:start + self.chunk_size]:
+                    self._velocity_add_script(keys=script_keys, args=args, client=pipe)
+                with REDIS_LATENCY.time(command="pipeline_velocity"):
+                    pipe.execute()
+
+        self._scatter_gather(write, list(by_client.items()))
+
+    def top_velocity(self, key: str, count: int, now: int, offset: int = 0) -> list:
+        args = [(offset + count) * VELOCITY_CANDIDATES, now // 60, VELOCITY_WINDOW]
+
+        def read(client, skeys):
+            pipe = client.pipeline(transaction=False)
+            for skey in skeys:
+                self._velocity_top_script(keys=[skey], args=args, client=pipe)
+            with REDIS_LATENCY.time(command="pipeline_velocity_top"):
+                return pipe.execute()
+
+        replies = self._scatter_gather(read, _by_client(self.shards(key)))
+        return rank_velocity(_velocity_pairs(reply for shard_replies in replies for reply in shard_replies),
+                             offset, count)
+
+    def refresh_velocity(self, key: str, now: int, chunk_size: int = COMPACT_CHUNK_SIZE) -> int:
+        dropped = 0
+        for client, skey in self.shards(key):
+            cursor = 0
+            while True:
+                cursor, removed = self._velocity_refresh_script(
+                    keys=[skey], args=[cursor, chunk_size, now // 60, VELOCITY_WINDOW], client=client)
+                dropped += removed
+                if int(cursor) == 0:
+                    break
+        return dropped
+
+    def rebase(self, key: str, now: int, min_exponent: float = 0.0, decay_rate: float = DECAY_RATE):
+        rebased = None
+        for client, skey in self.shards(key):
+            landmark = client.hget(_meta_key(skey), "landmark")
+            if landmark is not None and decay_rate * (now - int(landmark)) >= min_exponent:
+                rebased = self._rebase_shard(client, skey, now, decay_rate) or rebased
+        return rebased
+
+    def compact(self, key: str, now: int, max_size: int, floor: float, decay_rate: float = DECAY_RATE,
+                chunk_size: int = COMPACT_CHUNK_SIZE):
+        by_score = by_rank = 0
+        for client, skey in self.shards(key):
+            while True:
+                with REDIS_LATENCY.time(command="compact"):
+                    removed = self._compact_script(keys=[skey, _meta_key(skey)],
+                                                   args=[floor, max_size, chunk_size, SCORING_MODE, decay_rate, now],
+                                                   client=client)
+                by_score += removed[0]
+                by_rank += removed[1]
+                if removed[0] < chunk_size and removed[1] < chunk_size:
+                    break
+        return by_score, by_rank
+
+    def _rebase_shard(self, client, key: str, now: int, decay_rate: float):
+        """Move one sorted set's landmark to `now` and rescale every stored score to match.
+
+        Runs as a single MULTI so readers never see the set half-rescaled; writers
+        read the landmark inside ADD_EVENT_SCRIPT, so none of them can straddle it.
+        """
+        meta = _meta_key(key)
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(meta)
+                    landmark = pipe.hget(meta, "landmark")
+                    if landmark is None:
+                        return None
+                    pipe.multi()
+                    pipe.zunionstore(key, {key: decayed_score(1.0, int(landmark), now, decay_rate)})
+                    pipe.hset(meta, "landmark", now)
+                    pipe.execute()
+                    return now
+                except redis.WatchError:
+                    continue
+
+def make_store(backend: str = STORE_BACKEND, snapshot_dir: str = SNAPSHOT_DIR) -> TrendingStore:
+    if backend == "redis":
+        return RedisTrendingStore()
+    if backend == "redis_sketch":
+        from sketch_store import RedisSketchStore
+        return RedisSketchStore()
+    if backend in ("local", "sketch"):
+        # Imported lazily: local_store and sketch_store build on the classes above
+        from local_store import LocalTrendingStore
+        from sketch_store import SketchTrendingStore
+        local = LocalTrendingStore() if backend == "local" else SketchTrendingStore()
+        if snapshot_dir:
+            import snapshot
+            stats = snapshot.restore(local, snapshot_dir)
+            logger.info("Serving %s store from %s after %.1fms", backend, snapshot_dir, stats["seconds"] * 1000)
+            # Snapshotting on a clean exit leaves no log to replay, so the next start serves every set at once
+            atexit.register(snapshot.write_snapshot, local, snapshot_dir)
+        return local
+    raise ValueError(f"unknown STORE_BACKEND {backend!r}")
+
+store = make_store()
+
+def add_event(key: str, item_id: str, event_time: int, weight: float = 1.0, categories=()) -> bool:
+    """Write one event; False if it was only buffered, to be written by a later flush."""
+    if _buffer is not None:
+        for target_key in (key, *(category_key(key, category) for category in categories)):
+            _buffer.add(target_key, item_id, event_time, weight)
+        return False
+    store.add_events(event_targets(key, categories), [(item_id, event_time, weight)], int(time.time()),
+                     velocity_targets(key, categories) if VELOCITY_WINDOW > 0 else ())
+    return True
+
+def by_categories(events) -> dict:
+    """Group (item_id, event_time, weight[, categories[, event_id]]) tuples by their categories."""
+    groups = defaultdict(list)
+    for event in events:
+        groups[tuple(event[3]) if len(event) > 3 else ()].append(event[:3])
+    return groups
+
+def add_events(key: str, events):
+    """Write (item_id, event_time, weight[, categories]) tuples to every decay profile of `key`
+    and of each event's category sets."""
     now = int(time.time())
-    score = decayed_score(weight, event_time, now)
-    r.zadd(key, {item_id: score})
+    for categories, group in by_categories(events).items():
+        store.add_events(event_targets(key, categories), group, now,
+                         velocity_targets(key, categories) if VELOCITY_WINDOW > 0 else ())
+
+def trending_target(key: str, window: str = None, categories=()):
+    """(sorted set key, union sources or None, decay rate) read for /trending."""
+    if len(categories) > 1:
+        return union_target(key, categories, window)
+    profile_key, decay_rate = profile_target(category_key(key, categories[0]) if categories else key, window)
+    return profile_key, None, decay_rate
+
+def history_time(key: str, at: int):
+    """Time of the newest history copy of `key` taken at or before `at`, or None."""
+    taken = [t for t in store.history(key) if t <= at]
+    return taken[-1] if taken else None
+
+def at_target(target_key: str, sources, at: int, taken):
+    """Key and sources to read scores as of a past `at` from: the history copy taken at `taken`.
+
+    The live set also holds every event after `at`, so it is never rescaled
+    back in time; without a copy at or before `at` there is nothing to answer from.
+    """
+    if taken is None:
+        raise ValueError(f"no history copy was taken at or before {at}")
+    return history_key(target_key, taken), sources and [history_key(source, taken) for source in sources]
+
+def get_trending(key: str, count: int = 10, window: str = None, categories=(), offset: int = 0, cursor=None,
+                 now: int = None, at: int = None):
+    """Top of `key`, of one category, or of the union of several categories.
+
+    Pages start `offset` rows after `cursor`, a (score, time, member) triple
+    taken from the last row of the previous page and the `now` it was read at.
+    With `at` (forward mode), scores are as of that time instead of now.
+    """
+    now = int(time.time()) if now is None else now
+    target_key, sources, decay_rate = trending_target(key, window, categories)
+    if at is not None:
+        if at < now:
+            taken = history_time(sources[0] if sources else target_key, at)
+            target_key, sources = at_target(target_key, sources, at, taken)
+        now = at
+    if sources:
+        return store.top_union(target_key, sources, count, now, decay_rate, offset=offset, cursor=cursor)
+    return store.top(target_key, count, now, decay_rate, offset, cursor)
+
+def get_velocity(key: str, count: int = 10, categories=(), offset: int = 0, now: int = None):
+    """Fastest-rising items of `key` or of one category, by change in events per minute."""
+    now = int(time.time()) if now is None else now
+    return store.top_velocity(velocity_targets(key, categories)[-1], count, now, offset)
+
+def trending_keys(key: str) -> list:
+    """`key` and every category set stored under it, for the maintenance jobs."""
+    return [key] + [category_key(key, category) for category in sorted(store.categories(key))]
+
+def record_history(key: str, now: int = None, top_k: int = HISTORY_TOP_K,
+                   retention: int = HISTORY_INTERVAL * HISTORY_BUCKETS) -> int:
+    """Copy the top_k of every set under `key` to history_key(set, now) and drop copies older than retention."""
+    now = int(time.time()) if now is None else now
+    written = 0
+    for target_key in trending_keys(key):
+        for profile_key, decay_rate in profile_targets(target_key):
+            rows = store.top(profile_key, top_k, now, decay_rate)
+            if rows:
+                store.save_history(profile_key, now, rows, decay_rate)
+                written += 1
+            for taken in store.history(profile_key):
+                if taken < now - retention:
+                    store.drop_history(profile_key, taken)
+    return written
+
+def store_memory(key: str) -> dict:
+    """Bytes held by each profile of `key`, for stores that can report it."""
+    usage = {}
+    for profile_key, _ in profile_targets(key):
+        size = store.memory(profile_key)
+        if size is not None:
+            usage[profile_key] = size
+    return usage
+
+def rebase_landmark(key: str, now: int = None):
+    """Move the landmark of every profile and shard of `key` to `now`; returns `now`, or None if nothing was stored."""
+    now = int(time.time()) if now is None else now
+    rebased = [store.rebase(profile_key, now, 0.0, decay_rate) for profile_key, decay_rate in profile_targets(key)]
+    return now if any(landmark is not None for landmark in rebased) else None
+
+def compact(key: str, max_size: int = COMPACT_MAX_SIZE, floor: float = COMPACT_SCORE_FLOOR, now: int = None):
+    """Trim every profile of `key`; returns (evicted_by_score, evicted_by_rank) summed over profiles."""
+    now = int(time.time()) if now is None else now
+    evicted = [store.compact(profile_key, now, max_size, floor, decay_rate)
+               for profile_key, decay_rate in profile_targets(key)]
+    return sum(by_score for by_score, _ in evicted), sum(by_rank for _, by_rank in evicted)
+
+def maybe_rebase_landmark(key: str, now: int = None):
+    now = int(time.time()) if now is None else now
+    rebased = [store.rebase(profile_key, now, LANDMARK_REBASE_EXPONENT, decay_rate)
+               for profile_key, decay_rate in profile_targets(key)]
+    return now if any(landmark is not None for landmark in rebased) else None
+
+class CoalescingBuffer:
+    """Write-behind buffer that merges add_event calls per (key, item_id).
+
+    Pending items are handed to a background flusher when the window elapses or
+    max_items distinct items are pending. At most queue_size batches wait for
+    Redis; beyond that add() blocks, pushing back on the callers.
+    """
+
+    def __init__(self, window_ms: int = COALESCE_WINDOW_MS, max_items: int = COALESCE_MAX_ITEMS,
+                 queue_size: int = COALESCE_QUEUE_SIZE):
+        self.window = window_ms / 1000.0
+        self.max_items = max_items
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.events = 0
+        self.writes = 0
+        self.failed_writes = 0
+
+    def add(self, key: str, item_id: str, event_time: int, weight: float = 1.0):
+        self._ensure_started()
+        with self._lock:
+            self.events += 1
+            entry = self._pending.get((key, item_id))
+            # The undecayed total feeds the velocity buckets
+            total = weight if entry is None else entry[3] + weight
+            if SCORING_MODE != "forward" or entry is None:
+                # Snapshot mode overwrites on write anyway, so the last event wins.
+                rates = [rate for _, rate in profile_targets(key)]
+                self._pending[(key, item_id)] = (event_time, [weight] * len(rates), rates, total)
+            else:
+                # Sum as forward-decayed values (one per profile) whose landmark is
+                # the newest event time seen, which keeps every exponent <= 0.
+                ref, accs, rates, _ = entry
+                if event_time > ref:
+                    accs = [decayed_score(acc, ref, event_time, rate) + weight for acc, rate in zip(accs, rates)]
+                    self._pending[(key, item_id)] = (event_time, accs, rates, total)
+                else:
+                    for i, rate in enumerate(rates):
+                        accs[i] += decayed_score(weight, event_time, ref, rate)
+                    self._pending[(key, item_id)] = (ref, accs, rates, total)
+            batch = self._take() if len(self._pending) >= self.max_items else None
+        if batch:
+            self._queue.put(batch)
+
+    def backlogged(self) -> bool:
+        """True while every queue slot is taken, i.e. add() may block until the flusher catches up."""
+        return self._queue.full()
+
+    def flush(self):
+        batch = self._take_locked()
+        if batch:
+            self._queue.put(batch)
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self.flush()
+            self._closed = True
+            self._thread.join()
+        else:
+            # Never started in this process: write what is pending inline.
+            self._closed = True
+            batch = self._take_locked()
+            if batch:
+                self._write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "writes": self.writes,
+            "failed_writes": self.failed_writes,
+            "coalesce_ratio": self.events / self.writes if self.writes else 0.0,
+        }
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preforking server gets one flusher per worker.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="coalesce-flusher", daemon=True)
+                self._thread.start()
+
+    def _take(self):
+        batch, self._pending = self._pending, {}
+        return batch
+
+    def _take_locked(self):
+        with self._lock:
+            return self._take()
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.window)
+            except queue.Empty:
+                batch = self._take_locked()
+                if batch:
+                    self._write(batch)
+                elif self._closed:
+                    return
+                continue
+            self._write(batch)
+            self._queue.task_done()
+
+    def _write(self, batch: dict):
+        by_key = defaultdict(list)
+        for (key, item_id), (event_time, weights, _, total) in batch.items():
+            by_key[key].append((item_id, event_time, weights, total))
+        for key, events in by_key.items():
+            try:
+                targets = profile_targets(key)
+                now = int(time.time())
+                if SCORING_MODE != "forward":
+                    store.add_events(targets, [(item_id, t, weights[0]) for item_id, t, weights, _ in events], now)
+                else:
+                    for i, target in enumerate(targets):
+                        store.add_events([target], [(item_id, t, weights[i]) for item_id, t, weights, _ in events],
+                                         now)
+                if VELOCITY_WINDOW > 0:
+                    store.add_velocity([velocity_key(key)], [(item_id, t, total) for item_id, t, _, total in events],
+                                       now)
+                self.writes += len(events)
+            except Exception:
+                self.failed_writes += len(events)
+                logger.exception("Dropped %d coalesced writes for %s", len(events), key)
+
+def coalesce_stats() -> dict:
+    return _buffer.stats() if _buffer is not None else {}
+
+def client_cache_stats() -> dict:
+    tracking = getattr(store, "tracking", None)
+    return tracking.stats() if tracking is not None else {}
 
-def get_trending(key: str, count: int = 10):
-    return r.zrevrange(key, 0, count - 1, withscores=True)
+_buffer = CoalescingBuffer() if COALESCE_WINDOW_MS > 0 else None
+if _buffer is not None:
+    atexit.register(_buffer.close)
@@ -0,0 +1,196 @@
+import asyncio
+import time
+from collections import defaultdict
+import redis.asyncio as aioredis
+import scoring
+from scoring import (
+    store, RedisTrendingStore, ADD_EVENT_SCRIPT, UNION_SCRIPT, PAGE_SCRIPT, VELOCITY_ADD_SCRIPT, VELOCITY_TOP_SCRIPT,
+    _event_args, _velocity_calls, _velocity_pairs, rank_velocity, velocity_targets, _script_keys, _parse_host,
+    _meta_key, _queue_top, _page_bounds, _split_page, _split_top, _merge_replies, _union_keys, shard_index, shard_key,
+    event_targets, by_categories, trending_target, history_time, history_index_key, at_target,
+)
+from metrics import REDIS_LATENCY
+from constants import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, BATCH_CHUNK_SIZE, REDIS_MAX_CONNECTIONS, REDIS_SHARD_HOSTS, TRENDING_SHARDS,
+    CATEGORY_UNION_TTL_MS, SCORING_MODE, VELOCITY_WINDOW, VELOCITY_CANDIDATES,
+)
+
+# Pooled asyncio Redis connections; requests share them instead of pinning a worker each
+pools = [aioredis.ConnectionPool(host=host, port=port, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS)
+         for host, port in map(_parse_host, REDIS_SHARD_HOSTS)] \
+    or [aioredis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS)]
+clients = [aioredis.Redis(connection_pool=pool) for pool in pools]
+r = clients[0]
+
+_add_event_script = r.register_script(ADD_EVENT_SCRIPT)
+_union_script = r.register_script(UNION_SCRIPT)
+_page_script = r.register_script(PAGE_SCRIPT)
+_velocity_add_script = r.register_script(VELOCITY_ADD_SCRIPT)
+_velocity_top_script = r.register_script(VELOCITY_TOP_SCRIPT)
+
+# Backends other than the plain Redis store go through their synchronous methods:
+# in-process ones are fast enough to call straight from the event loop, and the
+# rest (e.g. redis_sketch) run on a worker thread.
+_local = None if type(store) is RedisTrendingStore else store
+
+async def _call_local(method, *args, **kwargs):
+    if isinstance(_local, RedisTrendingStore):
+        return await asyncio.to_thread(method, *args, **kwargs)
+    return method(*args, **kwargs)
+
+def shards(key: str):
+    return [(clients[i % len(clients)], shard_key(key, i)) for i in range(TRENDING_SHARDS)]
+
+def _locate(targets, item_id: str):
+    index = shard_index(item_id)
+    return clients[index % len(clients)], _script_keys([shard_key(key, index) for key, _ in targets])
+
+async def add_event(key: str, item_id: str, event_time: int, weight: float = 1.0, categories=()) -> bool:
+    buffer = scoring._buffer
+    if buffer is not None:
+        # Coalesced as in the WSGI app; add() only blocks while the flusher is behind, and then waits off the loop
+        if buffer.backlogged():
+            return await asyncio.to_thread(scoring.add_event, key, item_id, event_time, weight, categories)
+        return scoring.add_event(key, item_id, event_time, weight, categories)
+    await add_events(key, [(item_id, event_time, weight, categories)])
+    return True
+
+async def add_events(key: str, events, chunk_size: int = BATCH_CHUNK_SIZE):
+    now = int(time.time())
+    await asyncio.gather(*(_write_events(event_targets(key, categories), group, now, chunk_size,
+                                         velocity_targets(key, categories) if VELOCITY_WINDOW > 0 else ())
+                           for categories, group in by_categories(events).items()))
+
+async def _write_events(targets, events, now: int, chunk_size: int, velocity=()):
+    if _local is not None:
+        await _call_local(_local.add_events, targets, events, now, velocity)
+        return
+    rates = [rate for _, rate in targets]
+    if len(events) == 1 and not velocity:
+        item_id, event_time, weight = events[0]
+        client, keys = _locate(targets, item_id)
+        with REDIS_LATENCY.time(command="evalsha"):
+            await _add_event_script(keys=keys, args=_event_args(item_id, event_time, weight, now, rates),
+                                    client=client)
+        return
+    by_client = defaultdict(list)
+    for item_id, event_time, weight in events:
+        client, keys = _locate(targets, item_id)
+        by_client[client].append((_add_event_script, keys, _event_args(item_id, event_time, weight, now, rates)))
+    # An item's velocity buckets share its shard index, so they ride in the same pipeline
+    for index, keys, args in _velocity_calls(velocity, events, now, TRENDING_SHARDS):
+        by_client[clients[index % len(clients)]].append((_velocity_add_script, keys, args))
+
+    async def write(client, calls):
+        for start in range(0, len(calls), chunk_size):
+            pipe = client.pipeline(transaction=False)
+            for script, keys, args in calls[start:start + chunk_size]:
+                await script(keys=keys, args=args, client=pipe)
+            with REDIS_LATENCY.time(command="pipeline_add"):
+                await pipe.execute()
+
+    await asyncio.gather(*(write(client, calls) for client, calls in by_client.items()))
+
+async def _queue_page(pipe, skeys: list, start: int, limit: int, cursor, decay_rate: float):
+    if cursor is None:
+        _queue_top(pipe, skeys, limit, start)
+        return
+    for skey in skeys:
+        await _page_script(keys=[skey, _meta_key(skey)], args=[*cursor, limit, SCORING_MODE, decay_rate], client=pipe)
+
+async def _read_top(client, skeys: list, page: tuple) -> list:
+    pipe = client.pipeline(transaction=False)
+    await _queue_page(pipe, skeys, *page)
+    with REDIS_LATENCY.time(command="pipeline_top"):
+        return _split_page(await pipe.execute(), page[2])
+
+async def _read_tracked(key: str, start: int, limit: int) -> list:
+    """Each shard's rows through the synchronous store's tracking cache, reading misses on the async clients."""
+    tracking = store.tracking
+    shard_list = store.shards(key)
+    hits, missing, token = tracking.lookup(shard_list, start, limit)
+    if missing:
+        rows = tracking.read_size(start, limit)
+        by_client = defaultdict(list)
+        for client, skey in missing:
+            # The sync and async client lists follow the same host order
+            by_client[clients[store.clients.index(client) % len(clients)]].append(skey)
+
+        async def read(client, skeys):
+            pipe = client.pipeline(transaction=False)
+            _queue_top(pipe, skeys, rows)
+            with REDIS_LATENCY.time(command="pipeline_top"):
+                return list(zip(skeys, _split_top(await pipe.execute())))
+
+        replies = await asyncio.gather(*(read(client, skeys) for client, skeys in by_client.items()))
+        fetched = dict(pair for reply in replies for pair in reply)
+        tracking.store(missing, token, [fetched[skey] for _, skey in missing], rows)
+        hits.update((skey, (items[start:start + limit], landmark)) for skey, (items, landmark) in fetched.items())
+    return [hits[skey] for _, skey in shard_list]
+
+async def _read_union(client, union_key: str, sources, indexes: list, args: list, page: tuple) -> list:
+    pipe = client.pipeline(transaction=False)
+    for index in indexes:
+        await _union_script(keys=_union_keys(union_key, sources, index, TRENDING_SHARDS), args=args, client=pipe)
+    await _queue_page(pipe, [shard_key(union_key, index) for index in indexes], *page)
+    with REDIS_LATENCY.time(command="pipeline_union"):
+        return _split_page((await pipe.execute())[len(indexes):], page[2])
+
+async def _history_time(key: str, at: int):
+    if _local is not None:
+        return await _call_local(history_time, key, at)
+    taken = await r.zrevrangebyscore(history_index_key(key), at, "-inf", start=0, num=1)
+    return int(taken[0]) if taken else None
+
+async def get_trending(key: str, count: int = 10, window: str = None, categories=(), offset: int = 0, cursor=None,
+                       now: int = None, at: int = None):
+    now = int(time.time()) if now is None else now
+    profile_key, sources, decay_rate = trending_target(key, window, categories)
+    if at is not None:
+        if at < now:
+            taken = await _history_time(sources[0] if sources else profile_key, at)
+            profile_key, sources = at_target(profile_key, sources, at, taken)
+        now = at
+    union = bool(sources)
+    if _local is not None:
+        if union:
+            return await _call_local(_local.top_union, profile_key, sources, count, now, decay_rate,
+                                     offset=offset, cursor=cursor)
+        return await _call_local(_local.top, profile_key, count, now, decay_rate, offset, cursor)
+    start, limit = _page_bounds(TRENDING_SHARDS, count, offset, cursor)
+    if not union and cursor is None and store.tracking is not None:
+        replies = [await _read_tracked(profile_key, start, limit)]
+        return _merge_replies(replies, offset - start + count, now, decay_rate)[offset - start:]
+    page = (start, limit, cursor, decay_rate)
+    by_client = defaultdict(list)
+    for index in range(TRENDING_SHARDS):
+        by_client[clients[index % len(clients)]].append(index)
+    if union:
+        args = [CATEGORY_UNION_TTL_MS, SCORING_MODE, decay_rate, now]
+        reads = [_read_union(client, profile_key, sources, indexes, args, page)
+                 for client, indexes in by_client.items()]
+    else:
+        reads = [_read_top(client, [shard_key(profile_key, index) for index in indexes], page)
+                 for client, indexes in by_client.items()]
+    replies = await asyncio.gather(*reads)
+    return _merge_replies(replies, offset - start + count, now, decay_rate)[offset - start:]
+
+async def get_velocity(key: str, count: int = 10, categories=(), offset: int = 0, now: int = None):
+    now = int(time.time()) if now is None else now
+    velocity_key = velocity_targets(key, categories)[-1]
+    if _local is not None:
+        return await _call_local(_local.top_velocity, velocity_key, count, now, offset)
+    args = [(offset + count) * VELOCITY_CANDIDATES, now // 60, VELOCITY_WINDOW]
+
+    async def read(client, skeys):
+        pipe = client.pipeline(transaction=False)
+        for skey in skeys:
+            await _velocity_top_script(keys=[skey], args=args, client=pipe)
+        with REDIS_LATENCY.time(command="pipeline_velocity_top"):
+            return await pipe.execute()
+
+    by_client = defaultdict(list)
+    for client, skey in shards(velocity_key):
+        by_client[client].append(skey)
+    replies = await asyncio.gather(*(read(client, skeys) for client, skeys in by_client.items()))
+    return rank_velocity(_velocity_pairs(reply for shard_replies in replies for reply in shard_replies), offset, count)
@@ -0,0 +1,173 @@
+import argparse
+import importlib.util
+import logging
+import os
+import signal
+import sys
+import time
+from gunicorn.app.base import BaseApplication
+from constants import (
+    IN_PROCESS_STORE, SERVER_BIND, SERVER_WORKER_CLASS, SERVER_WORKERS, SERVER_THREADS, SERVER_TIMEOUT,
+    SERVER_GRACEFUL_TIMEOUT, SERVER_KEEPALIVE, SERVER_MAX_REQUESTS, SERVER_WARM_CONNECTIONS, SERVER_PIDFILE,
+    LOG_LEVEL, LOG_FORMAT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Production entry point: gunicorn with the worker model taken from the config
+# and the CPU count, instead of app.py's single-threaded dev server.
+#   python serve.py                      # serve in the foreground
+#   python serve.py --worker-class asgi  # app_asgi.py on uvicorn workers
+#   python serve.py reload               # HUP: replace the workers one by one
+#   python serve.py upgrade              # USR2 then TERM: a new master on new code
+#
+# With a shared store the app is imported once in the master (preload) and the
+# workers fork from it, so they start in milliseconds; each then opens its
+# Redis connections before it accepts a request. In-process stores keep their
+# data and job thread inside the one worker, so they are loaded there instead.
+# gevent workers monkey-patch the standard library when they start, after a
+# preloaded app would already hold unpatched sockets, threads and locks, so
+# they load the app themselves too.
+
+# Worker class -> (app, gunicorn worker class)
+WORKER_CLASSES = {
+    "sync": ("app:app", "sync"),
+    "gthread": ("app:app", "gthread"),
+    "gevent": ("app:app", "gevent"),
+    "asgi": ("app_asgi:app", "uvicorn.workers.UvicornWorker"),
+}
+
+def worker_count(worker_class: str, cpus: int = None) -> int:
+    """Workers for `worker_class` on `cpus` CPUs: 2n + 1 processes that block on Redis, n that do not."""
+    if IN_PROCESS_STORE:
+        return 1
+    cpus = cpus or os.cpu_count() or 1
+    return 2 * cpus + 1 if worker_class == "sync" else cpus
+
+def warm_connections(worker_class: str) -> int:
+    # A sync worker serves one request at a time, so it never holds more than one connection
+    return 1 if worker_class == "sync" else SERVER_WARM_CONNECTIONS
+
+def warm_up(worker):
+    """gunicorn post_worker_init hook: open this worker's Redis connections before it accepts requests.
+
+    The ASGI app does the same for its asyncio pools at lifespan startup.
+    """
+    import scoring
+    size = warm_connections(worker.cfg.worker_class_str)
+    start = time.monotonic()
+    opened = 0
+    try:
+        for client in getattr(scoring.store, "clients", []):
+            pool = client.connection_pool
+            connections = [pool.get_connection() for _ in range(size)]
+            for connection in connections:
+                pool.release(connection)
+            opened += len(connections)
+    except Exception as e:
+        logger.warning("Worker %d could not warm its Redis connections: %s", worker.pid, e)
+        return
+    logger.info("Worker %d opened %d Redis connections in %.1fms", worker.pid, opened, (time.monotonic() - start) * 1000)
+
+def preload(worker_class: str) -> bool:
+    """Whether the master imports the app before forking the workers."""
+    return not IN_PROCESS_STORE and worker_class != "gevent"
+
+def server_options(worker_class: str = SERVER_WORKER_CLASS, workers: int = SERVER_WORKERS,
+                   bind: str = SERVER_BIND) -> dict:
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f"unknown worker class {worker_class!r}; choose from {', '.join(WORKER_CLASSES)}")
+    if worker_class == "gevent" and importlib.util.find_spec("gevent") is None:
+        raise ValueError("the gevent worker class needs the gevent package")
+    if IN_PROCESS_STORE and workers > 1:
+        raise ValueError("in-process stores keep their data inside one process; run a single worker")
+    options = {
+        "bind": bind,
+        "worker_class": WORKER_CLASSES[worker_class][1],
+        "workers": workers or worker_count(worker_class),
+        "threads": SERVER_THREADS if worker_class == "gthread" else 1,
+        "preload_app": preload(worker_class),
+        "timeout": SERVER_TIMEOUT,
+        "graceful_timeout": SERVER_GRACEFUL_TIMEOUT,
+        "keepalive": SERVER_KEEPALIVE,
+        "max_requests": SERVER_MAX_REQUESTS,
+        # Spread the restarts out so the workers are not all recycled at once
+        "max_requests_jitter": SERVER_MAX_REQUESTS // 10,
+        "pidfile": SERVER_PIDFILE,
+    }
+    if worker_class != "asgi":
+        options["post_worker_init"] = warm_up
+    return options
+
+class Server(BaseApplication):
+    def __init__(self, app_uri: str, options: dict):
+        self.app_uri = app_uri
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        module, _, name = self.app_uri.partition(":")
+        return getattr(importlib.import_module(module), name)
+
+def _read_pid(pidfile: str) -> int:
+    with open(pidfile) as f:
+        return int(f.read().strip())
+
+def reload(pidfile: str = SERVER_PIDFILE):
+    """Gracefully replace every worker. Preloaded app code is kept; use upgrade() to deploy new code."""
+    os.kill(_read_pid(pidfile), signal.SIGHUP)
+
+def upgrade(pidfile: str = SERVER_PIDFILE, timeout: float = 60.0, settle: float = 5.0):
+    """Start a new master on the current code next to the running one, then stop the old one gracefully.
+
+    Both share the listening socket, so no connection is refused meanwhile. The
+    new master writes "<pidfile>.2" and takes over `pidfile` once the old one exits.
+    """
+    old = _read_pid(pidfile)
+    os.kill(old, signal.SIGUSR2)
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(0.5)
+        try:
+            new = _read_pid(f"{pidfile}.2")
+            break
+        except (OSError, ValueError):
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"no new master after {timeout:.0f}s; {old} keeps serving")
+    # gunicorn has no readiness signal, so give the new workers time to boot and warm up
+    time.sleep(settle)
+    os.kill(old, signal.SIGTERM)
+    logger.info("Upgraded master %d -> %d", old, new)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the decay service with gunicorn")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "reload", "upgrade"])
+    parser.add_argument("--worker-class", default=SERVER_WORKER_CLASS, choices=list(WORKER_CLASSES))
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="0 picks a count from the CPUs")
+    parser.add_argument("--bind", default=SERVER_BIND)
+    parser.add_argument("--pidfile", default=SERVER_PIDFILE)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    if args.command == "reload":
+        reload(args.pidfile)
+        return
+    if args.command == "upgrade":
+        upgrade(args.pidfile)
+        return
+    try:
+        options = server_options(args.worker_class, args.workers, args.bind)
+    except ValueError as e:
+        parser.error(str(e))
+    options["pidfile"] = args.pidfile
+    logger.info("Serving %s on %s with %d %s workers", WORKER_CLASSES[args.worker_class][0], args.bind,
+                options["workers"], args.worker_class)
+    Server(WORKER_CLASSES[args.worker_class][0], options).run()
+
+if __name__ == "__main__":
+    sys.exit(main())
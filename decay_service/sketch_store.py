@@ -0,0 +1,217 @@
+import hashlib
+import math
+import numpy as np
+from scoring import RedisTrendingStore, decayed_scores, _meta_key, _velocity_calls
+from local_store import LocalTrendingStore, _LocalSet
+from metrics import REDIS_LATENCY
+from constants import (
+    SCORING_MODE, LANDMARK_REBASE_EXPONENT, SKETCH_EPSILON, SKETCH_DELTA, SKETCH_TOP_K,
+)
+
+# Approximate heavy-hitter stores for very large item cardinality. Decayed counts
+# go into a Count-Min Sketch of depth x width cells (width = e / SKETCH_EPSILON,
+# depth = ln(1 / SKETCH_DELTA)), and only the SKETCH_TOP_K items with the largest
+# estimates are kept as members, Space-Saving style: an untracked item replaces
+# the current minimum once its estimate exceeds it. Memory is O(width * depth + k)
+# per trending set instead of O(items). Counts are summed forward-decayed
+# weights, so these stores require SCORING_MODE=forward.
+
+def sketch_shape(epsilon: float = SKETCH_EPSILON, delta: float = SKETCH_DELTA) -> tuple:
+    """(depth, width) of a Count-Min Sketch with the given error bounds."""
+    return max(1, math.ceil(math.log(1.0 / delta))), max(1, math.ceil(math.e / epsilon))
+
+def sketch_columns(member: bytes, depth: int, width: int) -> list:
+    """One column per sketch row, from independent 64-bit slices of salted blake2b digests."""
+    columns = []
+    for group in range(0, depth, 8):
+        digest = hashlib.blake2b(member, digest_size=8 * min(8, depth - group), salt=group.to_bytes(16, "little"))
+        data = digest.digest()
+        columns += [int.from_bytes(data[i:i + 8], "little") % width for i in range(0, len(data), 8)]
+    return columns
+
+def _require_forward():
+    if SCORING_MODE != "forward":
+        raise ValueError("sketch stores sum decayed counts and need SCORING_MODE=forward")
+
+class _SketchSet(_LocalSet):
+    """Top-k members plus the Count-Min Sketch their scores are estimated from."""
+
+    __slots__ = ("sketch",)
+
+    def __init__(self, depth: int, width: int):
+        super().__init__()
+        self.sketch = np.zeros((depth, width), dtype=np.float64)
+
+    def rescale(self, factor: float):
+        super().rescale(factor)
+        self.sketch *= factor
+
+    def admit(self, member: bytes, estimate: float, k: int):
+        if member in self.scores or len(self.scores) < k:
+            self.set(member, estimate)
+        elif estimate > -self.index[-1][0]:
+            _, smallest = self.index.pop()
+            del self.scores[smallest]
+            self.set(member, estimate)
+
+class SketchTrendingStore(LocalTrendingStore):
+    """In-process heavy-hitter store; reads, unions and compaction work as in LocalTrendingStore."""
+
+    def __init__(self, k: int = SKETCH_TOP_K, epsilon: float = SKETCH_EPSILON, delta: float = SKETCH_DELTA):
+        _require_forward()
+        super().__init__(max_size=0)
+        self.k = k
+        self.depth, self.width = sketch_shape(epsilon, delta)
+
+    def _new_set(self) -> _SketchSet:
+        return _SketchSet(self.depth, self.width)
+
+    def add_events(self, targets, events, now: int, velocity=()):
+        members = [item_id.encode() for item_id, _, _ in events]
+        times = np.fromiter((event_time for _, event_time, _ in events), dtype=np.int64, count=len(events))
+        weights = np.fromiter((weight for _, _, weight in events), dtype=np.float64, count=len(events))
+        columns = np.array([sketch_columns(member, self.depth, self.width) for member in members],
+                           dtype=np.int64).reshape(len(events), self.depth).T
+        rows = np.arange(self.depth)[:, None]
+        with self._lock:
+            writes = []
+            for key, decay_rate in targets:
+                zset = self._sets.get(key)
+                if zset is None:
+                    zset = self._new_set()
+                if zset.landmark is not None and decay_rate * (now - zset.landmark) >= LANDMARK_REBASE_EXPONENT:
+                    self._rebase(zset, now, decay_rate)
+                scores = decayed_scores(weights, times, now if zset.landmark is None else zset.landmark, decay_rate)
+                # No touched cell can grow by more than the whole batch, so this bound refuses before any write
+                if not math.isfinite(float(np.abs(zset.sketch[rows, columns]).max() + np.abs(scores).sum())):
+                    raise ValueError("event score is not finite")
+                writes.append((key, zset, scores))
+            for key, zset, scores in writes:
+                self._sets.setdefault(key, zset)
+                if zset.landmark is None:
+                    zset.landmark = now
+                for row in range(self.depth):
+                    np.add.at(zset.sketch[row], columns[row], scores)
+                # Estimates after the whole batch: min over the rows of each event's cells
+                estimates = zset.sketch[rows, columns].min(axis=0).tolist()
+                for member, estimate in zip(members, estimates):
+                    zset.admit(member, estimate, self.k)
+                zset.last_updated = now
+            self._log("add", targets, events, now)
+            if velocity:
+                self.add_velocity(velocity, events, now)
+
+    def memory(self, key: str):
+        zset = self._sets.get(key)
+        sketch = zset.sketch.nbytes if isinstance(zset, _SketchSet) else 0
+        return sketch + super().memory(key)
+
+# Adds one event to the sketch and bounded top-k of every profile. Columns are
+# hashed by the caller, so the script needs no hashing of its own.
+# KEYS: top-k sorted set, meta hash and sketch hash of each profile, in triples
+# ARGV: item_id, weight, event_time, now, k, depth, one sketch field per row, then one decay rate per profile
+SKETCH_ADD_SCRIPT = """
+local weight = tonumber(ARGV[2])
+local event_time = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local k = tonumber(ARGV[5])
+local depth = tonumber(ARGV[6])
+for i = 1, #KEYS / 3 do
+    local zset, meta, sketch = KEYS[3 * i - 2], KEYS[3 * i - 1], KEYS[3 * i]
+    local decay_rate = tonumber(ARGV[6 + depth + i])
+    local landmark = tonumber(redis.call('HGET', meta, 'landmark'))
+    if not landmark then
+        landmark = now
+        redis.call('HSET', meta, 'landmark', landmark)
+    end
+    local score = string.format('%.17g', weight * math.exp(decay_rate * (event_time - landmark)))
+    local estimate
+    for row = 1, depth do
+        local count = tonumber(redis.call('HINCRBYFLOAT', sketch, ARGV[6 + row], score))
+        if not estimate or count < estimate then
+            estimate = count
+        end
+    end
+    estimate = string.format('%.17g', estimate)
+    if redis.call('ZSCORE', zset, ARGV[1]) or redis.call('ZCARD', zset) < k then
+        redis.call('ZADD', zset, estimate, ARGV[1])
+    else
+        local smallest = redis.call('ZRANGE', zset, 0, 0, 'WITHSCORES')
+        if tonumber(estimate) > tonumber(smallest[2]) then
+            redis.call('ZREM', zset, smallest[1])
+            redis.call('ZADD', zset, estimate, ARGV[1])
+        end
+    end
+    redis.call('HSET', meta, 'last_updated', now)
+end
+return 1
+"""
+
+# Moves the landmark to `now`, rescaling the top-k scores and every sketch cell.
+# KEYS: top-k sorted set, meta hash, sketch hash
+# ARGV: now, decay_rate
+SKETCH_REBASE_SCRIPT = """
+local landmark = tonumber(redis.call('HGET', KEYS[2], 'landmark'))
+if not landmark then
+    return false
+end
+local factor = math.exp(-tonumber(ARGV[2]) * (tonumber(ARGV[1]) - landmark))
+redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', string.format('%.17g', factor))
+local cells = redis.call('HGETALL', KEYS[3])
+for i = 1, #cells, 2 do
+    redis.call('HSET', KEYS[3], cells[i], string.format('%.17g', tonumber(cells[i + 1]) * factor))
+end
+redis.call('HSET', KEYS[2], 'landmark', ARGV[1])
+return ARGV[1]
+"""
+
+def _sketch_key(key: str) -> str:
+    return f"{key}:sketch"
+
+class RedisSketchStore(RedisTrendingStore):
+    """Heavy-hitter store in Redis: one unsharded top-k sorted set plus a sketch hash per trending set.
+
+    Reads, category unions and compaction run on the top-k set exactly as in
+    RedisTrendingStore.
+    """
+
+    def __init__(self, k: int = SKETCH_TOP_K, epsilon: float = SKETCH_EPSILON, delta: float = SKETCH_DELTA):
+        _require_forward()
+        # Top-k sets are small, so there is nothing to gain from sharding them
+        super().__init__(hosts=[], shard_count=1)
+        self.k = k
+        self.depth, self.width = sketch_shape(epsilon, delta)
+        self._sketch_add_script = self.clients[0].register_script(SKETCH_ADD_SCRIPT)
+        self._sketch_rebase_script = self.clients[0].register_script(SKETCH_REBASE_SCRIPT)
+
+    def add_events(self, targets, events, now: int, velocity=()):
+        keys = [k for key, _ in targets for k in (key, _meta_key(key), _sketch_key(key))]
+        rates = [rate for _, rate in targets]
+        calls = []
+        for item_id, event_time, weight in events:
+            fields = [f"{row}:{column}" for row, column in
+                      enumerate(sketch_columns(item_id.encode(), self.depth, self.width))]
+            calls.append((self._sketch_add_script, keys,
+                          [item_id, weight, event_time, now, self.k, self.depth, *fields, *rates]))
+        # Velocity sets are unsharded here too, so their buckets go in the same pipeline
+        calls += [(self._velocity_add_script, script_keys, args)
+                  for _, script_keys, args in _velocity_calls(velocity, events, now, self.shard_count)]
+        client = self.clients[0]
+        for start in range(0, len(calls), self.chunk_size):
+            pipe = client.pipeline(transaction=False)
+            for script, script_keys, args in calls[start:start + self.chunk_size]:
+                script(keys=script_keys, args=args, client=pipe)
+            with REDIS_LATENCY.time(command="pipeline_add"):
+                pipe.execute()
+
+    def _rebase_shard(self, client, key: str, now: int, decay_rate: float):
+        landmark = self._sketch_rebase_script(keys=[key, _meta_key(key), _sketch_key(key)], args=[now, decay_rate],
+                                              client=client)
+        return None if landmark is None else now
+
+    def delete(self, key: str):
+        self.clients[0].delete(key, _meta_key(key), _sketch_key(key))
+
+    def memory(self, key: str):
+        client = self.clients[0]
+        return sum(client.memory_usage(k) or 0 for k in (key, _meta_key(key), _sketch_key(key)))
@@ -0,0 +1,226 @@
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+import msgspec
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Warm restart for the in-process stores (local, sketch).
+#
+# A snapshot is one binary file: an 8-byte magic, the length of a JSON header,
+# the header, then 8-byte aligned sections. Members are interned into one table
+# shared by every set (uint64 end offsets into a byte blob), and each set is a
+# uint32 array of member ids plus a float64 array of stored scores in rank order.
+# Mapping the file takes milliseconds and top-k rows can be read straight from
+# np.frombuffer views of it, so a restarted process answers reads while the
+# dicts and rank indexes are rebuilt behind it. Every mutation after the
+# snapshot goes to an append-only delta log (delta-<seq>.log) of length-prefixed
+# msgpack records that restore() replays on top of it.
+
+MAGIC = b"DKSNAP01"
+SNAPSHOT_FILE = "trending.snap"
+_HEAD = struct.Struct("<8sQ")
+_FRAME = struct.Struct("<I")
+
+def _pad(size: int) -> int:
+    return (size + 7) & ~7
+
+def _log_path(directory: str, seq: int) -> str:
+    return os.path.join(directory, f"delta-{seq:012d}.log")
+
+def _log_seqs(directory: str) -> list:
+    return sorted(int(os.path.basename(path)[6:-4]) for path in glob.glob(os.path.join(directory, "delta-*.log")))
+
+class DeltaLog:
+    """Append-only journal of store mutations, rotated to a new file at every snapshot.
+
+    Records are written straight to the file descriptor, so they survive a
+    process crash; they are not fsynced, so a power loss can drop the tail.
+    """
+
+    def __init__(self, directory: str, seq: int):
+        self.directory = directory
+        self.seq = seq
+        self._encoder = msgspec.msgpack.Encoder()
+        self._fd = os.open(_log_path(directory, seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def append(self, record):
+        data = self._encoder.encode(record)
+        os.write(self._fd, _FRAME.pack(len(data)) + data)
+
+    def rotate(self) -> int:
+        os.close(self._fd)
+        self.seq += 1
+        self._fd = os.open(_log_path(self.directory, self.seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return self.seq
+
+    def close(self):
+        os.close(self._fd)
+
+def read_log(path: str):
+    """Yield the records of one delta log, stopping at a record torn by a crash."""
+    with open(path, "rb") as f:
+        data = f.read()
+    decoder = msgspec.msgpack.Decoder()
+    pos = 0
+    while pos + _FRAME.size <= len(data):
+        (size,) = _FRAME.unpack_from(data, pos)
+        end = pos + _FRAME.size + size
+        if end > len(data):
+            break
+        yield decoder.decode(data[pos + _FRAME.size:end])
+        pos = end
+
+def write_snapshot(store, directory: str) -> dict:
+    """Snapshot `store` atomically and drop the delta logs it makes redundant; returns some stats."""
+    start = time.monotonic()
+    seq, sets, rings = store.capture()
+    interned = {}
+    sections = []
+    size = 0
+
+    def section(data) -> int:
+        nonlocal size
+        offset = size
+        data = memoryview(data).cast("B")
+        sections.append(data)
+        sections.append(b"\0" * (_pad(len(data)) - len(data)))
+        size += _pad(len(data))
+        return offset
+
+    entries = []
+    for key, landmark, last_updated, rows, sketch in sets:
+        ids = np.fromiter((interned.setdefault(member, len(interned)) for _, member in rows),
+                          dtype=np.uint32, count=len(rows))
+        scores = -np.fromiter((score for score, _ in rows), dtype=np.float64, count=len(rows))
+        entry = {"key": key, "landmark": landmark, "last_updated": last_updated, "count": len(rows),
+                 "ids": section(ids), "scores": section(scores), "sketch": None}
+        if sketch is not None:
+            entry["sketch"] = [section(np.ascontiguousarray(sketch, dtype=np.float64)), *sketch.shape]
+        entries.append(entry)
+    members = list(interned)
+    ends = np.cumsum(np.fromiter(map(len, members), dtype=np.uint64, count=len(members)), dtype=np.uint64)
+    velocity = msgspec.msgpack.encode(rings)
+    header = msgspec.json.encode({
+        "log_seq": seq, "created": time.time(), "sets": entries,
+        "members": {"count": len(members), "ends": section(ends), "blob": section(b"".join(members))},
+        # Velocity rings are small (recently active items only), so they are one msgpack blob
+        "velocity": [section(velocity), len(velocity)],
+    })
+
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, len(header)))
+        f.write(header + b"\0" * (_pad(len(header)) - len(header)))
+        for data in sections:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    for old in _log_seqs(directory):
+        if old < seq:
+            os.remove(_log_path(directory, old))
+    return {"sets": len(entries), "members": len(members), "bytes": os.path.getsize(path),
+            "seconds": time.monotonic() - start}
+
+class SnapshotView:
+    """A mapped snapshot file, readable in place before the store is rebuilt from it."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            # Copy-on-write: sketch arrays stay views of the mapping until they are written to
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, header_size = _HEAD.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trending snapshot")
+        header = msgspec.json.decode(self._mm[_HEAD.size:_HEAD.size + header_size])
+        self._base = _HEAD.size + _pad(header_size)
+        self.log_seq = header["log_seq"]
+        self.sets = {entry["key"]: entry for entry in header["sets"]}
+        self._velocity = header["velocity"]
+        table = header["members"]
+        self._ends = self._array(np.uint64, table["ends"], table["count"])
+        self._blob = self._base + table["blob"]
+
+    def _array(self, dtype, offset: int, count: int):
+        return np.frombuffer(self._mm, dtype=dtype, count=count, offset=self._base + offset)
+
+    def _rank_arrays(self, entry: dict, start: int = 0, stop: int = None):
+        stop = entry["count"] if stop is None else min(stop, entry["count"])
+        start = min(start, stop)
+        return (self._array(np.uint32, entry["ids"] + 4 * start, stop - start),
+                self._array(np.float64, entry["scores"] + 8 * start, stop - start))
+
+    def top(self, key: str, start: int, count: int):
+        """Rows start..start+count of `key` as (member, stored score) plus its landmark, or None if absent."""
+        entry = self.sets.get(key)
+        if entry is None:
+            return None
+        ids, scores = self._rank_arrays(entry, start, start + count)
+        ends = self._ends
+        rows = [(self._mm[self._blob + (int(ends[i - 1]) if i else 0):self._blob + int(ends[i])], score)
+                for i, score in zip(ids.tolist(), scores.tolist())]
+        return rows, entry["landmark"]
+
+    def load_into(self, store):
+        """Materialize every set into `store`, sharing one bytes object per member across sets."""
+        ends = self._ends.tolist()
+        blob = self._mm[self._blob:self._blob + (ends[-1] if ends else 0)]
+        members = [blob[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        for key, entry in self.sets.items():
+            ids, scores = self._rank_arrays(entry)
+            sketch = None
+            if entry["sketch"] is not None:
+                offset, depth, width = entry["sketch"]
+                sketch = self._array(np.float64, offset, depth * width).reshape(depth, width)
+            store.load_set(key, entry["landmark"], entry["last_updated"], [members[i] for i in ids.tolist()],
+                           scores.tolist(), sketch)
+        offset, size = self._velocity
+        now = int(time.time())
+        for key, rings in msgspec.msgpack.decode(self._mm[self._base + offset:self._base + offset + size]).items():
+            store.load_velocity(key, rings, now)
+
+def _read_logs(directory: str, seq: int) -> tuple:
+    """(every record of the delta logs from `seq` on, in order; the next log sequence to write)."""
+    seqs = [old for old in _log_seqs(directory) if old >= seq]
+    records = [record for old in seqs for record in read_log(_log_path(directory, old))]
+    # A crash may have torn the tail of the last log, so appending continues in a new one
+    return records, max(seqs + [seq]) + 1
+
+def restore(store, directory: str, background: bool = True) -> dict:
+    """Rebuild `store` from the snapshot and delta logs in `directory`, then journal to a fresh log.
+
+    With `background`, this returns as soon as the snapshot is mapped and the
+    logs are read: top-k reads of sets no log record changed are answered from
+    the mapping while a thread rebuilds the store and replays the logs; writes
+    and reads of the changed sets wait for it.
+    """
+    start = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    view = SnapshotView(path) if os.path.exists(path) else None
+    records, next_seq = _read_logs(directory, view.log_seq if view else 0)
+    stats = {"sets": len(view.sets) if view else 0, "replayed": len(records)}
+
+    def rebuild():
+        if view is not None:
+            view.load_into(store)
+        for record in records:
+            store.replay(record)
+        store.journal = DeltaLog(directory, next_seq)
+        stats["rebuild_seconds"] = time.monotonic() - start
+        logger.info("Rebuilt store from %s: %d sets, %d journal records replayed in %.3fs", directory,
+                    stats["sets"], stats["replayed"], stats["rebuild_seconds"])
+
+    if background and view is not None:
+        # The mapping is as of the snapshot, so it must not answer for sets changed since
+        store.warm_start(view, {key for record in records for key in store.record_keys(record)}, rebuild)
+    else:
+        rebuild()
+    stats["seconds"] = time.monotonic() - start
+    return stats
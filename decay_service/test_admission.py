@@ -0,0 +1,99 @@
+import falcon
+import falcon.testing
+import pytest
+import redis
+from admission import AdmissionMiddleware, RedisTokenBuckets, TokenBuckets
+
+NOW = 1_700_000_000.0
+
+@pytest.fixture(params=["local", "redis"])
+def buckets(request):
+    if request.param == "local":
+        return TokenBuckets(rate=2.0, burst=3.0, max_clients=100)
+    request.getfixturevalue("fake_redis")
+    return RedisTokenBuckets(key="trending", rate=2.0, burst=3.0, max_clients=100)
+
+def test_burst_then_refill(buckets):
+    assert [buckets.take("ip:1", NOW) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Empty: the next token is half a second away at 2 per second
+    assert buckets.take("ip:1", NOW) == pytest.approx(0.5)
+    assert buckets.take("ip:1", NOW + 0.25) == pytest.approx(0.25)
+    assert buckets.take("ip:1", NOW + 0.5) == 0.0
+    # Other clients have their own buckets
+    assert buckets.take("ip:2", NOW + 0.5) == 0.0
+
+def test_idle_bucket_fills_up_to_the_burst(buckets):
+    for _ in range(3):
+        buckets.take("key:a", NOW)
+    waits = [buckets.take("key:a", NOW + 60) for _ in range(4)]
+    assert waits[:3] == [0.0, 0.0, 0.0] and waits[3] == pytest.approx(0.5)
+
+def test_least_recent_clients_are_forgotten():
+    buckets = TokenBuckets(rate=1.0, burst=1.0, max_clients=2)
+    buckets.take("ip:1", NOW)
+    buckets.take("ip:2", NOW)
+    buckets.take("ip:3", NOW)
+    # ip:1 was dropped, so it starts over with a full bucket
+    assert buckets.take("ip:1", NOW) == 0.0
+    assert buckets.take("ip:3", NOW) > 0
+
+def test_redis_buckets_are_shared_and_outside_the_tracked_prefix(fake_redis):
+    first = RedisTokenBuckets(key="trending", rate=1.0, burst=2.0)
+    second = RedisTokenBuckets(key="trending", rate=1.0, burst=2.0)
+    assert first.take("ip:1", NOW) == 0.0
+    assert second.take("ip:1", NOW) == 0.0
+    assert first.take("ip:1", NOW) > 0
+    assert first.client.keys("*") == [b"ratelimit:trending:ip:1"]
+
+def test_redis_failure_falls_back_to_local_buckets(fake_redis, monkeypatch):
+    buckets = RedisTokenBuckets(key="trending", rate=1.0, burst=1.0)
+
+    def down(**kwargs):
+        raise redis.ConnectionError("down")
+
+    monkeypatch.setattr(buckets, "_script", down)
+    assert buckets.take("ip:1", NOW) == 0.0
+    assert buckets.take("ip:1", NOW) > 0
+
+class Accepted:
+    def on_post(self, req, resp):
+        resp.media = {"message": "ok"}
+
+    def on_get(self, req, resp):
+        resp.media = []
+
+def client(middleware) -> falcon.testing.TestClient:
+    app = falcon.App(middleware=[middleware])
+    app.add_route("/add_event", Accepted())
+    app.add_route("/trending", Accepted())
+    return falcon.testing.TestClient(app)
+
+def test_rate_limited_writes_get_429():
+    api = client(AdmissionMiddleware(TokenBuckets(rate=0.5, burst=2.0), max_in_flight=0, api_keys={"k1", "k2"}))
+    headers = {"X-API-Key": "k1"}
+    assert [api.simulate_post("/add_event", headers=headers).status_code for _ in range(3)] == [200, 200, 429]
+    limited = api.simulate_post("/add_event", headers=headers)
+    assert limited.json == {"error": "rate limit exceeded"}
+    assert limited.headers["Retry-After"] == "2"
+    # Another key, and every read, are still served
+    assert api.simulate_post("/add_event", headers={"X-API-Key": "k2"}).status_code == 200
+    assert api.simulate_get("/trending", headers=headers).status_code == 200
+
+def test_unknown_api_keys_share_the_bucket_of_their_address():
+    api = client(AdmissionMiddleware(TokenBuckets(rate=0.5, burst=2.0), max_in_flight=0, api_keys={"k1"}))
+    statuses = [api.simulate_post("/add_event", headers={"X-API-Key": f"made-up-{i}"}).status_code for i in range(3)]
+    assert statuses == [200, 200, 429]
+    assert api.simulate_post("/add_event").status_code == 429
+    assert api.simulate_post("/add_event", headers={"X-API-Key": "k1"}).status_code == 200
+
+def test_writes_beyond_max_in_flight_are_shed():
+    middleware = AdmissionMiddleware(TokenBuckets(rate=100.0, burst=100.0), max_in_flight=1, wait_ms=0)
+    api = client(middleware)
+    assert api.simulate_post("/add_event").status_code == 200
+    # Hold the only slot, as a request still being served would
+    middleware._slots.acquire()
+    shed = api.simulate_post("/add_event")
+    assert shed.status_code == 503 and shed.headers["Retry-After"] == "1"
+    assert api.simulate_get("/trending").status_code == 200
+    middleware._slots.release()
+    assert api.simulate_post("/add_event").status_code == 200
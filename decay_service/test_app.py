@@ -0,0 +1,93 @@
+import json
+import time
+import falcon.testing
+import pytest
+import app
+import dedup
+import local_store
+import payloads
+import scoring
+from constants import MAX_EVENT_WEIGHT
+
+# Scores are read at the wall clock, so they can be a few seconds of decay below the weights
+NOW = int(time.time())
+
+@pytest.fixture
+def api(store) -> falcon.testing.TestClient:
+    return falcon.testing.TestClient(app.app)
+
+def event(item_id, weight=1.0, **fields) -> dict:
+    return {"item_id": item_id, "event_time": NOW, "weight": weight, **fields}
+
+def trending(api, count=10) -> dict:
+    return {row["item_id"]: row["score"] for row in api.simulate_get("/trending", params={"count": count}).json}
+
+def test_batch_writes_valid_events_and_reports_the_rest(api):
+    body = [event("a", 2.0), {"item_id": "b"}, event("c"), event("a", 1.0)]
+    result = api.simulate_post("/add_events", json=body)
+    assert result.status_code == 200
+    assert result.json["added"] == 3 and result.json["duplicates"] == 0
+    assert [error["index"] for error in result.json["errors"]] == [1]
+    assert trending(api) == pytest.approx({"a": 3.0, "c": 1.0}, rel=1e-2)
+
+def test_batch_accepts_ndjson(api):
+    body = "\n".join(json.dumps(event(item)) for item in ("a", "b")) + "\n\nnot json\n"
+    result = api.simulate_post("/add_events", body=body, headers={"Content-Type": "application/x-ndjson"})
+    assert result.status_code == 200
+    assert result.json["added"] == 2 and [error["index"] for error in result.json["errors"]] == [2]
+    assert set(trending(api)) == {"a", "b"}
+
+def test_batch_of_only_invalid_events_is_a_400(api):
+    result = api.simulate_post("/add_events", json=[{"item_id": "a"}, {"event_time": NOW}])
+    assert result.status_code == 400 and result.json["added"] == 0
+    assert api.simulate_post("/add_events", body=b"[{").status_code == 400
+
+def test_oversized_batch_is_a_413(api, monkeypatch):
+    monkeypatch.setattr(app, "MAX_BATCH_EVENTS", 2)
+    result = api.simulate_post("/add_events", json=[event("a"), event("b"), event("c")])
+    assert result.status_code == 413
+    assert trending(api) == {}
+
+def test_weights_beyond_the_bound_are_rejected(api):
+    assert api.simulate_post("/add_event", json=event("a", MAX_EVENT_WEIGHT)).status_code == 200
+    refused = api.simulate_post("/add_event", json=event("b", -2 * MAX_EVENT_WEIGHT))
+    assert refused.status_code == 400 and "weight" in refused.json["error"]
+    result = api.simulate_post("/add_events", json=[event("c", 1e308), event("c")])
+    assert result.json["added"] == 1 and [error["index"] for error in result.json["errors"]] == [0]
+
+def test_velocity_ranks_items_by_their_rise(api, monkeypatch):
+    for module in (scoring, payloads, local_store):
+        monkeypatch.setattr(module, "VELOCITY_WINDOW", 5)
+    api.simulate_post("/add_events", json=[event("a"), event("a"), event("a"), event("b")])
+    rows = api.simulate_get("/trending", params={"mode": "velocity"}).json
+    assert [row["item_id"] for row in rows] == ["a", "b"]
+    assert rows[0]["score"] == pytest.approx(3 * rows[1]["score"])
+
+@pytest.mark.parametrize("params", [
+    {"mode": "velocity", "window": "1h"}, {"mode": "velocity", "category": "a,b"}, {"mode": "sideways"},
+    {"count": "0"}, {"count": "x"}, {"offset": "-1"},
+])
+def test_invalid_trending_queries_are_a_400(api, params):
+    result = api.simulate_get("/trending", params=params)
+    assert result.status_code == 400 and result.json["error"]
+
+def test_retries_of_buffered_events_are_not_refused(api, store, monkeypatch):
+    monkeypatch.setattr(dedup, "bloom", dedup.BloomFilter(window=60, capacity=1000, error_rate=0.001))
+    body = event("a", event_id="e1")
+    assert api.simulate_post("/add_event", json=body).json.get("duplicate") is None
+    assert api.simulate_post("/add_event", json=body).json["duplicate"]
+    # Buffered, the write only happens at the flush, which fails here
+    add_events, failures = store.add_events, [ConnectionError("down")]
+
+    def flaky(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        add_events(*args, **kwargs)
+
+    monkeypatch.setattr(store, "add_events", flaky)
+    for attempt in range(2):
+        buffer = scoring.CoalescingBuffer(window_ms=500)
+        monkeypatch.setattr(scoring, "_buffer", buffer)
+        assert api.simulate_post("/add_event", json=event("b", event_id="e2")).json.get("duplicate") is None
+        buffer.close()
+    assert set(trending(api)) == {"a", "b"}
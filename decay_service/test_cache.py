@@ -0,0 +1,102 @@
+import asyncio
+import json
+import threading
+import time
+from cache import AsyncTrendingCache, TrendingCache
+
+ROWS = [(f"item{i}", float(100 - i)) for i in range(20)]
+
+def serialize(rows) -> bytes:
+    return json.dumps(rows).encode()
+
+class Loader:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, key, count):
+        self.calls.append((key, count))
+        return ROWS[:count]
+
+def test_every_count_up_to_max_k_is_sliced_from_one_load():
+    loader = Loader()
+    cache = TrendingCache(loader, serialize, ttl_ms=60_000, max_k=10)
+    assert json.loads(cache.get("all", 3)) == [list(row) for row in ROWS[:3]]
+    assert json.loads(cache.get("all", 10)) == [list(row) for row in ROWS[:10]]
+    assert cache.get("all", 3) is cache.get("all", 3)
+    assert loader.calls == [("all", 10)]
+    assert (cache.hits, cache.misses) == (3, 1)
+    # Larger counts, and other keys, are loaded on their own
+    cache.get("all", 11)
+    cache.get("news", 3)
+    assert loader.calls[1:] == [("all", 11), ("news", 10)]
+
+def test_expired_entries_are_reloaded(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    loader = Loader()
+    cache = TrendingCache(loader, serialize, ttl_ms=500, max_k=10)
+    cache.get("all", 3)
+    clock[0] += 0.4
+    cache.get("all", 3)
+    clock[0] += 0.2
+    cache.get("all", 3)
+    assert len(loader.calls) == 2
+
+def test_disabled_cache_loads_every_time():
+    loader = Loader()
+    cache = TrendingCache(loader, serialize, ttl_ms=0, max_k=10)
+    cache.get("all", 3)
+    cache.get("all", 3)
+    assert loader.calls == [("all", 3), ("all", 3)]
+
+def test_stale_entry_is_served_while_one_caller_reloads(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    entered, release = threading.Event(), threading.Event()
+    loader = Loader()
+    cache = TrendingCache(loader, serialize, ttl_ms=500, max_k=10)
+    stale = cache.get("all", 3)
+
+    def slow_loader(key, count):
+        entered.set()
+        release.wait(5)
+        return loader(key, count)
+
+    cache.loader = slow_loader
+    clock[0] += 1
+    reloader = threading.Thread(target=cache.get, args=("all", 3))
+    reloader.start()
+    assert entered.wait(5)
+    # The reload is held, so other callers get the expired rows without waiting
+    assert cache.get("all", 3) is stale
+    release.set()
+    reloader.join(5)
+    assert len(loader.calls) == 2
+
+def test_async_cache_loads_each_key_once():
+    loader = Loader()
+
+    async def load(key, count):
+        await asyncio.sleep(0.01)
+        return loader(key, count)
+
+    async def main():
+        cache = AsyncTrendingCache(load, serialize, ttl_ms=60_000, max_k=10)
+        replies = await asyncio.gather(*(cache.get("all", 3) for _ in range(5)))
+        return cache, replies
+
+    cache, replies = asyncio.run(main())
+    assert len(set(replies)) == 1
+    assert loader.calls == [("all", 10)]
+    assert cache.misses == 1
+
+def test_least_recently_refreshed_keys_are_evicted():
+    loader = Loader()
+    cache = TrendingCache(loader, serialize, ttl_ms=60_000, max_k=10, max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        cache.get(key, 3)
+    # A hit does not count as a refresh, so "a" goes first
+    assert list(cache._entries) == ["b", "c"] and sorted(cache._locks) == ["b", "c"]
+    cache.get("a", 3)
+    assert loader.calls == [("a", 10), ("b", 10), ("c", 10), ("a", 10)]
+    assert list(cache._entries) == ["c", "a"]
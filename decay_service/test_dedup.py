@@ -0,0 +1,79 @@
+import time
+import pytest
+import dedup
+from dedup import BloomFilter, RedisBloomFilter, bloom_offsets, bloom_size, remember, split_duplicates
+
+NOW = 1_700_000_000
+
+def event(item_id: str, event_id=None):
+    return (item_id, NOW, 1.0, (), event_id)
+
+@pytest.fixture(params=["local", "redis"])
+def bloom(request, monkeypatch):
+    if request.param == "local":
+        bloom = BloomFilter(window=60, capacity=1000, error_rate=0.001)
+    else:
+        request.getfixturevalue("fake_redis")
+        bloom = RedisBloomFilter(key="trending", window=60, capacity=1000, error_rate=0.001)
+    monkeypatch.setattr(dedup, "bloom", bloom)
+    return bloom
+
+def offsets(bloom, *event_ids) -> list:
+    return [bloom_offsets(event_id, bloom.bits, bloom.hashes) for event_id in event_ids]
+
+def test_bloom_size_meets_the_error_rate():
+    bits, hashes = bloom_size(1000, 0.01)
+    # Each of the two live filters gets about half the error budget
+    per_filter = (1 - (1 - 1 / bits) ** (hashes * 1000)) ** hashes
+    assert 1 - (1 - per_filter) ** 2 <= 0.011
+    assert all(0 <= o < bits for o in bloom_offsets("some-event", bits, hashes))
+    assert bloom_offsets("some-event", bits, hashes) == bloom_offsets("some-event", bits, hashes)
+
+def test_ids_are_remembered_for_one_to_two_windows(bloom):
+    start = NOW - NOW % bloom.window
+    bloom.add(offsets(bloom, "a"), start + 59)
+    assert bloom.contains(offsets(bloom, "a", "b"), start + 59) == [True, False]
+    assert bloom.contains(offsets(bloom, "a"), start + 60 + 59) == [True]
+    assert bloom.contains(offsets(bloom, "a"), start + 120) == [False]
+
+def test_redis_filters_live_outside_the_tracked_prefix(fake_redis):
+    bloom = RedisBloomFilter(key="trending", window=60, capacity=1000, error_rate=0.001)
+    bloom.add(offsets(bloom, "a"), NOW)
+    assert bloom.client.keys("*") == [f"dedup:trending:{NOW // bloom.window}".encode()]
+    assert 0 < bloom.client.ttl(f"dedup:trending:{NOW // bloom.window}") <= 2 * bloom.window
+
+def test_split_keeps_the_first_copy_of_each_unseen_id(bloom):
+    events = [event("a", "e1"), event("b", "e2"), event("a", "e1"), event("c"), event("c")]
+    fresh, dropped = split_duplicates(events)
+    assert fresh == [events[0], events[1], events[3], events[4]]
+    assert dropped == 1
+
+def test_only_written_ids_count_as_duplicates(bloom):
+    events = [event("a", "e1"), event("b", "e2")]
+    # Checked but never remembered, e.g. the write failed: the retry is accepted
+    assert split_duplicates(events) == (events, 0)
+    fresh, _ = split_duplicates(events)
+    remember(fresh[:1])
+    assert split_duplicates(events) == ([events[1]], 1)
+
+def test_everything_passes_without_dedup(monkeypatch):
+    monkeypatch.setattr(dedup, "bloom", None)
+    events = [event("a", "e1"), event("a", "e1")]
+    assert split_duplicates(events) == (events, 0)
+    remember(events)
+
+def test_remember_only_logs_a_failing_store(bloom, monkeypatch, caplog):
+    def fail(offsets, now):
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(bloom, "add", fail)
+    remember([event("a", "e1")])
+    assert "Remembering 1 event ids failed" in caplog.text
+
+def test_split_uses_the_arrival_time(bloom, monkeypatch):
+    clock = [NOW - NOW % bloom.window]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    remember([event("a", "e1")])
+    assert split_duplicates([event("a", "e1")])[1] == 1
+    clock[0] += 2 * bloom.window
+    assert split_duplicates([event("a", "e1")])[1] == 0
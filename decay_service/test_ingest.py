@@ -0,0 +1,68 @@
+import json
+import time
+import pytest
+import ingest
+from ingest import batch_events, load_checkpoint, parse_lines, tail_file, write_batches
+from scoring import get_trending
+
+NOW = int(time.time())
+
+def line(item_id: str) -> bytes:
+    return json.dumps({"item_id": item_id, "event_time": NOW}).encode() + b"\n"
+
+def test_tail_reads_complete_lines_from_the_offset(tmp_path):
+    path = tmp_path / "events.ndjson"
+    path.write_bytes(line("a") + line("b") + b'{"item_id": "c"')
+    read = list(tail_file(str(path), follow=False))
+    assert [item for item, _ in read] == [line("a"), line("b")]
+    inode, offset = read[-1][1]
+    assert offset == len(line("a") + line("b"))
+    # The partial line is read once it is complete
+    with open(path, "ab") as f:
+        f.write(b', "event_time": 1}\n')
+    assert [item for item, _ in tail_file(str(path), inode, offset, follow=False)] == [b'{"item_id": "c", "event_time": 1}\n']
+
+def test_tail_starts_over_on_a_replaced_or_truncated_file(tmp_path):
+    path = tmp_path / "events.ndjson"
+    path.write_bytes(line("new"))
+    inode = path.stat().st_ino
+    # A checkpoint past the end of the file, or of another inode, belongs to an older file
+    assert len(list(tail_file(str(path), inode, 10_000, follow=False))) == 1
+    assert len(list(tail_file(str(path), inode + 1, len(line("new")), follow=False))) == 1
+    assert list(tail_file(str(path), inode, len(line("new")), follow=False)) == []
+
+def test_batches_close_on_size_and_move_past_invalid_lines():
+    items = [(line("a"), 1), (b"not json\n", 2), (line("b"), 3), None, (b"{}\n", 4), None, (line("c"), 5)]
+    batches = list(batch_events(parse_lines(items), max_size=2, max_wait_ms=60_000))
+    assert [([event[0] for event in events], position) for events, position in batches] == [
+        (["a", "b"], 3), ([], 4), (["c"], 5)]
+
+def test_batches_close_after_the_wait():
+    items = iter([(line("a"), 1), None])
+    batches = batch_events(parse_lines(items), max_size=100, max_wait_ms=0)
+    assert [(len(events), position) for events, position in batches] == [(1, 1)]
+
+def test_write_retries_until_the_store_accepts_then_checkpoints(store, tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / "events.offset")
+    failures = [ConnectionError("down")]
+    add_events = ingest.add_events
+
+    def flaky(key, events):
+        if failures:
+            raise failures.pop()
+        add_events(key, events)
+
+    monkeypatch.setattr(ingest, "add_events", flaky)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    events = list(parse_lines([(line("a"), (7, 10)), (line("b"), (7, 20))]))
+    write_batches([([event for event, _ in events], (7, 20))], "trending", checkpoint)
+    assert sorted(member for member, _ in get_trending("trending", 10, now=NOW)) == [b"a", b"b"]
+    assert load_checkpoint(checkpoint) == (7, 20)
+    assert not failures
+
+@pytest.mark.parametrize("text", ["", "{", '{"offset": 3}'])
+def test_missing_or_broken_checkpoints_start_from_the_beginning(tmp_path, text):
+    path = tmp_path / "events.offset"
+    if text:
+        path.write_text(text)
+    assert load_checkpoint(str(path)) == (None, 0)
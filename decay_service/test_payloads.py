@@ -0,0 +1,45 @@
+import json
+import pytest
+from payloads import encode_cursor, parse_batch, parse_categories, parse_cursor, parse_event, serialize_trending
+
+NOW = 1_700_000_000
+
+def test_event_fields_are_decoded_and_coerced():
+    body = b'{"item_id": 42, "event_time": "1700000000", "weight": "2.5", "category": "news,sports", "event_id": 7}'
+    assert parse_event(body, NOW) == ("42", NOW, 2.5, ("news", "sports"), "7")
+    # Decoded objects (batch lines already split out) go through the same checks
+    assert parse_event({"item_id": "a", "event_time": NOW}, NOW) == ("a", NOW, 1.0, (), None)
+
+@pytest.mark.parametrize("body, error", [
+    (b'{"item_id": "a"}', "item_id and event_time are required"),
+    (b'{"item_id": "", "event_time": 1}', "item_id and event_time are required"),
+    (b'[1, 2]', "event must be a JSON object"),
+    (b'{"item_id": "a", "event_time": 1', "event must be a JSON object"),
+    (b'{"item_id": "a", "event_time": 1, "weight": "nan"}', "weight must be a finite number"),
+    (b'{"item_id": "a", "event_time": 1, "weight": "x"}', "weight"),
+    (b'{"item_id": "a", "event_time": 1700009999}', "in the future"),
+    (b'{"item_id": "a", "event_time": 1, "category": "no spaces"}', "invalid category"),
+])
+def test_invalid_events_raise_value_error(body, error):
+    with pytest.raises(ValueError, match=error):
+        parse_event(body, NOW)
+
+def test_categories_are_deduplicated_in_order():
+    assert parse_categories(" b, a ,b,,") == ("b", "a")
+    assert parse_categories(["x", "x"]) == ("x",)
+    with pytest.raises(ValueError):
+        parse_categories([1])
+
+def test_batch_splits_arrays_and_ndjson_without_decoding_events():
+    events = parse_batch(b'[{"item_id": "a", "event_time": 1}, {"bad": true}]')
+    assert [json.loads(bytes(event)) for event in events] == [{"item_id": "a", "event_time": 1}, {"bad": True}]
+    assert parse_batch(b'{"item_id": "a"}\n\nnot json\n', "application/x-ndjson") == [b'{"item_id": "a"}', b"not json"]
+    with pytest.raises(ValueError):
+        parse_batch(b"[{")
+
+def test_trending_rows_and_cursors_round_trip():
+    rows = [(b"a", 2.123456789), (b"b", 1.0)]
+    assert json.loads(serialize_trending(rows)) == [{"item_id": "a", "score": 2.123457}, {"item_id": "b", "score": 1.0}]
+    assert parse_cursor(encode_cursor(rows[0], NOW)) == (2.123456789, NOW, "a")
+    with pytest.raises(ValueError, match="invalid cursor"):
+        parse_cursor("not-a-cursor")
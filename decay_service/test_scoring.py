@@ -0,0 +1,309 @@
+import math
+import os
+import time
+import pytest
+import redis
+import scoring
+from local_store import LocalTrendingStore
+from scoring import (
+    TrackingCache, add_events, compact, decayed_score, get_trending, rebase_landmark, maybe_rebase_landmark,
+    record_history,
+)
+from constants import DECAY_RATE, LANDMARK_REBASE_EXPONENT, _parse_profiles
+
+KEY = "trending"
+# add_events stamps landmarks with the wall clock, so reads are made around it
+NOW = int(time.time())
+
+def page_through(count: int, now: int, between=None) -> list:
+    """Every row of KEY, `count` at a time by cursor, calling between(page number) after each page."""
+    rows, cursor, page = [], None, 0
+    # A cursor that jumps back would page forever
+    while len(rows) <= 1000:
+        batch = get_trending(KEY, count, cursor=cursor, now=now)
+        rows.extend(batch)
+        if len(batch) < count:
+            return rows
+        member, score = batch[-1]
+        cursor = (score, now, member.decode())
+        page += 1
+        if between is not None:
+            between(page)
+    return rows
+
+def members(rows) -> list:
+    return [member.decode() for member, _ in rows]
+
+def test_forward_events_accumulate(store):
+    add_events(KEY, [("a", NOW - 100, 1.0), ("b", NOW - 10, 1.0)])
+    add_events(KEY, [("a", NOW - 50, 2.0)])
+    rows = dict(get_trending(KEY, 10, now=NOW + 30))
+    assert rows[b"a"] == pytest.approx(decayed_score(1.0, NOW - 100, NOW + 30) + decayed_score(2.0, NOW - 50, NOW + 30))
+    assert rows[b"b"] == pytest.approx(decayed_score(1.0, NOW - 10, NOW + 30))
+
+def test_rebase_keeps_present_scores(store):
+    add_events(KEY, [(f"item{i}", NOW - 10 * i, 1.0 + i) for i in range(20)])
+    later = NOW + 3600
+    before = get_trending(KEY, 20, now=later)
+    assert rebase_landmark(KEY, later) == later
+    after = get_trending(KEY, 20, now=later)
+    assert members(after) == members(before)
+    assert [score for _, score in after] == pytest.approx([score for _, score in before])
+    # Events after the rebase still add up against the new landmark
+    add_events(KEY, [("item0", later, 5.0)])
+    assert dict(get_trending(KEY, 20, now=later))[b"item0"] == pytest.approx(dict(before)[b"item0"] + 5.0)
+
+def test_rebase_waits_for_the_exponent(store):
+    add_events(KEY, [("a", NOW, 1.0)])
+    due = NOW + math.ceil(LANDMARK_REBASE_EXPONENT / DECAY_RATE) + 60
+    assert maybe_rebase_landmark(KEY, NOW + 60) is None
+    assert maybe_rebase_landmark(KEY, due) == due
+
+def test_local_store_rebases_on_write(monkeypatch):
+    store = scoring.make_store("local", None)
+    monkeypatch.setattr(scoring, "store", store)
+    add_events(KEY, [("a", NOW, 1.0)])
+    later = NOW + math.ceil(LANDMARK_REBASE_EXPONENT / DECAY_RATE) + 60
+    store.add_events([(KEY, DECAY_RATE)], [("b", later, 1.0)], later)
+    assert store._sets[KEY].landmark == later
+    rows = dict(get_trending(KEY, 10, now=later))
+    assert rows[b"a"] == pytest.approx(decayed_score(1.0, NOW, later))
+    assert rows[b"b"] == pytest.approx(1.0)
+
+def test_coalescing_buffer_merges_events_per_item(store):
+    buffer = scoring.CoalescingBuffer(window_ms=500)
+    for i in range(10):
+        buffer.add(KEY, "a", NOW - 10 * i, 1.0)
+    buffer.add(KEY, "b", NOW, 2.0)
+    assert get_trending(KEY, 10, now=NOW) == []
+    buffer.close()
+    assert buffer.stats()["events"] == 11 and buffer.stats()["writes"] == 2
+    rows = dict(get_trending(KEY, 10, now=NOW))
+    assert rows[b"a"] == pytest.approx(sum(decayed_score(1.0, NOW - 10 * i, NOW) for i in range(10)))
+    assert rows[b"b"] == pytest.approx(2.0)
+
+def test_coalescing_buffer_counts_failed_writes(store, monkeypatch, caplog):
+    def down(*args, **kwargs):
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(store, "add_events", down)
+    buffer = scoring.CoalescingBuffer(window_ms=500)
+    buffer.add(KEY, "a", NOW, 1.0)
+    buffer.add(KEY, "b", NOW, 1.0)
+    buffer.close()
+    assert buffer.stats()["failed_writes"] == 2 and buffer.stats()["writes"] == 0
+    assert "Dropped 2 coalesced writes" in caplog.text
+
+def test_writes_that_would_overflow_a_total_are_refused(store):
+    add_events(KEY, [("a", NOW, 1e308)])
+    with pytest.raises(Exception, match="not finite"):
+        add_events(KEY, [("a", NOW, 1e308)])
+    # Nothing of the refused write is kept, and the set still reads as numbers
+    assert get_trending(KEY, 10, now=NOW) == [(b"a", pytest.approx(1e308))]
+    add_events(KEY, [("b", NOW, 1.0)])
+    assert len(get_trending(KEY, 10, now=NOW)) == 2
+
+def test_every_profile_decays_at_its_own_rate(store, monkeypatch):
+    monkeypatch.setattr(scoring, "DECAY_PROFILES", _parse_profiles("1h=3600,24h=86400"))
+    monkeypatch.setattr(scoring, "DEFAULT_WINDOW", "1h")
+    add_events(KEY, [("a", NOW - 3600, 1.0), ("b", NOW, 1.0)])
+    hourly = dict(get_trending(KEY, 10, now=NOW))
+    assert hourly == dict(get_trending(KEY, 10, window="1h", now=NOW))
+    assert hourly[b"a"] == pytest.approx(0.5)
+    assert dict(get_trending(KEY, 10, window="24h", now=NOW))[b"a"] == pytest.approx(0.5 ** (1 / 24))
+    with pytest.raises(ValueError, match="unknown window"):
+        get_trending(KEY, 10, window="7d", now=NOW)
+
+def test_compaction_drops_members_below_the_present_floor(store):
+    add_events(KEY, [(f"item{w:02d}", NOW, float(w)) for w in range(1, 31)])
+    # One half-life later every present score is half its weight
+    later = NOW + round(math.log(2) / DECAY_RATE)
+    assert compact(KEY, max_size=0, floor=2.75, now=later) == (5, 0)
+    assert sorted(members(get_trending(KEY, 30, now=later)))[:1] == ["item06"]
+
+def test_compaction_keeps_the_top_of_every_shard(store):
+    add_events(KEY, [(f"item{w:02d}", NOW, float(w)) for w in range(1, 31)])
+    top = get_trending(KEY, 5, now=NOW)
+    by_score, by_rank = compact(KEY, max_size=5, floor=0, now=NOW)
+    left = get_trending(KEY, 30, now=NOW)
+    assert by_score == 0 and by_rank == 30 - len(left) > 0
+    assert left[:5] == top
+
+def test_category_union_sums_present_scores(store):
+    add_events(KEY, [("a", NOW, 1.0, ("news",)), ("b", NOW - 600, 2.0, ("sports",)), ("c", NOW, 1.0)])
+    add_events(KEY, [("a", NOW, 1.0, ("news", "sports"))])
+    later = NOW + 60
+    rows = dict(get_trending(KEY, 10, categories=("news", "sports"), now=later))
+    assert set(rows) == {b"a", b"b"}
+    # Counted once per requested category it was written to
+    assert rows[b"a"] == pytest.approx(decayed_score(3.0, NOW, later))
+    assert rows[b"b"] == pytest.approx(decayed_score(2.0, NOW - 600, later))
+    assert members(get_trending(KEY, 10, categories=("sports",), now=later)) == ["b", "a"]
+
+def test_local_store_drops_expired_unions(monkeypatch):
+    store = LocalTrendingStore()
+    monkeypatch.setattr(scoring, "store", store)
+    add_events(KEY, [("a", NOW, 1.0, ("x", "y", "z"))])
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    get_trending(KEY, 10, categories=("x", "y"), now=NOW)
+    get_trending(KEY, 10, categories=("y", "z"), now=NOW)
+    assert len(store._union_expires) == 2
+    clock[0] += 60
+    assert members(get_trending(KEY, 10, categories=("x", "z"), now=NOW)) == ["a"]
+    assert list(store._union_expires) == [scoring.union_target(KEY, ("x", "z"))[0]]
+    assert sum(":union:" in key for key in store._sets) == 1
+
+@pytest.mark.parametrize("count", [1, 3, 7])
+def test_cursor_pages_through_ties(store, count):
+    # Every score is equal, so only the item_id tiebreak orders the set
+    add_events(KEY, [(f"item{i:02d}", NOW, 1.0) for i in range(25)])
+    rows = page_through(count, NOW)
+    assert sorted(members(rows)) == [f"item{i:02d}" for i in range(25)]
+    assert members(rows) == members(get_trending(KEY, 25, now=NOW))
+
+def test_cursor_skips_no_unchanged_item_when_others_are_rescored(store):
+    add_events(KEY, [(f"item{i:02d}", NOW - i, 1.0 + (i % 4)) for i in range(30)])
+    rescored = set()
+
+    def rescore(page):
+        # Raise the item the cursor points at and one not read yet, both above the cursor
+        rows = get_trending(KEY, 30, now=NOW)
+        for member, _ in (rows[5 * page - 1], rows[-1]):
+            rescored.add(member.decode())
+            add_events(KEY, [(member.decode(), NOW, 10.0)])
+
+    rows = page_through(5, NOW, rescore)
+    seen = members(rows)
+    for item in (f"item{i:02d}" for i in range(30)):
+        if item not in rescored:
+            assert seen.count(item) == 1, item
+
+def test_cursor_survives_a_rebase(store):
+    add_events(KEY, [(f"item{i:02d}", NOW - 3 * i, 1.0) for i in range(12)])
+    later = NOW + 600
+    expected = members(get_trending(KEY, 12, now=later))
+    first = get_trending(KEY, 5, now=later)
+    rebase_landmark(KEY, later)
+    member, score = first[-1]
+    rest = get_trending(KEY, 10, cursor=(score, later, member.decode()), now=later)
+    assert members(first) + members(rest) == expected
+
+@pytest.mark.parametrize("read_after", [37, 123, 159, 173, 601, 849])
+def test_cursor_pages_through_ties_when_the_cursor_item_is_rescored(store, read_after):
+    # The cursor score only approximates the tie once converted through the landmark
+    add_events(KEY, [(f"item{i:02d}", NOW, 0.3) for i in range(10)])
+    later = NOW + read_after
+    rescored = []
+
+    def rescore(page):
+        if not rescored:
+            cursor_item = members(get_trending(KEY, 10, now=later))[3 * page - 1]
+            rescored.append(cursor_item)
+            add_events(KEY, [(cursor_item, NOW, 5.0)])
+
+    seen = members(page_through(3, later, rescore))
+    assert sorted(item for item in seen if item not in rescored) == sorted(
+        f"item{i:02d}" for i in range(10) if f"item{i:02d}" not in rescored)
+
+def test_time_travel_reads_history_copies_and_projects_forward(store):
+    add_events(KEY, [("a", NOW, 2.0), ("b", NOW, 1.0, ("news",))])
+    assert record_history(KEY, now=NOW) == 2
+    add_events(KEY, [("b", NOW, 5.0)])
+    # The past is read from the copy, decayed to `at`, without the later event
+    past = dict(get_trending(KEY, 10, now=NOW + 60, at=NOW + 30))
+    assert past == {b"a": pytest.approx(decayed_score(2.0, NOW, NOW + 30)),
+                    b"b": pytest.approx(decayed_score(1.0, NOW, NOW + 30))}
+    assert members(get_trending(KEY, 10, categories=("news",), now=NOW + 60, at=NOW)) == ["b"]
+    # The future projects the live set
+    future = dict(get_trending(KEY, 10, now=NOW, at=NOW + 600))
+    assert future[b"b"] == pytest.approx(decayed_score(6.0, NOW, NOW + 600))
+    with pytest.raises(ValueError, match="no history copy"):
+        get_trending(KEY, 10, now=NOW + 60, at=NOW - 1)
+
+def test_history_copies_older_than_the_retention_are_dropped(store):
+    add_events(KEY, [("a", NOW, 1.0)])
+    for taken in (NOW - 300, NOW - 200, NOW):
+        record_history(KEY, now=taken, retention=250)
+    assert store.history(KEY) == [NOW - 200, NOW]
+
+def tracking_cache(clients) -> TrackingCache:
+    """A TrackingCache whose listeners count as connected, without starting them."""
+    cache = TrackingCache(clients, prefix=KEY, rows=10)
+    cache._pid = os.getpid()
+    cache._live = set(clients)
+    return cache
+
+def miss(cache, shards):
+    """(shards to read, token) of a lookup that is expected to miss."""
+    _, missing, token = cache.lookup(shards, 0, 5)
+    return missing, token
+
+def test_tracking_cache_keeps_rows_until_invalidated():
+    client = object()
+    shards = [(client, f"{KEY}:shard:0"), (client, f"{KEY}:shard:1")]
+    cache = tracking_cache([client])
+    replies = [([(b"a", 2.0)], "100"), ([(b"b", 1.0)], "100")]
+    missing, token = miss(cache, shards)
+    assert len(missing) == 2
+    cache.store(missing, token, replies, 10)
+    hits, missing, _ = cache.lookup(shards, 0, 5)
+    assert not missing and hits[f"{KEY}:shard:0"] == ([(b"a", 2.0)], "100")
+    # A write to a shard's meta hash (e.g. a rebase) drops that shard only
+    cache._invalidate(["invalidate", [f"{KEY}:shard:1:meta".encode()]])
+    _, missing, _ = cache.lookup(shards, 0, 5)
+    assert missing == [shards[1]]
+
+def test_tracking_cache_drops_a_read_that_raced_an_invalidation():
+    client = object()
+    shards = [(client, f"{KEY}:shard:0"), (client, f"{KEY}:shard:1")]
+    cache = tracking_cache([client])
+    missing, token = miss(cache, shards)
+    # The shard is written (and invalidated) after it was read but before the rows are stored
+    cache._invalidate(["invalidate", [f"{KEY}:shard:0".encode()]])
+    cache.store(missing, token, [([(b"stale", 9.0)], None), ([(b"b", 1.0)], None)], 10)
+    _, missing, _ = cache.lookup(shards, 0, 5)
+    assert missing == [shards[0]]
+
+def test_tracking_cache_drops_reads_across_a_flush_or_disconnect():
+    client = object()
+    shards = [(client, f"{KEY}:shard:0")]
+    cache = tracking_cache([client])
+    missing, token = miss(cache, shards)
+    cache._invalidate(["invalidate", None])
+    cache.store(missing, token, [([(b"a", 1.0)], None)], 10)
+    assert cache.lookup(shards, 0, 5)[1] == shards
+    # Rows read while the host's listener is down are not kept either
+    cache._live.clear()
+    missing, token = miss(cache, shards)
+    cache.store(missing, token, [([(b"a", 1.0)], None)], 10)
+    assert cache.lookup(shards, 0, 5)[1] == shards
+
+def test_tracked_reads_skip_redis_until_invalidated(fake_redis):
+    store = scoring.RedisTrendingStore(hosts=["redis-a:6379"], shard_count=2)
+    store.tracking = tracking_cache(store.clients)
+    store.add_events([(KEY, DECAY_RATE)], [(f"item{i}", NOW, 1.0 + i) for i in range(6)], NOW)
+    expected = store.top(KEY, 3, NOW)
+    store.add_events([(KEY, DECAY_RATE)], [("item0", NOW, 100.0)], NOW)
+    # fakeredis sends no invalidations, so the rows read before the write are still served
+    assert store.top(KEY, 3, NOW) == expected
+    assert store.tracking.stats()["hits"] == 2
+    skey = scoring.shard_key(KEY, scoring.shard_index("item0", 2), 2)
+    store.tracking._invalidate(["invalidate", [skey.encode()]])
+    assert store.top(KEY, 1, NOW)[0][0] == b"item0"
+
+def test_tracking_cache_is_disabled_without_invalidation_pushes(monkeypatch, caplog):
+    class NoPushes:
+        # e.g. the hiredis parser, which keeps RESP3 pushes to itself
+        def __init__(self, **kwargs):
+            self._parser = object()
+
+    client = redis.Redis()
+    monkeypatch.setattr(redis, "Connection", NoPushes)
+    cache = TrackingCache([client], prefix=KEY, rows=10)
+    # Returns instead of reconnecting forever, and the host never counts as connected
+    cache._listen(client)
+    assert "Client-side caching disabled" in caplog.text
+    missing, token = miss(cache, [(client, f"{KEY}:shard:0")])
+    cache.store(missing, token, [([(b"a", 1.0)], None)], 10)
+    assert cache.stats()["keys"] == 0
@@ -0,0 +1,42 @@
+import importlib.util
+import pytest
+import serve
+from serve import server_options, worker_count
+
+@pytest.fixture
+def shared_store(monkeypatch):
+    monkeypatch.setattr(serve, "IN_PROCESS_STORE", False)
+
+def test_worker_count_follows_the_worker_class(shared_store):
+    assert worker_count("sync", cpus=4) == 9
+    assert worker_count("gthread", cpus=4) == worker_count("asgi", cpus=4) == 4
+
+def test_in_process_stores_run_one_worker_without_preloading():
+    assert worker_count("sync", cpus=4) == 1
+    options = server_options("gthread", workers=0)
+    assert options["workers"] == 1 and not options["preload_app"]
+    with pytest.raises(ValueError, match="single worker"):
+        server_options("gthread", workers=2)
+
+@pytest.mark.parametrize("worker_class, gunicorn_class, threads, preload", [
+    ("sync", "sync", 1, True),
+    ("gthread", "gthread", serve.SERVER_THREADS, True),
+    ("gevent", "gevent", 1, False),
+    ("asgi", "uvicorn.workers.UvicornWorker", 1, True),
+])
+def test_server_options(shared_store, monkeypatch, worker_class, gunicorn_class, threads, preload):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: object() if name == "gevent" else find_spec(name))
+    options = server_options(worker_class, workers=3, bind="127.0.0.1:9000")
+    assert (options["worker_class"], options["workers"], options["threads"]) == (gunicorn_class, 3, threads)
+    # gevent patches the standard library in the worker, so nothing may be imported before that in the master
+    assert options["preload_app"] is preload
+    # The ASGI app warms its pools at lifespan startup instead
+    assert ("post_worker_init" in options) is (worker_class != "asgi")
+
+def test_unknown_or_missing_worker_classes_are_refused(shared_store, monkeypatch):
+    with pytest.raises(ValueError, match="unknown worker class"):
+        server_options("eventlet")
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(ValueError, match="needs the gevent package"):
+        server_options("gevent")
@@ -0,0 +1,45 @@
+import math
+import time
+import pytest
+from sketch_store import RedisSketchStore, SketchTrendingStore
+from constants import DECAY_RATE
+
+KEY = "trending"
+NOW = int(time.time())
+
+@pytest.fixture(params=["sketch", "redis_sketch"])
+def sketch(request):
+    if request.param == "sketch":
+        return SketchTrendingStore(k=5, epsilon=0.01, delta=0.01)
+    request.getfixturevalue("fake_redis")
+    return RedisSketchStore(k=5, epsilon=0.01, delta=0.01)
+
+def write(store, events):
+    for start in range(0, len(events), 50):
+        store.add_events([(KEY, DECAY_RATE)], events[start:start + 50], NOW)
+
+def test_heavy_hitters_are_kept_and_never_underestimated(sketch):
+    heavy = [(f"hot{i}", NOW, 100.0 + i) for i in range(5)]
+    light = [(f"cold{i}", NOW, 1.0) for i in range(300)]
+    write(sketch, light[:150] + heavy + light[150:])
+    rows = sketch.top(KEY, 10, NOW)
+    assert len(rows) == 5
+    assert sorted(member for member, _ in rows) == sorted(item_id.encode() for item_id, _, _ in heavy)
+    total = sum(weight for _, _, weight in heavy + light)
+    for member, estimate in rows:
+        exact = 100.0 + int(member[3:])
+        # Count-Min estimates only overcount, by at most epsilon * total with probability 1 - delta
+        assert exact - 1e-6 <= estimate <= exact + 0.01 * total
+
+def test_a_rising_item_replaces_the_smallest_tracked_one(sketch):
+    write(sketch, [(f"item{i}", NOW, float(i + 1)) for i in range(5)])
+    sketch.add_events([(KEY, DECAY_RATE)], [("new", NOW, 0.6)], NOW)
+    assert b"item0" in {member for member, _ in sketch.top(KEY, 10, NOW)}
+    sketch.add_events([(KEY, DECAY_RATE)], [("new", NOW, 0.6)], NOW)
+    tracked = {member for member, _ in sketch.top(KEY, 10, NOW)}
+    assert b"new" in tracked and b"item0" not in tracked and len(tracked) == 5
+
+def test_scores_decay_between_reads(sketch):
+    sketch.add_events([(KEY, DECAY_RATE)], [("a", NOW, 4.0)], NOW)
+    later = NOW + 600
+    assert sketch.top(KEY, 1, later)[0][1] == pytest.approx(4.0 * math.exp(-DECAY_RATE * 600))
@@ -0,0 +1,114 @@
+import glob
+import os
+import threading
+import time
+import scoring
+import snapshot
+from local_store import LocalTrendingStore
+from sketch_store import SketchTrendingStore
+from constants import DECAY_RATE
+
+TARGETS = [("trending", DECAY_RATE), ("trending:category:news", DECAY_RATE)]
+NOW = int(time.time())
+
+def restored(directory, cls=LocalTrendingStore, background=False):
+    store = cls()
+    snapshot.restore(store, directory, background)
+    return store
+
+def tops(store, keys=("trending", "trending:category:news", "other")) -> dict:
+    return {key: store.top(key, 50, NOW) for key in keys}
+
+def write_history(store):
+    store.add_events(TARGETS, [(f"item{i}", NOW - i, 1.0 + i % 3) for i in range(30)], NOW)
+    store.add_events([("other", DECAY_RATE)], [("x", NOW, 1.0)], NOW)
+
+def close(*stores):
+    for store in stores:
+        if store.journal is not None:
+            store.journal.close()
+
+def test_journal_alone_replays_every_write(tmp_path):
+    store = restored(str(tmp_path))
+    write_history(store)
+    store.compact("trending", NOW, 10, 0.0)
+    store.rebase("trending:category:news", NOW + 60)
+    again = restored(str(tmp_path))
+    assert tops(again) == tops(store)
+    close(store, again)
+
+def test_snapshot_plus_journal_restores_later_writes(tmp_path):
+    store = restored(str(tmp_path))
+    write_history(store)
+    snapshot.write_snapshot(store, str(tmp_path))
+    store.add_events(TARGETS, [("late", NOW, 50.0)], NOW)
+    store.delete("other")
+    store.save_history("trending", NOW, store.top("trending", 5, NOW))
+    again = restored(str(tmp_path))
+    assert tops(again) == tops(store)
+    assert again.history("trending") == [NOW]
+    # Only the logs after the snapshot are kept
+    assert len(glob.glob(os.path.join(str(tmp_path), "delta-*.log"))) == 2
+    close(store, again)
+
+def test_torn_record_ends_the_replay(tmp_path):
+    store = restored(str(tmp_path))
+    store.add_events(TARGETS, [("a", NOW, 1.0)], NOW)
+    store.add_events(TARGETS, [("b", NOW, 2.0)], NOW)
+    close(store)
+    log = glob.glob(os.path.join(str(tmp_path), "delta-*.log"))[0]
+    with open(log, "r+b") as f:
+        f.truncate(os.path.getsize(log) - 3)
+    again = restored(str(tmp_path))
+    assert [member for member, _ in again.top("trending", 10, NOW)] == [b"a"]
+    # Writes after the restore go to a new log, not after the torn record
+    again.add_events(TARGETS, [("c", NOW, 3.0)], NOW)
+    last = restored(str(tmp_path))
+    assert [member for member, _ in last.top("trending", 10, NOW)] == [b"c", b"a"]
+    close(again, last)
+
+def test_warm_start_serves_unchanged_sets_from_the_snapshot(tmp_path, monkeypatch):
+    store = restored(str(tmp_path))
+    write_history(store)
+    snapshot.write_snapshot(store, str(tmp_path))
+    store.add_events([("trending", DECAY_RATE)], [("late", NOW, 50.0)], NOW)
+    expected = tops(store)
+    close(store)
+
+    release = threading.Event()
+    replay = LocalTrendingStore.replay
+
+    def held_replay(self, record):
+        release.wait(5)
+        replay(self, record)
+
+    monkeypatch.setattr(LocalTrendingStore, "replay", held_replay)
+    again = restored(str(tmp_path), background=True)
+    # The rebuild is held, so these come straight from the mapped snapshot
+    assert again.top("other", 50, NOW) == expected["other"]
+    assert again.top("trending:category:news", 50, NOW) == expected["trending:category:news"]
+    # "trending" changed after the snapshot, so its read waits for the replay
+    read = []
+    reader = threading.Thread(target=lambda: read.append(again.top("trending", 50, NOW)))
+    reader.start()
+    reader.join(0.2)
+    assert not read
+    release.set()
+    reader.join(5)
+    assert read == [expected["trending"]]
+    assert tops(again) == expected
+    close(again)
+
+def test_sketch_store_restores_sketch_and_history_copies(tmp_path):
+    store = restored(str(tmp_path), SketchTrendingStore)
+    write_history(store)
+    rows = store.top("trending", 5, NOW)
+    store.save_history("trending", NOW, rows)
+    snapshot.write_snapshot(store, str(tmp_path))
+    again = restored(str(tmp_path), SketchTrendingStore)
+    assert tops(again) == tops(store)
+    copy = scoring.history_key("trending", NOW)
+    # History copies are plain sets, with no sketch in memory or in the snapshot
+    assert getattr(again._sets[copy], "sketch", None) is None
+    assert again.top(copy, 5, NOW) == rows
+    close(store, again)